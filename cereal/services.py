@@ -69,6 +69,7 @@ services = {
   "navRoute": (True, 0.),
   "navThumbnail": (True, 0.),
   "roadLimitSpeed": (False, 0.),
+  "nTuneUpdate": (True, 0.),
 
   # debug
   "testJoystick": (False, 0.),
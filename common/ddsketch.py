@@ -0,0 +1,117 @@
+import math
+import struct
+from typing import Dict, List, Sequence
+
+# magnitudes below this are counted as zero
+MIN_VALUE = 1e-9
+
+# gamma, count, sum, min, max, zero count, number of positive and negative buckets
+HEADER = struct.Struct("<dIdddIHH")
+
+
+class DDSketch:
+  """Streaming quantile sketch with relative accuracy (DDSketch, Masson et al. 2019).
+
+  Values are counted in logarithmically sized buckets, so a quantile is within
+  relative_accuracy of the true value. At most max_buckets buckets are kept for each sign,
+  beyond that the ones closest to zero are merged, which only affects the lowest quantiles
+  of positive and the highest of negative values. count, sum, min and max are exact."""
+  def __init__(self, relative_accuracy: float = 0.01, max_buckets: int = 1024):
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.max_buckets = max_buckets
+
+    self.pos: Dict[int, int] = {}
+    self.neg: Dict[int, int] = {}
+    self.zero = 0
+    self.count = 0
+    self.sum = 0.
+    self.min = math.inf
+    self.max = -math.inf
+
+  def key(self, magnitude: float) -> int:
+    return math.ceil(math.log(magnitude) / self.log_gamma)
+
+  def value(self, key: int) -> float:
+    return 2 * self.gamma ** key / (self.gamma + 1)
+
+  def add(self, v: float) -> None:
+    self.count += 1
+    self.sum += v
+    if v < self.min:
+      self.min = v
+    if v > self.max:
+      self.max = v
+
+    if v > MIN_VALUE:
+      store = self.pos
+    elif v < -MIN_VALUE:
+      store = self.neg
+    else:
+      self.zero += 1
+      return
+
+    k = self.key(abs(v))
+    store[k] = store.get(k, 0) + 1
+    if len(store) > self.max_buckets:
+      self.collapse(store)
+
+  def collapse(self, store: Dict[int, int]) -> None:
+    while len(store) > self.max_buckets:
+      n = store.pop(min(store))
+      store[min(store)] += n
+
+  def merge(self, other: "DDSketch") -> None:
+    """Add the values of other, a sketch with the same relative accuracy"""
+    if other.gamma != self.gamma:
+      raise ValueError("can only merge sketches with the same relative accuracy")
+    for store, other_store in ((self.pos, other.pos), (self.neg, other.neg)):
+      for k, n in other_store.items():
+        store[k] = store.get(k, 0) + n
+      self.collapse(store)
+    self.zero += other.zero
+    self.count += other.count
+    self.sum += other.sum
+    self.min = min(self.min, other.min)
+    self.max = max(self.max, other.max)
+
+  def to_bytes(self) -> bytes:
+    pos, neg = sorted(self.pos.items()), sorted(self.neg.items())
+    buckets = [k for k, _ in pos] + [n for _, n in pos] + [k for k, _ in neg] + [n for _, n in neg]
+    return (HEADER.pack(self.gamma, self.count, self.sum, self.min, self.max, self.zero, len(pos), len(neg)) +
+            struct.pack(f"<{len(pos)}i{len(pos)}I{len(neg)}i{len(neg)}I", *buckets))
+
+  @classmethod
+  def from_bytes(cls, dat: bytes, max_buckets: int = 1024) -> "DDSketch":
+    gamma, count, total, min_value, max_value, zero, n_pos, n_neg = HEADER.unpack_from(dat)
+    buckets = struct.unpack_from(f"<{n_pos}i{n_pos}I{n_neg}i{n_neg}I", dat, HEADER.size)
+
+    sketch = cls((gamma - 1) / (gamma + 1), max_buckets)
+    sketch.gamma = gamma  # exactly, so it merges with sketches of the same accuracy
+    sketch.log_gamma = math.log(gamma)
+    sketch.pos = dict(zip(buckets[:n_pos], buckets[n_pos:2 * n_pos]))
+    sketch.neg = dict(zip(buckets[2 * n_pos:2 * n_pos + n_neg], buckets[2 * n_pos + n_neg:]))
+    sketch.zero, sketch.count, sketch.sum, sketch.min, sketch.max = zero, count, total, min_value, max_value
+    return sketch
+
+  def quantiles(self, qs: Sequence[float]) -> List[float]:
+    """Estimates of the qs quantiles (ascending, 0 to 1), like sorted(values)[round(q * (count - 1))]"""
+    if self.count == 0:
+      return [math.nan] * len(qs)
+
+    buckets = [(-self.value(k), self.neg[k]) for k in sorted(self.neg, reverse=True)]
+    buckets.append((0., self.zero))
+    buckets += [(self.value(k), self.pos[k]) for k in sorted(self.pos)]
+
+    ret = []
+    i, seen = 0, buckets[0][1]
+    for q in qs:
+      rank = round(q * (self.count - 1))
+      while seen <= rank and i < len(buckets) - 1:
+        i += 1
+        seen += buckets[i][1]
+      ret.append(min(max(buckets[i][0], self.min), self.max))
+    return ret
+
+  def quantile(self, q: float) -> float:
+    return self.quantiles([q])[0]
@@ -0,0 +1,91 @@
+import os
+import select
+import struct
+from typing import List, NamedTuple, Optional
+from cffi import FFI
+
+ffi = FFI()
+ffi.cdef("""
+int inotify_init1(int flags);
+int inotify_add_watch(int fd, const char *pathname, uint32_t mask);
+int inotify_rm_watch(int fd, int wd);
+""")
+libc = ffi.dlopen(None)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyEvent(NamedTuple):
+  wd: int
+  mask: int
+  cookie: int
+  name: str
+
+
+class Inotify:
+  """Minimal inotify wrapper, events are read in batches with an optional timeout"""
+  def __init__(self):
+    self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.fd == -1:
+      raise OSError(ffi.errno, f"{os.strerror(ffi.errno)}: inotify_init1")
+    self.watches = {}
+
+  def fileno(self) -> int:
+    return self.fd
+
+  def add_watch(self, path: str, mask: int) -> int:
+    wd = libc.inotify_add_watch(self.fd, path.encode(), mask)
+    if wd == -1:
+      raise OSError(ffi.errno, f"{os.strerror(ffi.errno)}: inotify_add_watch({path}, {mask:#x})")
+    self.watches[wd] = path
+    return wd
+
+  def rm_watch(self, wd: int) -> None:
+    self.watches.pop(wd, None)
+    libc.inotify_rm_watch(self.fd, wd)
+
+  def read(self, timeout: Optional[float] = None) -> List[InotifyEvent]:
+    """Wait up to timeout seconds (forever if None) and return all pending events"""
+    r, _, _ = select.select([self.fd], [], [], timeout)
+    if not r:
+      return []
+
+    try:
+      buf = os.read(self.fd, 64 * 1024)
+    except BlockingIOError:
+      return []
+
+    events = []
+    i = 0
+    while i + EVENT_HEADER.size <= len(buf):
+      wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(buf, i)
+      i += EVENT_HEADER.size
+      name = buf[i:i + name_len].rstrip(b"\0").decode(errors="replace")
+      i += name_len
+      events.append(InotifyEvent(wd, mask, cookie, name))
+    return events
+
+  def close(self) -> None:
+    if self.fd != -1:
+      os.close(self.fd)
+      self.fd = -1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -3,6 +3,7 @@ import os
 import sys
 import copy
 import json
+import marshal
 import time
 import uuid
 import socket
@@ -14,6 +15,9 @@ from contextlib import contextmanager
 
 LOG_TIMESTAMPS = "LOG_TIMESTAMPS" in os.environ
 
+# marks a marshalled record on the logmessaged socket, json records start with '{'
+BINARY_RECORD = b"\x00"
+
 def json_handler(obj):
   # if isinstance(obj, (datetime.date, datetime.time)):
   #   return obj.isoformat()
@@ -33,38 +37,66 @@ class SwagFormatter(logging.Formatter):
     self.swaglogger = swaglogger
     self.host = socket.gethostname()
 
-  def format_dict(self, record):
-    record_dict = NiceOrderedDict()
-
+  def record_fields(self, record):
     if isinstance(record.msg, dict):
-      record_dict['msg'] = record.msg
+      msg = record.msg
     else:
       try:
-        record_dict['msg'] = record.getMessage()
+        msg = record.getMessage()
       except (ValueError, TypeError):
-        record_dict['msg'] = [record.msg]+record.args
+        msg = [record.msg]+record.args
+
+    exc_info = self.formatException(record.exc_info) if record.exc_info else None
 
-    record_dict['ctx'] = self.swaglogger.get_ctx()
+    return (msg, self.swaglogger.get_ctx(), exc_info, record.levelno, record.name, record.filename, record.lineno,
+            record.pathname, record.module, record.funcName, record.process, record.thread, record.threadName,
+            record.created)
 
-    if record.exc_info:
-      record_dict['exc_info'] = self.formatException(record.exc_info)
+  def fields_dict(self, fields):
+    (msg, ctx, exc_info, levelno, name, filename, lineno, pathname, module, funcName,
+     process, thread, threadName, created) = fields
 
-    record_dict['level'] = record.levelname
-    record_dict['levelnum'] = record.levelno
-    record_dict['name'] = record.name
-    record_dict['filename'] = record.filename
-    record_dict['lineno'] = record.lineno
-    record_dict['pathname'] = record.pathname
-    record_dict['module'] = record.module
-    record_dict['funcName'] = record.funcName
+    record_dict = NiceOrderedDict()
+    record_dict['msg'] = msg
+    record_dict['ctx'] = ctx
+    if exc_info is not None:
+      record_dict['exc_info'] = exc_info
+    record_dict['level'] = logging.getLevelName(levelno)
+    record_dict['levelnum'] = levelno
+    record_dict['name'] = name
+    record_dict['filename'] = filename
+    record_dict['lineno'] = lineno
+    record_dict['pathname'] = pathname
+    record_dict['module'] = module
+    record_dict['funcName'] = funcName
     record_dict['host'] = self.host
-    record_dict['process'] = record.process
-    record_dict['thread'] = record.thread
-    record_dict['threadName'] = record.threadName
-    record_dict['created'] = record.created
+    record_dict['process'] = process
+    record_dict['thread'] = thread
+    record_dict['threadName'] = threadName
+    record_dict['created'] = created
 
     return record_dict
 
+  def format_dict(self, record):
+    return self.fields_dict(self.record_fields(record))
+
+  def format_binary(self, record):
+    """The record's fields marshalled, logmessaged builds the dict and does the json encoding"""
+    if self.swaglogger is None:
+      raise Exception("must set swaglogger before calling format_binary()")
+    fields = self.record_fields(record)
+    if type(fields[0]) is not dict and isinstance(fields[0], dict):
+      # cloudlog.event() messages
+      fields = (dict(fields[0]),) + fields[1:]
+    try:
+      return marshal.dumps(fields)
+    except ValueError:
+      # values marshal can't store become what the json encoding would make of them
+      return marshal.dumps(json.loads(json_robust_dumps(fields)))
+
+  def load_binary(self, dat):
+    return self.fields_dict(marshal.loads(dat))
+
   def format(self, record):
     if self.swaglogger is None:
       raise Exception("must set swaglogger before calling format()")
@@ -98,6 +130,9 @@ class SwagLogFileFormatter(SwagFormatter):
   def format(self, record):
     if isinstance(record, str):
       v = json.loads(record)
+    elif isinstance(record, dict):
+      # already formatted by logmessaged
+      v = NiceOrderedDict(record)
     else:
       v = self.format_dict(record)
 
@@ -1,8 +1,236 @@
-from common.params_pyx import Params, ParamKeyType, UnknownKeyName, put_nonblocking # pylint: disable=no-name-in-module, import-error
+import atexit
+import inspect
+import os
+import threading
+import time
+import weakref
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional
+
+from common.params_pyx import Params, ParamKeyType, UnknownKeyName # pylint: disable=no-name-in-module, import-error
 assert Params
 assert ParamKeyType
 assert UnknownKeyName
-assert put_nonblocking
+
+Callback = Callable[[str, Optional[bytes]], None]
+
+
+class ParamsCache:
+  """Process local read-through cache of the params directory.
+
+  Values are read from disk once and then served from memory. An inotify watch on the params
+  directory drops changed keys from the cache and calls the callbacks registered with watch(),
+  so hot loops can pick up toggles without any filesystem syscalls. Without inotify this
+  falls back to reading through to Params."""
+  def __init__(self, d=""):
+    self.params = Params(d)
+    self.path = self.params.get_param_path()
+    self.cache: Dict[str, Optional[bytes]] = {}
+    # bound methods are held weakly, so a watcher is dropped once its owner is gone
+    self.callbacks: Dict[str, List[Callable[[], Optional[Callback]]]] = defaultdict(list)
+    self.generation = 0
+    self.lock = threading.Lock()
+
+    self.inotify = None
+    try:
+      from common.inotify import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO, IN_MOVED_FROM, IN_DELETE
+      self.inotify = Inotify()
+      self.inotify.add_watch(self.path, IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE)
+      threading.Thread(target=self._watch_thread, name="params_cache", daemon=True).start()
+    except Exception:
+      self.inotify = None
+
+  def _watch_thread(self):
+    from common.inotify import IN_Q_OVERFLOW
+    while True:
+      events = self.inotify.read()
+      overflow = any(e.mask & IN_Q_OVERFLOW for e in events)
+      # params are written to a hidden temp file and renamed into place
+      keys = {e.name for e in events if e.name and not e.name.startswith('.')}
+
+      with self.lock:
+        self.generation += 1
+        if overflow:
+          keys |= set(self.cache.keys()) | set(self.callbacks.keys())
+          self.cache.clear()
+        for k in keys:
+          self.cache.pop(k, None)
+        callbacks = {}
+        for k in keys:
+          if k in self.callbacks:
+            self.callbacks[k] = [ref for ref in self.callbacks[k] if ref() is not None]
+            callbacks[k] = [ref() for ref in self.callbacks[k]]
+
+      for k, cbs in callbacks.items():
+        value = self.get(k)
+        for cb in cbs:
+          if cb is not None:
+            cb(k, value)
+
+  def _get(self, key: str) -> Optional[bytes]:
+    if self.inotify is None:
+      return self.params.get(key)
+
+    try:
+      return self.cache[key]
+    except KeyError:
+      pass
+
+    self.params.check_key(key)
+    generation = self.generation
+    value = self.params.get(key)
+    with self.lock:
+      # don't cache a value that changed while it was being read
+      if generation == self.generation:
+        self.cache[key] = value
+    return value
+
+  def get(self, key, encoding=None):
+    value = self._get(key.decode() if isinstance(key, bytes) else key)
+    if value is None or encoding is None:
+      return value
+    return value.decode(encoding)
+
+  def get_bool(self, key) -> bool:
+    return self.get(key) == b"1"
+
+  def put(self, key, dat):
+    self.params.put(key, dat)
+
+  def put_bool(self, key, val):
+    self.params.put_bool(key, val)
+
+  def delete(self, key):
+    self.params.delete(key)
+
+  def watch(self, keys: Iterable[str], callback: Callback):
+    """Call callback(key, value) from the watcher thread whenever one of keys changes.
+
+    A bound method is only called while its object is alive, other callables are kept until unwatch()."""
+    ref = weakref.WeakMethod(callback) if inspect.ismethod(callback) else (lambda: callback)
+    with self.lock:
+      for k in keys:
+        self.params.check_key(k)
+        self.callbacks[k].append(ref)
+
+  def unwatch(self, callback: Callback):
+    """Stop calling callback for all keys"""
+    with self.lock:
+      for k, refs in self.callbacks.items():
+        self.callbacks[k] = [ref for ref in refs if ref() not in (None, callback)]
+
+
+_writer_start_lock = threading.Lock()
+
+
+def _reset_writer_start_lock() -> None:
+  # a child forked while another thread held the lock would never get it
+  global _writer_start_lock
+  _writer_start_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_writer_start_lock)
+
+
+class ParamsWriter:
+  """Single background thread for non blocking params writes.
+
+  Writes queued while the thread is busy are coalesced, only the last value of a key is
+  written, and each batch is written with one directory fsync per params directory.
+  A forked child starts its own thread, writes still queued in the parent are left to it."""
+  RETRY_DELAY = 1.
+
+  def __init__(self):
+    self.pid = None
+
+  def start(self) -> None:
+    with _writer_start_lock:
+      if self.pid == os.getpid():
+        return
+      self.cv = threading.Condition()
+      self.pending: Dict[str, Dict[str, bytes]] = defaultdict(dict)
+      self.queued = 0
+      self.written = 0
+      threading.Thread(target=self._writer_thread, name="params_writer", daemon=True).start()
+      self.pid = os.getpid()
+
+  def put(self, key, val, d="") -> None:
+    # raise UnknownKeyName here instead of on the writer thread
+    Params(d).check_key(key)
+    if isinstance(val, str):
+      val = val.encode()
+    if os.getpid() != self.pid:
+      self.start()
+
+    with self.cv:
+      self.pending[d][key.decode() if isinstance(key, bytes) else key] = val
+      self.queued += 1
+      self.cv.notify_all()
+
+  def flush(self, timeout: Optional[float] = None) -> bool:
+    """Block until everything queued so far is on disk, returns False on timeout"""
+    if os.getpid() != self.pid:
+      # nothing was queued in this process
+      return True
+
+    with self.cv:
+      target = self.queued
+      return self.cv.wait_for(lambda: self.written >= target, timeout)
+
+  def _writer_thread(self):
+    while True:
+      with self.cv:
+        self.cv.wait_for(lambda: self.queued > self.written)
+        pending, self.pending = self.pending, defaultdict(dict)
+        queued = self.queued
+
+      failed = False
+      for d, values in pending.items():
+        try:
+          Params(d).put_many(values)
+        except OSError:
+          from selfdrive.swaglog import cloudlog
+          cloudlog.exception("params writer failed, retrying")
+          failed = True
+          with self.cv:
+            # keep anything newer that was queued meanwhile
+            for k, v in values.items():
+              self.pending[d].setdefault(k, v)
+
+      if failed:
+        # flush() keeps waiting until the retry succeeds
+        time.sleep(self.RETRY_DELAY)
+        continue
+
+      with self.cv:
+        self.written = queued
+        self.cv.notify_all()
+
+
+_writer = ParamsWriter()
+atexit.register(_writer.flush, 5.)
+
+
+def put_nonblocking(key, val, d="") -> None:
+  """Queue a param write on the shared writer thread, use flush() to wait for it"""
+  _writer.put(key, val, d)
+
+
+def flush(timeout: Optional[float] = None) -> bool:
+  return _writer.flush(timeout)
+
+
+_params_caches: Dict[str, ParamsCache] = {}
+_params_caches_lock = threading.Lock()
+
+
+def get_params_cache(d="") -> ParamsCache:
+  """Shared ParamsCache for a params directory, one inotify watch per process"""
+  with _params_caches_lock:
+    if d not in _params_caches:
+      _params_caches[d] = ParamsCache(d)
+    return _params_caches[d]
+
 
 if __name__ == "__main__":
   import sys
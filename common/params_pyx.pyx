@@ -2,7 +2,7 @@
 # cython: language_level = 3
 from libcpp cimport bool
 from libcpp.string cimport string
-import threading
+from libcpp.map cimport map
 
 cdef extern from "selfdrive/common/params.h":
   cpdef enum ParamKeyType:
@@ -19,7 +19,9 @@ cdef extern from "selfdrive/common/params.h":
     int remove(string) nogil
     int put(string, string) nogil
     int putBool(string, bool) nogil
+    int putMulti(map[string, string]) nogil
     bool checkKey(string) nogil
+    string getParamPath(string) nogil
     void clearAll(ParamKeyType)
 
 
@@ -49,6 +51,10 @@ cdef class Params:
       raise UnknownKeyName(key)
     return key
 
+  def get_param_path(self, key=""):
+    cdef string k = ensure_bytes(key)
+    return self.p.getParamPath(k).decode()
+
   def get(self, key, bool block=False, encoding=None):
     cdef string k = self.check_key(key)
     cdef string val
@@ -89,17 +95,18 @@ cdef class Params:
     with nogil:
       self.p.putBool(k, val)
 
+  def put_many(self, values):
+    """Write a dict of params, the directory is only fsynced once for all of them"""
+    cdef map[string, string] m
+    cdef int r
+    for key, dat in values.items():
+      m[self.check_key(key)] = ensure_bytes(dat)
+    with nogil:
+      r = self.p.putMulti(m)
+    if r != 0:
+      raise OSError(f"failed to write params {list(values)}")
+
   def delete(self, key):
     cdef string k = self.check_key(key)
     with nogil:
       self.p.remove(k)
-
-def put_nonblocking(key, val, d=""):
-  def f(key, val):
-    params = Params(d)
-    cdef string k = ensure_bytes(key)
-    params.put(k, val)
-
-  t = threading.Thread(target=f, args=(key, val))
-  t.start()
-  return t
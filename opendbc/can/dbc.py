@@ -16,6 +16,16 @@ def int_or_float(s):
 DBCSignal = namedtuple("DBCSignal", ["name", "start_bit", "msb", "lsb", "size", "is_little_endian", "is_signed",
                                      "factor", "offset", "tmin", "tmax", "units"])
 
+# regexps from https://github.com/ebroecker/canmatrix/blob/master/canmatrix/importdbc.py
+BO_REGEXP = re.compile(r"^BO\_ (\w+) (\w+) *: (\w+) (\w+)")
+SG_REGEXP = re.compile(r"^SG\_ (\w+) : (\d+)\|(\d+)@(\d+)([\+|\-]) \(([0-9.+\-eE]+),([0-9.+\-eE]+)\) \[([0-9.+\-eE]+)\|([0-9.+\-eE]+)\] \"(.*)\" (.*)")
+SGM_REGEXP = re.compile(r"^SG\_ (\w+) (\w+) *: (\d+)\|(\d+)@(\d+)([\+|\-]) \(([0-9.+\-eE]+),([0-9.+\-eE]+)\) \[([0-9.+\-eE]+)\|([0-9.+\-eE]+)\] \"(.*)\" (.*)")
+VAL_REGEXP = re.compile(r"VAL\_ (\w+) (\w+) (\s*[-+]?[0-9]+\s+\".+?\"[^;]*)")
+
+# used to find big endian LSB from MSB and size
+BE_BITS = [(j + i*8) for i in range(64) for j in range(7, -1, -1)]
+BE_BITS_INDEX = {b: i for i, b in enumerate(BE_BITS)}
+
 
 class dbc():
   def __init__(self, fn):
@@ -24,12 +34,6 @@ class dbc():
       self.txt = f.readlines()
     self._warned_addresses = set()
 
-    # regexps from https://github.com/ebroecker/canmatrix/blob/master/canmatrix/importdbc.py
-    bo_regexp = re.compile(r"^BO\_ (\w+) (\w+) *: (\w+) (\w+)")
-    sg_regexp = re.compile(r"^SG\_ (\w+) : (\d+)\|(\d+)@(\d+)([\+|\-]) \(([0-9.+\-eE]+),([0-9.+\-eE]+)\) \[([0-9.+\-eE]+)\|([0-9.+\-eE]+)\] \"(.*)\" (.*)")
-    sgm_regexp = re.compile(r"^SG\_ (\w+) (\w+) *: (\d+)\|(\d+)@(\d+)([\+|\-]) \(([0-9.+\-eE]+),([0-9.+\-eE]+)\) \[([0-9.+\-eE]+)\|([0-9.+\-eE]+)\] \"(.*)\" (.*)")
-    val_regexp = re.compile(r"VAL\_ (\w+) (\w+) (\s*[-+]?[0-9]+\s+\".+?\"[^;]*)")
-
     # A dictionary which maps message ids to tuples ((name, size), signals).
     #   name is the ASCII name of the message.
     #   size is the size of the message in bytes.
@@ -40,15 +44,12 @@ class dbc():
     # A dictionary which maps message ids to a list of tuples (signal name, definition value pairs)
     self.def_vals = defaultdict(list)
 
-    # used to find big endian LSB from MSB and size
-    be_bits = [(j + i*8) for i in range(64) for j in range(7, -1, -1)]
-
     for l in self.txt:
       l = l.strip()
 
       if l.startswith("BO_ "):
         # new group
-        dat = bo_regexp.match(l)
+        dat = BO_REGEXP.match(l)
 
         if dat is None:
           print("bad BO {0}".format(l))
@@ -63,10 +64,10 @@ class dbc():
 
       if l.startswith("SG_ "):
         # new signal
-        dat = sg_regexp.match(l)
+        dat = SG_REGEXP.match(l)
         go = 0
         if dat is None:
-          dat = sgm_regexp.match(l)
+          dat = SGM_REGEXP.match(l)
           go = 1
 
         if dat is None:
@@ -87,7 +88,7 @@ class dbc():
           lsb = start_bit
           msb = start_bit + signal_size - 1
         else:
-          lsb = be_bits[be_bits.index(start_bit) + signal_size - 1]
+          lsb = BE_BITS[BE_BITS_INDEX[start_bit] + signal_size - 1]
           msb = start_bit
 
         self.msgs[ids][1].append(
@@ -98,7 +99,7 @@ class dbc():
 
       if l.startswith("VAL_ "):
         # new signal value/definition
-        dat = val_regexp.match(l)
+        dat = VAL_REGEXP.match(l)
 
         if dat is None:
           print("bad VAL {0}".format(l))
@@ -124,6 +125,13 @@ class dbc():
       name = m[0][0]
       self.msg_name_to_address[name] = address
 
+  def __getstate__(self):
+    # the raw file contents are only needed while parsing, keep cached/pickled dbcs small
+    state = self.__dict__.copy()
+    state.pop("txt", None)
+    state["_warned_addresses"] = set()
+    return state
+
   def lookup_msg_id(self, msg_id):
     if not isinstance(msg_id, numbers.Number):
       msg_id = self.msg_name_to_address[msg_id]
@@ -1,2 +1,27 @@
+from operator import itemgetter
+
 from opendbc.can.parser_pyx import CANParser, CANDefine  # pylint: disable=no-name-in-module, import-error
 assert CANParser, CANDefine
+
+
+class SignalAccessor:
+  """Reads the (signal, message) list a CANParser was built with in one call.
+
+  CANParser updates the message dicts in vl in place, so they are looked up once here and a
+  read is one itemgetter call per message instead of a double dict lookup per signal. read()
+  returns the values grouped by message, in the order the messages first appear in signals."""
+  def __init__(self, cp, signals):
+    groups = {}
+    for sig, msg in signals:
+      if sig not in cp.vl[msg]:
+        raise KeyError(f"{msg}.{sig} is not parsed by {cp.dbc_name}")
+      groups.setdefault(msg, []).append(sig)
+    # itemgetter of one key returns the value itself, not a tuple
+    self.getters = [(cp.vl[msg], itemgetter(*sigs) if len(sigs) > 1 else (lambda d, s=sigs[0]: (d[s],)))
+                    for msg, sigs in groups.items()]
+
+  def read(self):
+    values = []
+    for vl, get in self.getters:
+      values.extend(get(vl))
+    return values
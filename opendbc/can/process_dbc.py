@@ -1,22 +1,85 @@
 #!/usr/bin/env python3
 import os
 import sys
+import pickle
+import hashlib
 
 import jinja2
 
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from opendbc.can.dbc import dbc
 
-def process(in_fn, out_fn):
+TEMPLATE_FN = os.path.join(os.path.dirname(__file__), "dbc_template.cc")
+GENERATOR_FNS = [TEMPLATE_FN, os.path.join(os.path.dirname(__file__), "dbc.py"), __file__]
+CACHE_DIR_NAME = ".dbc_cache"
+DIGEST_HEADER = "// process_dbc digest: "
+
+
+def file_digest(*fns):
+  h = hashlib.sha1()
+  for fn in fns:
+    with open(fn, "rb") as f:
+      h.update(f.read())
+  return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_template():
+  with open(TEMPLATE_FN, "r") as template_f:
+    return jinja2.Template(template_f.read(), trim_blocks=True, lstrip_blocks=True)
+
+
+def load_dbc(in_fn, cache_dir=None):
+  """Parse a DBC file. If cache_dir is set, the parsed dbc is stored there keyed by a hash
+  of the DBC and the parser, so an unchanged DBC is only parsed once."""
+  if cache_dir is None:
+    return dbc(in_fn)
+
+  dbc_name = os.path.splitext(os.path.basename(in_fn))[0]
+  cache_fn = os.path.join(cache_dir, f"{dbc_name}.{file_digest(in_fn, *GENERATOR_FNS)}.pickle")
+  try:
+    with open(cache_fn, "rb") as f:
+      return pickle.load(f)
+  except (OSError, EOFError, pickle.UnpicklingError):
+    pass
+
+  can_dbc = dbc(in_fn)
+
+  os.makedirs(cache_dir, exist_ok=True)
+  for fn in os.listdir(cache_dir):
+    if fn.startswith(dbc_name + ".") and fn != os.path.basename(cache_fn):
+      os.remove(os.path.join(cache_dir, fn))
+
+  tmp_fn = f"{cache_fn}.{os.getpid()}.tmp"
+  with open(tmp_fn, "wb") as f:
+    pickle.dump(can_dbc, f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp_fn, cache_fn)
+  return can_dbc
+
+
+def is_up_to_date(in_fn, out_fn):
+  """Generated files start with a digest of their inputs, skip regenerating if it matches"""
+  try:
+    with open(out_fn, "r") as f:
+      return f.readline().rstrip("\n") == DIGEST_HEADER + file_digest(in_fn, *GENERATOR_FNS)
+  except OSError:
+    return False
+
+
+def process(in_fn, out_fn, cache_dir=None):
   dbc_name = os.path.split(out_fn)[-1].replace('.cc', '')
   # print("processing %s: %s -> %s" % (dbc_name, in_fn, out_fn))
 
-  template_fn = os.path.join(os.path.dirname(__file__), "dbc_template.cc")
+  if cache_dir is None:
+    cache_dir = os.path.join(os.path.dirname(out_fn), CACHE_DIR_NAME)
 
-  with open(template_fn, "r") as template_f:
-    template = jinja2.Template(template_f.read(), trim_blocks=True, lstrip_blocks=True)
+  if is_up_to_date(in_fn, out_fn):
+    return False
 
-  can_dbc = dbc(in_fn)
+  template = get_template()
+  can_dbc = load_dbc(in_fn, cache_dir)
 
   # process counter and checksums first
   msgs = [(address, msg_name, msg_size, sorted(msg_sigs, key=lambda s: s.name not in ("COUNTER", "CHECKSUM")))
@@ -103,7 +166,8 @@ def process(in_fn, out_fn):
     if count > 1:
       sys.exit("%s: Duplicate message name in DBC file %s" % (dbc_name, name))
 
-  parser_code = template.render(dbc=can_dbc, checksum_type=checksum_type, msgs=msgs, def_vals=def_vals)
+  parser_code = DIGEST_HEADER + file_digest(in_fn, *GENERATOR_FNS) + "\n"
+  parser_code += template.render(dbc=can_dbc, checksum_type=checksum_type, msgs=msgs, def_vals=def_vals)
 
   with open(out_fn, "a+") as out_f:
     out_f.seek(0)
@@ -111,15 +175,44 @@ def process(in_fn, out_fn):
       out_f.seek(0)
       out_f.truncate()
       out_f.write(parser_code)
+  return True
+
+
+def _process(args):
+  return process(*args)
+
+
+def process_many(fns, jobs=None):
+  """Generate code for a list of (in_fn, out_fn) pairs. Only DBCs that changed are
+  processed, in parallel when there is more than one. Returns the regenerated out_fns."""
+  stale = [(in_fn, out_fn) for in_fn, out_fn in fns if not is_up_to_date(in_fn, out_fn)]
+  if len(stale) <= 1 or jobs == 1:
+    results = [process(in_fn, out_fn) for in_fn, out_fn in stale]
+  else:
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+      results = list(executor.map(_process, stale))
+  return [out_fn for (_, out_fn), regenerated in zip(stale, results) if regenerated]
+
+
+def process_all(dbc_dir, out_dir, jobs=None):
+  fns = [(os.path.join(dbc_dir, x), os.path.join(out_dir, x.replace(".dbc", ".cc")))
+         for x in sorted(os.listdir(dbc_dir)) if x.endswith(".dbc")]
+  return process_many(fns, jobs)
+
 
 def main():
   if len(sys.argv) != 3:
-    print("usage: %s dbc_directory output_filename" % (sys.argv[0],))
+    print("usage: %s dbc_directory output_filename|output_directory" % (sys.argv[0],))
     sys.exit(0)
 
   dbc_dir = sys.argv[1]
   out_fn = sys.argv[2]
 
+  if os.path.isdir(out_fn):
+    for fn in process_all(dbc_dir, out_fn):
+      print("generated %s" % fn)
+    return
+
   dbc_name = os.path.split(out_fn)[-1].replace('.cc', '')
   in_fn = os.path.join(dbc_dir, dbc_name + '.dbc')
 
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 import time
 import struct
+import asyncio
 from collections import deque
-from typing import Callable, NamedTuple, Tuple, List, Deque, Generator, Optional, cast
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, NamedTuple, Tuple, List, Deque, Dict, Generator, Optional, cast
 from enum import IntEnum
 from functools import partial
 
@@ -270,6 +272,47 @@ _negative_response_codes = {
     0x93: 'voltage too low',
 }
 
+def _parse_data_identifier_response(data_identifier_type: int, resp: bytes) -> bytes:
+  resp_id = struct.unpack('!H', resp[0:2])[0] if len(resp) >= 2 else None
+  if resp_id != data_identifier_type:
+    raise ValueError('invalid response data identifier: {} expected: {}'.format(hex(resp_id), hex(data_identifier_type)))
+  return resp[2:]
+
+def _read_dtc_information_data(dtc_report_type: DTC_REPORT_TYPE, dtc_status_mask_type: DTC_STATUS_MASK_TYPE = DTC_STATUS_MASK_TYPE.ALL,
+                                dtc_severity_mask_type: DTC_SEVERITY_MASK_TYPE = DTC_SEVERITY_MASK_TYPE.ALL, dtc_mask_record: int = 0xFFFFFF,
+                                dtc_snapshot_record_num: int = 0xFF, dtc_extended_record_num: int = 0xFF) -> bytes:
+  data = b''
+  # dtc_status_mask_type
+  if dtc_report_type == DTC_REPORT_TYPE.NUMBER_OF_DTC_BY_STATUS_MASK or \
+     dtc_report_type == DTC_REPORT_TYPE.DTC_BY_STATUS_MASK or \
+     dtc_report_type == DTC_REPORT_TYPE.MIRROR_MEMORY_DTC_BY_STATUS_MASK or \
+     dtc_report_type == DTC_REPORT_TYPE.NUMBER_OF_MIRROR_MEMORY_DTC_BY_STATUS_MASK or \
+     dtc_report_type == DTC_REPORT_TYPE.NUMBER_OF_EMISSIONS_RELATED_OBD_DTC_BY_STATUS_MASK or \
+     dtc_report_type == DTC_REPORT_TYPE.EMISSIONS_RELATED_OBD_DTC_BY_STATUS_MASK:
+     data += bytes([dtc_status_mask_type])
+  # dtc_mask_record
+  if dtc_report_type == DTC_REPORT_TYPE.DTC_SNAPSHOT_IDENTIFICATION or \
+     dtc_report_type == DTC_REPORT_TYPE.DTC_SNAPSHOT_RECORD_BY_DTC_NUMBER or \
+     dtc_report_type == DTC_REPORT_TYPE.DTC_EXTENDED_DATA_RECORD_BY_DTC_NUMBER or \
+     dtc_report_type == DTC_REPORT_TYPE.MIRROR_MEMORY_DTC_EXTENDED_DATA_RECORD_BY_DTC_NUMBER or \
+     dtc_report_type == DTC_REPORT_TYPE.SEVERITY_INFORMATION_OF_DTC:
+     data += struct.pack('!I', dtc_mask_record)[1:]  # 3 bytes
+  # dtc_snapshot_record_num
+  if dtc_report_type == DTC_REPORT_TYPE.DTC_SNAPSHOT_IDENTIFICATION or \
+     dtc_report_type == DTC_REPORT_TYPE.DTC_SNAPSHOT_RECORD_BY_DTC_NUMBER or \
+     dtc_report_type == DTC_REPORT_TYPE.DTC_SNAPSHOT_RECORD_BY_RECORD_NUMBER:
+     data += bytes([dtc_snapshot_record_num])
+  # dtc_extended_record_num
+  if dtc_report_type == DTC_REPORT_TYPE.DTC_EXTENDED_DATA_RECORD_BY_DTC_NUMBER or \
+     dtc_report_type == DTC_REPORT_TYPE.MIRROR_MEMORY_DTC_EXTENDED_DATA_RECORD_BY_DTC_NUMBER:
+     data += bytes([dtc_extended_record_num])
+  # dtc_severity_mask_type
+  if dtc_report_type == DTC_REPORT_TYPE.NUMBER_OF_DTC_BY_SEVERITY_MASK_RECORD or \
+     dtc_report_type == DTC_REPORT_TYPE.DTC_BY_SEVERITY_MASK_RECORD:
+     data += bytes([dtc_severity_mask_type, dtc_status_mask_type])
+
+  return data
+
 def get_dtc_num_as_str(dtc_num_bytes):
   # ISO 15031-6
   designator = {
@@ -511,6 +554,50 @@ class IsoTpMessage():
 
 FUNCTIONAL_ADDRS = [0x7DF, 0x18DB33F1]
 
+def _uds_build_request(service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None) -> bytes:
+  req = bytes([service_type])
+  if subfunction is not None:
+    req += bytes([subfunction])
+  if data is not None:
+    req += data
+  return req
+
+def _uds_parse_response(service_type: SERVICE_TYPE, subfunction: Optional[int], resp: bytes) -> Optional[bytes]:
+  """Validate a response and strip the service id and sub-function id.
+  Returns None if the ECU asked to wait for another message (response pending)."""
+  resp_sid = resp[0] if len(resp) > 0 else None
+
+  # negative response
+  if resp_sid == 0x7F:
+    service_id = resp[1] if len(resp) > 1 else -1
+    try:
+      service_desc = SERVICE_TYPE(service_id).name
+    except BaseException:
+      service_desc = 'NON_STANDARD_SERVICE'
+    error_code = resp[2] if len(resp) > 2 else -1
+    try:
+      error_desc = _negative_response_codes[error_code]
+    except BaseException:
+      error_desc = resp[3:].hex()
+    # wait for another message if response pending
+    if error_code == 0x78:
+      return None
+    raise NegativeResponseError('{} - {}'.format(service_desc, error_desc), service_id, error_code)
+
+  # positive response
+  if service_type + 0x40 != resp_sid:
+    resp_sid_hex = hex(resp_sid) if resp_sid is not None else None
+    raise InvalidServiceIdError('invalid response service id: {}'.format(resp_sid_hex))
+
+  if subfunction is not None:
+    resp_sfn = resp[1] if len(resp) > 1 else None
+    if subfunction != resp_sfn:
+      resp_sfn_hex = hex(resp_sfn) if resp_sfn is not None else None
+      raise InvalidSubFunctioneError(f'invalid response subfunction: {resp_sfn_hex:x}')
+
+  # return data (exclude service id and sub-function id)
+  return resp[(1 if subfunction is None else 2):]
+
 def get_rx_addr_for_tx_addr(tx_addr, rx_offset=0x8):
   if tx_addr in FUNCTIONAL_ADDRS:
     return None
@@ -541,11 +628,7 @@ class UdsClient():
 
   # generic uds request
   def _uds_request(self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None) -> bytes:
-    req = bytes([service_type])
-    if subfunction is not None:
-      req += bytes([subfunction])
-    if data is not None:
-      req += data
+    req = _uds_build_request(service_type, subfunction, data)
 
     # send request, wait for response
     isotp_msg = IsoTpMessage(self._can_client, self.timeout, self.debug)
@@ -558,42 +641,13 @@ class UdsClient():
       if resp is None:
         continue
 
-      response_pending = False
-      resp_sid = resp[0] if len(resp) > 0 else None
-
-      # negative response
-      if resp_sid == 0x7F:
-        service_id = resp[1] if len(resp) > 1 else -1
-        try:
-          service_desc = SERVICE_TYPE(service_id).name
-        except BaseException:
-          service_desc = 'NON_STANDARD_SERVICE'
-        error_code = resp[2] if len(resp) > 2 else -1
-        try:
-          error_desc = _negative_response_codes[error_code]
-        except BaseException:
-          error_desc = resp[3:].hex()
-        # wait for another message if response pending
-        if error_code == 0x78:
-          response_pending = True
-          if self.debug:
-            print("UDS-RX: response pending")
-          continue
-        raise NegativeResponseError('{} - {}'.format(service_desc, error_desc), service_id, error_code)
-
-      # positive response
-      if service_type + 0x40 != resp_sid:
-        resp_sid_hex = hex(resp_sid) if resp_sid is not None else None
-        raise InvalidServiceIdError('invalid response service id: {}'.format(resp_sid_hex))
-
-      if subfunction is not None:
-        resp_sfn = resp[1] if len(resp) > 1 else None
-        if subfunction != resp_sfn:
-          resp_sfn_hex = hex(resp_sfn) if resp_sfn is not None else None
-          raise InvalidSubFunctioneError(f'invalid response subfunction: {resp_sfn_hex:x}')
-
-      # return data (exclude service id and sub-function id)
-      return resp[(1 if subfunction is None else 2):]
+      dat = _uds_parse_response(service_type, subfunction, resp)
+      response_pending = dat is None
+      if response_pending:
+        if self.debug:
+          print("UDS-RX: response pending")
+        continue
+      return dat
 
   # services
   def diagnostic_session_control(self, session_type: SESSION_TYPE):
@@ -687,10 +741,7 @@ class UdsClient():
     # TODO: support list of identifiers
     data = struct.pack('!H', data_identifier_type)
     resp = self._uds_request(SERVICE_TYPE.READ_DATA_BY_IDENTIFIER, subfunction=None, data=data)
-    resp_id = struct.unpack('!H', resp[0:2])[0] if len(resp) >= 2 else None
-    if resp_id != data_identifier_type:
-      raise ValueError('invalid response data identifier: {} expected: {}'.format(hex(resp_id), hex(data_identifier_type)))
-    return resp[2:]
+    return _parse_data_identifier_response(data_identifier_type, resp)
 
   def read_memory_by_address(self, memory_address: int, memory_size: int, memory_address_bytes: int = 4, memory_size_bytes: int = 1):
     if memory_address_bytes < 1 or memory_address_bytes > 4:
@@ -779,36 +830,8 @@ class UdsClient():
   def read_dtc_information(self, dtc_report_type: DTC_REPORT_TYPE, dtc_status_mask_type: DTC_STATUS_MASK_TYPE = DTC_STATUS_MASK_TYPE.ALL,
                            dtc_severity_mask_type: DTC_SEVERITY_MASK_TYPE = DTC_SEVERITY_MASK_TYPE.ALL, dtc_mask_record: int = 0xFFFFFF,
                            dtc_snapshot_record_num: int = 0xFF, dtc_extended_record_num: int = 0xFF):
-    data = b''
-    # dtc_status_mask_type
-    if dtc_report_type == DTC_REPORT_TYPE.NUMBER_OF_DTC_BY_STATUS_MASK or \
-       dtc_report_type == DTC_REPORT_TYPE.DTC_BY_STATUS_MASK or \
-       dtc_report_type == DTC_REPORT_TYPE.MIRROR_MEMORY_DTC_BY_STATUS_MASK or \
-       dtc_report_type == DTC_REPORT_TYPE.NUMBER_OF_MIRROR_MEMORY_DTC_BY_STATUS_MASK or \
-       dtc_report_type == DTC_REPORT_TYPE.NUMBER_OF_EMISSIONS_RELATED_OBD_DTC_BY_STATUS_MASK or \
-       dtc_report_type == DTC_REPORT_TYPE.EMISSIONS_RELATED_OBD_DTC_BY_STATUS_MASK:
-       data += bytes([dtc_status_mask_type])
-    # dtc_mask_record
-    if dtc_report_type == DTC_REPORT_TYPE.DTC_SNAPSHOT_IDENTIFICATION or \
-       dtc_report_type == DTC_REPORT_TYPE.DTC_SNAPSHOT_RECORD_BY_DTC_NUMBER or \
-       dtc_report_type == DTC_REPORT_TYPE.DTC_EXTENDED_DATA_RECORD_BY_DTC_NUMBER or \
-       dtc_report_type == DTC_REPORT_TYPE.MIRROR_MEMORY_DTC_EXTENDED_DATA_RECORD_BY_DTC_NUMBER or \
-       dtc_report_type == DTC_REPORT_TYPE.SEVERITY_INFORMATION_OF_DTC:
-       data += struct.pack('!I', dtc_mask_record)[1:]  # 3 bytes
-    # dtc_snapshot_record_num
-    if dtc_report_type == DTC_REPORT_TYPE.DTC_SNAPSHOT_IDENTIFICATION or \
-       dtc_report_type == DTC_REPORT_TYPE.DTC_SNAPSHOT_RECORD_BY_DTC_NUMBER or \
-       dtc_report_type == DTC_REPORT_TYPE.DTC_SNAPSHOT_RECORD_BY_RECORD_NUMBER:
-       data += bytes([dtc_snapshot_record_num])
-    # dtc_extended_record_num
-    if dtc_report_type == DTC_REPORT_TYPE.DTC_EXTENDED_DATA_RECORD_BY_DTC_NUMBER or \
-       dtc_report_type == DTC_REPORT_TYPE.MIRROR_MEMORY_DTC_EXTENDED_DATA_RECORD_BY_DTC_NUMBER:
-       data += bytes([dtc_extended_record_num])
-    # dtc_severity_mask_type
-    if dtc_report_type == DTC_REPORT_TYPE.NUMBER_OF_DTC_BY_SEVERITY_MASK_RECORD or \
-       dtc_report_type == DTC_REPORT_TYPE.DTC_BY_SEVERITY_MASK_RECORD:
-       data += bytes([dtc_severity_mask_type, dtc_status_mask_type])
-
+    data = _read_dtc_information_data(dtc_report_type, dtc_status_mask_type, dtc_severity_mask_type, dtc_mask_record,
+                                      dtc_snapshot_record_num, dtc_extended_record_num)
     resp = self._uds_request(SERVICE_TYPE.READ_DTC_INFORMATION, subfunction=dtc_report_type, data=data)
 
     # TODO: parse response
@@ -891,3 +914,175 @@ class UdsClient():
 
   def request_transfer_exit(self):
     self._uds_request(SERVICE_TYPE.REQUEST_TRANSFER_EXIT, subfunction=None)
+
+
+class AsyncCanDispatcher():
+  """Shares one panda between several AsyncUdsClients. A single reader task polls the panda and
+  hands received frames to the client listening on (bus, rx_addr), so requests to different ECUs
+  can be outstanding at the same time. The blocking panda.can_recv runs on a reader thread, not
+  on the event loop. Only physical addressing is supported.
+
+  async with AsyncCanDispatcher(panda) as can:
+    clients = [AsyncUdsClient(can, addr) for addr in addrs]
+    results = await asyncio.gather(*[c.read_data_by_identifiers(dids) for c in clients])
+  """
+  def __init__(self, panda, tx_timeout: float = 1, poll_interval: float = 0.001, debug: bool = False):
+    self.panda = panda
+    self.tx_timeout = tx_timeout
+    self.poll_interval = poll_interval
+    self.debug = debug
+    self._listeners = {}  # type: Dict[Tuple[int, int], Tuple[List[Tuple[int, int, bytes, int]], asyncio.Event]]
+    self._reader = None  # type: Optional[asyncio.Task]
+    self._executor = None  # type: Optional[ThreadPoolExecutor]
+
+  def can_send(self, addr: int, dat: bytes, bus: int) -> None:
+    self.panda.can_send(addr, dat, bus, timeout=int(self.tx_timeout*1000))
+
+  def register(self, bus: int, rx_addr: int) -> Tuple[List[Tuple[int, int, bytes, int]], asyncio.Event]:
+    if (bus, rx_addr) in self._listeners:
+      raise ValueError(f"rx addr {hex(rx_addr)} on bus {bus} already in use")
+    listener = ([], asyncio.Event())  # type: Tuple[List[Tuple[int, int, bytes, int]], asyncio.Event]
+    self._listeners[(bus, rx_addr)] = listener
+    return listener
+
+  def unregister(self, bus: int, rx_addr: int) -> None:
+    self._listeners.pop((bus, rx_addr), None)
+
+  async def _read(self) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+      msgs = await loop.run_in_executor(self._executor, self.panda.can_recv)
+      for msg in msgs:
+        listener = self._listeners.get((msg[3], msg[0]))
+        if listener is not None and len(msg[2]) > 0:
+          listener[0].append(msg)
+          listener[1].set()
+      # only sleep when the panda had nothing for us
+      if not msgs:
+        await asyncio.sleep(self.poll_interval)
+
+  def start(self) -> None:
+    if self._reader is None:
+      self._executor = ThreadPoolExecutor(1, thread_name_prefix="can_recv")
+      self._reader = asyncio.get_running_loop().create_task(self._read())
+
+  async def stop(self) -> None:
+    if self._reader is not None:
+      self._reader.cancel()
+      try:
+        await self._reader
+      except asyncio.CancelledError:
+        pass
+      self._reader = None
+      # a can_recv still in progress finishes before the panda is handed back
+      await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+      self._executor = None
+
+  async def __aenter__(self) -> 'AsyncCanDispatcher':
+    self.start()
+    return self
+
+  async def __aexit__(self, *args) -> None:
+    await self.stop()
+
+class AsyncUdsClient():
+  """asyncio version of UdsClient. Requests to one ECU are sent one after another, waiting for a
+  response (including response pending) only suspends this client, not the other ECUs."""
+  def __init__(self, dispatcher: AsyncCanDispatcher, tx_addr: int, rx_addr: int = None, bus: int = 0, timeout: float = 1,
+               debug: bool = False, response_pending_timeout: float = 10):
+    self.bus = bus
+    self.tx_addr = tx_addr
+    self.rx_addr = rx_addr if rx_addr is not None else get_rx_addr_for_tx_addr(tx_addr)
+    if self.rx_addr is None:
+      raise ValueError("functional addressing is not supported by AsyncUdsClient")
+    self.timeout = timeout
+    self.debug = debug
+    self.response_pending_timeout = response_pending_timeout
+    self._dispatcher = dispatcher
+    self._rx_frames, self._rx_event = dispatcher.register(self.bus, self.rx_addr)
+    self._can_client = CanClient(dispatcher.can_send, self._can_recv, self.tx_addr, self.rx_addr, self.bus, debug=self.debug)
+    self._lock = asyncio.Lock()
+
+  def close(self) -> None:
+    self._dispatcher.unregister(self.bus, self.rx_addr)
+
+  def _can_recv(self) -> List[Tuple[int, int, bytes, int]]:
+    msgs = self._rx_frames[:]
+    self._rx_frames.clear()
+    self._rx_event.clear()
+    return msgs
+
+  async def _isotp_recv(self, isotp_msg: IsoTpMessage, timeout: float) -> bytes:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+      resp = isotp_msg.recv(timeout=0)
+      if resp is not None:
+        return resp
+
+      remaining = deadline - loop.time()
+      if remaining <= 0:
+        raise MessageTimeoutError("timeout waiting for response")
+      try:
+        await asyncio.wait_for(self._rx_event.wait(), remaining)
+      except asyncio.TimeoutError:
+        raise MessageTimeoutError("timeout waiting for response")
+      # any frame restarts the timeout, same as IsoTpMessage.recv
+      deadline = loop.time() + timeout
+
+  # generic uds request
+  async def _uds_request(self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None) -> bytes:
+    req = _uds_build_request(service_type, subfunction, data)
+
+    async with self._lock:
+      # send request, wait for response
+      isotp_msg = IsoTpMessage(self._can_client, 0, self.debug)
+      isotp_msg.send(req)
+      response_pending = False
+      while True:
+        timeout = self.response_pending_timeout if response_pending else self.timeout
+        resp = await self._isotp_recv(isotp_msg, timeout)
+
+        dat = _uds_parse_response(service_type, subfunction, resp)
+        response_pending = dat is None
+        if response_pending:
+          if self.debug:
+            print("UDS-RX: response pending")
+          continue
+        return dat
+
+  # services
+  async def diagnostic_session_control(self, session_type: SESSION_TYPE):
+    await self._uds_request(SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, subfunction=session_type)
+
+  async def tester_present(self, ):
+    await self._uds_request(SERVICE_TYPE.TESTER_PRESENT, subfunction=0x00)
+
+  async def read_data_by_identifier(self, data_identifier_type: DATA_IDENTIFIER_TYPE):
+    data = struct.pack('!H', data_identifier_type)
+    resp = await self._uds_request(SERVICE_TYPE.READ_DATA_BY_IDENTIFIER, subfunction=None, data=data)
+    return _parse_data_identifier_response(data_identifier_type, resp)
+
+  async def read_data_by_identifiers(self, data_identifier_types: List[int]) -> Dict[int, bytes]:
+    # requests go out back to back, identifiers the ECU rejects are left out of the result
+    results = {}
+    for data_identifier_type in data_identifier_types:
+      try:
+        results[data_identifier_type] = await self.read_data_by_identifier(data_identifier_type)
+      except NegativeResponseError:
+        pass
+    return results
+
+  async def clear_diagnostic_information(self, dtc_group_type: DTC_GROUP_TYPE):
+    data = struct.pack('!I', dtc_group_type)[1:]  # 3 bytes
+    await self._uds_request(SERVICE_TYPE.CLEAR_DIAGNOSTIC_INFORMATION, subfunction=None, data=data)
+
+  async def read_dtc_information(self, dtc_report_type: DTC_REPORT_TYPE, dtc_status_mask_type: DTC_STATUS_MASK_TYPE = DTC_STATUS_MASK_TYPE.ALL,
+                                 dtc_severity_mask_type: DTC_SEVERITY_MASK_TYPE = DTC_SEVERITY_MASK_TYPE.ALL, dtc_mask_record: int = 0xFFFFFF,
+                                 dtc_snapshot_record_num: int = 0xFF, dtc_extended_record_num: int = 0xFF):
+    data = _read_dtc_information_data(dtc_report_type, dtc_status_mask_type, dtc_severity_mask_type, dtc_mask_record,
+                                      dtc_snapshot_record_num, dtc_extended_record_num)
+    resp = await self._uds_request(SERVICE_TYPE.READ_DTC_INFORMATION, subfunction=dtc_report_type, data=data)
+
+    # TODO: parse response
+    return resp
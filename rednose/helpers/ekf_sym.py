@@ -1,6 +1,5 @@
 import os
 import logging
-from bisect import bisect_right
 
 import numpy as np
 import sympy as sp
@@ -10,6 +9,9 @@ from rednose.helpers.sympy_helpers import sympy_into_c
 from rednose.helpers import TEMPLATE_DIR, load_code
 from rednose.helpers.chi2_lookup import chi2_ppf
 
+# number of checkpoints kept for rewinding
+REWIND_TO_KEEP = 512
+
 
 def solve(a, b):
   if a.shape[0] == 1 and a.shape[1] == 1:
@@ -245,11 +247,12 @@ class EKF_sym():
     # process noise
     self.Q = Q
 
-    # rewind stuff
+    # rewind stuff, checkpoints are kept in ring buffers starting at rewind_start
     self.max_rewind_age = max_rewind_age
-    self.rewind_t = []
-    self.rewind_states = []
-    self.rewind_obscache = []
+    self.rewind_t = np.zeros(REWIND_TO_KEEP)
+    self.rewind_x = np.zeros((REWIND_TO_KEEP, self.dim_x, 1))
+    self.rewind_P = np.zeros((REWIND_TO_KEEP, self.dim_err, self.dim_err))
+    self.rewind_obscache = [None] * REWIND_TO_KEEP
     self.init_state(x_initial, P_initial, None)
 
     ffi, lib = load_code(folder, name, "kf")
@@ -350,14 +353,16 @@ class EKF_sym():
     self.P = np.array(covs).astype(np.float64)
     self.filter_time = filter_time
     self.augment_times = [0] * self.N
-    self.rewind_obscache = []
-    self.rewind_t = []
-    self.rewind_states = []
+    self.reset_rewind()
 
   def reset_rewind(self):
-    self.rewind_obscache = []
-    self.rewind_t = []
-    self.rewind_states = []
+    self.rewind_obscache[:] = [None] * REWIND_TO_KEEP
+    self.rewind_start = 0
+    self.rewind_len = 0
+
+  def rewind_idx(self, i):
+    # ring buffer index of the i-th oldest checkpoint
+    return (self.rewind_start + i) % REWIND_TO_KEEP
 
   def augment(self):
     # TODO this is not a generalized way of doing this and implies that the augmented states
@@ -413,38 +418,41 @@ class EKF_sym():
     self.set_globals[global_var](val)
 
   def rewind(self, t):
-    # find where we are rewinding to
-    idx = bisect_right(self.rewind_t, t)
-    assert self.rewind_t[idx - 1] <= t
-    assert self.rewind_t[idx] > t    # must be true, or rewind wouldn't be called
+    # find where we are rewinding to, the checkpoint times are sorted in the two halves of the ring
+    end = self.rewind_start + self.rewind_len
+    idx = int(np.searchsorted(self.rewind_t[self.rewind_start:min(end, REWIND_TO_KEEP)], t, side='right'))
+    if idx == REWIND_TO_KEEP - self.rewind_start:
+      idx += int(np.searchsorted(self.rewind_t[:end - REWIND_TO_KEEP], t, side='right'))
+    assert 0 < idx < self.rewind_len    # must be true, or rewind wouldn't be called
 
     # set the state to the time right before that
-    self.filter_time = self.rewind_t[idx - 1]
-    self.x[:] = self.rewind_states[idx - 1][0]
-    self.P[:] = self.rewind_states[idx - 1][1]
-
-    # return the observations we rewound over for fast forwarding
-    ret = self.rewind_obscache[idx:]
-
-    # throw away the old future
-    # TODO: is this making a copy?
-    self.rewind_t = self.rewind_t[:idx]
-    self.rewind_states = self.rewind_states[:idx]
-    self.rewind_obscache = self.rewind_obscache[:idx]
+    i = self.rewind_idx(idx - 1)
+    self.filter_time = float(self.rewind_t[i])
+    self.x[:] = self.rewind_x[i]
+    self.P[:] = self.rewind_P[i]
+
+    # return the observations we rewound over for fast forwarding, and throw away the old future
+    ret = []
+    for j in range(idx, self.rewind_len):
+      i = self.rewind_idx(j)
+      ret.append(self.rewind_obscache[i])
+      self.rewind_obscache[i] = None
+    self.rewind_len = idx
 
     return ret
 
   def checkpoint(self, obs):
-    # push to rewinder
-    self.rewind_t.append(self.filter_time)
-    self.rewind_states.append((np.copy(self.x), np.copy(self.P)))
-    self.rewind_obscache.append(obs)
-
-    # only keep a certain number around
-    REWIND_TO_KEEP = 512
-    self.rewind_t = self.rewind_t[-REWIND_TO_KEEP:]
-    self.rewind_states = self.rewind_states[-REWIND_TO_KEEP:]
-    self.rewind_obscache = self.rewind_obscache[-REWIND_TO_KEEP:]
+    # push to rewinder, overwriting the oldest checkpoint once full
+    if self.rewind_len == REWIND_TO_KEEP:
+      i = self.rewind_start
+      self.rewind_start = self.rewind_idx(1)
+    else:
+      i = self.rewind_idx(self.rewind_len)
+      self.rewind_len += 1
+    self.rewind_t[i] = self.filter_time
+    self.rewind_x[i] = self.x
+    self.rewind_P[i] = self.P
+    self.rewind_obscache[i] = obs
 
   def predict(self, t):
     # initialize time
@@ -463,7 +471,8 @@ class EKF_sym():
 
     # rewind
     if self.filter_time is not None and t < self.filter_time:
-      if len(self.rewind_t) == 0 or t < self.rewind_t[0] or t < self.rewind_t[-1] - self.max_rewind_age:
+      if self.rewind_len == 0 or t < self.rewind_t[self.rewind_start] or \
+         t < self.rewind_t[self.rewind_idx(self.rewind_len - 1)] - self.max_rewind_age:
         self.logger.error("observation too old at %.3f with filter at %.3f, ignoring" % (t, self.filter_time))
         return None
       rewound = self.rewind(t)
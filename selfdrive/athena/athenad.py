@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import asyncio
 import base64
 import hashlib
 import io
@@ -13,10 +14,12 @@ import sys
 import tempfile
 import threading
 import time
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from functools import partial
-from typing import Any, Dict
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
 
 import requests
 from jsonrpc import JSONRPCResponseManager, dispatcher
@@ -28,11 +31,13 @@ from cereal import log
 from cereal.services import service_list
 from common.api import Api
 from common.basedir import PERSIST
-from common.file_helpers import CallbackReader
-from common.params import Params
+from common.params import Params, put_nonblocking
 from common.realtime import sec_since_boot
 from selfdrive.hardware import HARDWARE, PC, TICI
 from selfdrive.loggerd.config import ROOT
+from selfdrive.loggerd.recompress import ensure_recompressed, lower_priority, source_path
+from selfdrive.loggerd.upload_engine import (BANDWIDTH_LIMIT_PARAM, METERED_CONCURRENCY, WIFI_CONCURRENCY,
+                                             get_upload_limiter, new_session, upload_file)
 from selfdrive.loggerd.xattr_cache import getxattr, setxattr
 from selfdrive.statsd import STATS_DIR
 from selfdrive.swaglog import SWAGLOG_DIR, cloudlog
@@ -50,95 +55,221 @@ RETRY_DELAY = 10  # seconds
 MAX_RETRY_COUNT = 30  # Try for at most 5 minutes if upload fails immediately
 MAX_AGE = 31 * 24 * 3600  # seconds
 WS_FRAME_SIZE = 4096
+PERSIST_DELAY = 1  # seconds, upload queue changes within this are saved together
+LOG_BATCH_FILES = 8  # swaglogs are up to 256 kB each
+LOG_MAX_INFLIGHT = 4
+LOG_RESPONSE_TIMEOUT = 100  # seconds
+LOG_RETRY_DELAY = 3600  # seconds
+STATS_ID_PREFIX = "stats:"
+STATS_BATCH_FILES = 16
+STATS_MAX_INFLIGHT = 2
+STATS_RESPONSE_TIMEOUT = 100  # seconds
+STATS_RETRY_DELAY = 60  # seconds
+STATS_SPOOL_SIZE = 16 * 1024 * 1024
 
 NetworkType = log.DeviceState.NetworkType
 
 dispatcher["echo"] = lambda s: s
-recv_queue: Any = queue.Queue()
-send_queue: Any = queue.Queue()
-upload_queue: Any = queue.Queue()
-low_priority_send_queue: Any = queue.Queue()
-log_recv_queue: Any = queue.Queue()
 cancelled_uploads: Any = set()
 UploadItem = namedtuple('UploadItem', ['path', 'url', 'headers', 'created_at', 'id', 'retry_count', 'current', 'progress', 'allow_cellular'], defaults=(0, False, 0, False))
 
 cur_upload_items: Dict[int, Any] = {}
+upload_session = new_session(WIFI_CONCURRENCY)
 
 class AbortTransferException(Exception):
   pass
 
 
-class UploadQueueCache():
-  params = Params()
+def _wake(fut):
+  if not fut.done():
+    fut.set_result(None)
+
+
+class AsyncQueue:
+  """FIFO queue any thread can put to and coroutines wait on.
+
+  Unlike asyncio.Queue it isn't tied to an event loop, so the queues outlive a connection's loop
+  and the jsonrpc worker threads can put to them directly."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.items: Deque[Any] = deque()
+    self.waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+  @property
+  def queue(self) -> List[Any]:
+    with self.lock:
+      return list(self.items)
+
+  def qsize(self) -> int:
+    return len(self.items)
+
+  def put_nowait(self, item) -> None:
+    with self.lock:
+      self.items.append(item)
+      waiters, self.waiters = self.waiters, []
+    for loop, fut in waiters:
+      if not fut.done():
+        loop.call_soon_threadsafe(_wake, fut)
+
+  def get_nowait(self):
+    with self.lock:
+      if not self.items:
+        raise queue.Empty
+      return self.items.popleft()
+
+  async def get(self):
+    while True:
+      try:
+        return self.get_nowait()
+      except queue.Empty:
+        await AsyncQueue.wait_any(self)
 
   @staticmethod
-  def initialize(upload_queue):
+  async def wait_any(*queues: "AsyncQueue") -> None:
+    """Wait until one of the queues has an item"""
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    for q in queues:
+      with q.lock:
+        if q.items:
+          return
+        q.waiters = [w for w in q.waiters if not w[1].done()] + [(loop, fut)]
+    await fut
+
+
+class UploadQueue(AsyncQueue):
+  """Pending uploads, persisted to the AthenadUploadQueue param.
+
+  Changes only mark the queue dirty, persist_handler writes it at most once every
+  PERSIST_DELAY seconds. Uploads in progress are saved with the queue, and params are
+  written to a temp file and renamed, so after a crash the queue is the last saved one."""
+  PARAM = "AthenadUploadQueue"
+
+  def __init__(self):
+    super().__init__()
+    self.dirty = False
+    self.changes = AsyncQueue()
+
+  def put_nowait(self, item) -> None:
+    super().put_nowait(item)
+    self.changed()
+
+  def changed(self) -> None:
+    if not self.dirty:
+      self.dirty = True
+      self.changes.put_nowait(None)
+
+  def load(self) -> None:
     try:
-      upload_queue_json = UploadQueueCache.params.get("AthenadUploadQueue")
+      upload_queue_json = Params().get(self.PARAM)
       if upload_queue_json is not None:
         for item in json.loads(upload_queue_json):
-          upload_queue.put(UploadItem(**item))
+          super().put_nowait(UploadItem(**item))
     except Exception:
-      cloudlog.exception("athena.UploadQueueCache.initialize.exception")
+      cloudlog.exception("athena.UploadQueue.load.exception")
 
-  @staticmethod
-  def cache(upload_queue):
+  def cache(self) -> None:
     try:
-      items = [i._asdict() for i in upload_queue.queue if i.id not in cancelled_uploads]
-      UploadQueueCache.params.put("AthenadUploadQueue", json.dumps(items))
+      current = [i._replace(current=False, progress=0) for i in list(cur_upload_items.values()) if i is not None]
+      items = [i._asdict() for i in current + self.queue if i.id not in cancelled_uploads]
+      Params().put(self.PARAM, json.dumps(items))
     except Exception:
-      cloudlog.exception("athena.UploadQueueCache.cache.exception")
+      cloudlog.exception("athena.UploadQueue.cache.exception")
 
-
-def handle_long_poll(ws):
+  async def persist_handler(self) -> None:
+    loop = asyncio.get_running_loop()
+    try:
+      while True:
+        await self.changes.get()
+        await asyncio.sleep(PERSIST_DELAY)
+        self.dirty = False
+        await loop.run_in_executor(None, self.cache)
+    finally:
+      if self.dirty:
+        self.dirty = False
+        self.cache()
+
+
+recv_queue = AsyncQueue()
+send_queue = AsyncQueue()
+low_priority_send_queue = AsyncQueue()
+log_recv_queue = AsyncQueue()
+stats_recv_queue = AsyncQueue()
+upload_queue = UploadQueue()
+
+
+async def handle_long_poll(ws):
+  """Serve one websocket connection until it fails.
+
+  Everything runs as tasks on the event loop. The blocking websocket and http calls run on
+  small thread pools: one thread each for receiving and sending frames, HANDLER_THREADS for
+  jsonrpc methods and one per upload worker."""
+  loop = asyncio.get_running_loop()
   end_event = threading.Event()
+  dispatcher["startLocalProxy"] = partial(startLocalProxy, end_event)
+
+  ws_executor = ThreadPoolExecutor(2, thread_name_prefix='athena_ws')
+  rpc_executor = ThreadPoolExecutor(HANDLER_THREADS, thread_name_prefix='athena_rpc')
+  uploads = UploadWorkers(end_event)
 
-  threads = [
-    threading.Thread(target=ws_recv, args=(ws, end_event), name='ws_recv'),
-    threading.Thread(target=ws_send, args=(ws, end_event), name='ws_send'),
-    threading.Thread(target=upload_handler, args=(end_event,), name='upload_handler'),
-    threading.Thread(target=log_handler, args=(end_event,), name='log_handler'),
-    threading.Thread(target=stat_handler, args=(end_event,), name='stat_handler'),
+  ws_tasks = [
+    loop.create_task(ws_recv(ws, ws_executor)),
+    loop.create_task(ws_send(ws, ws_executor)),
+  ]
+  tasks = ws_tasks + [
+    loop.create_task(log_handler()),
+    loop.create_task(stat_handler()),
+    loop.create_task(upload_queue.persist_handler()),
+  ] + [
+    loop.create_task(jsonrpc_handler(rpc_executor)) for _ in range(HANDLER_THREADS)
   ] + [
-    threading.Thread(target=jsonrpc_handler, args=(end_event,), name=f'worker_{x}')
-    for x in range(HANDLER_THREADS)
+    loop.create_task(uploads.worker(x)) for x in range(uploads.size)
   ]
 
-  for thread in threads:
-    thread.start()
   try:
-    while not end_event.is_set():
-      time.sleep(0.1)
-  except (KeyboardInterrupt, SystemExit):
-    end_event.set()
-    raise
+    await asyncio.wait(ws_tasks, return_when=asyncio.FIRST_COMPLETED)
   finally:
-    for thread in threads:
-      cloudlog.debug(f"athena.joining {thread.name}")
-      thread.join()
+    end_event.set()
+    try:
+      ws.abort()
+    except Exception:
+      pass
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
+    # interrupted uploads go back in the queue, their transfers abort on end_event
+    for item in cur_upload_items.values():
+      if item is not None:
+        upload_queue.put_nowait(item._replace(current=False, progress=0))
+    cur_upload_items.clear()
 
-def jsonrpc_handler(end_event):
-  dispatcher["startLocalProxy"] = partial(startLocalProxy, end_event)
-  while not end_event.is_set():
+    for executor in (ws_executor, rpc_executor, uploads.executor):
+      executor.shutdown(wait=False)
+
+
+async def jsonrpc_handler(executor):
+  loop = asyncio.get_running_loop()
+  while True:
+    data = await recv_queue.get()
     try:
-      data = recv_queue.get(timeout=1)
       if "method" in data:
         cloudlog.debug(f"athena.jsonrpc_handler.call_method {data}")
-        response = JSONRPCResponseManager.handle(data, dispatcher)
+        response = await loop.run_in_executor(executor, JSONRPCResponseManager.handle, data, dispatcher)
         send_queue.put_nowait(response.json)
       elif "id" in data and ("result" in data or "error" in data):
-        log_recv_queue.put_nowait(data)
+        if str(json.loads(data)["id"]).startswith(STATS_ID_PREFIX):
+          stats_recv_queue.put_nowait(data)
+        else:
+          log_recv_queue.put_nowait(data)
       else:
         raise Exception("not a valid request or response")
-    except queue.Empty:
-      pass
     except Exception as e:
       cloudlog.exception("athena jsonrpc handler failed")
       send_queue.put_nowait(json.dumps({"error": str(e)}))
 
 
-def retry_upload(tid: int, end_event: threading.Event, increase_count: bool = True) -> None:
+async def retry_upload(tid: int, increase_count: bool = True) -> None:
   if cur_upload_items[tid].retry_count < MAX_RETRY_COUNT:
     item = cur_upload_items[tid]
     new_retry_count = item.retry_count + 1 if increase_count else item.retry_count
@@ -149,94 +280,124 @@ def retry_upload(tid: int, end_event: threading.Event, increase_count: bool = Tr
       current=False
     )
     upload_queue.put_nowait(item)
-    UploadQueueCache.cache(upload_queue)
 
     cur_upload_items[tid] = None
-
-    for _ in range(RETRY_DELAY):
-      time.sleep(1)
-      if end_event.is_set():
-        break
-
-
-def upload_handler(end_event: threading.Event) -> None:
-  sm = messaging.SubMaster(['deviceState'])
-  tid = threading.get_ident()
-
-  while not end_event.is_set():
-    cur_upload_items[tid] = None
-
-    try:
-      cur_upload_items[tid] = upload_queue.get(timeout=1)._replace(current=True)
-
-      if cur_upload_items[tid].id in cancelled_uploads:
-        cancelled_uploads.remove(cur_upload_items[tid].id)
-        continue
-
-      # Remove item if too old
-      age = datetime.now() - datetime.fromtimestamp(cur_upload_items[tid].created_at / 1000)
-      if age.total_seconds() > MAX_AGE:
-        cloudlog.event("athena.upload_handler.expired", item=cur_upload_items[tid], error=True)
-        continue
-
-      # Check if uploading over metered connection is allowed
-      sm.update(0)
-      metered = sm['deviceState'].networkMetered
-      network_type = sm['deviceState'].networkType.raw
-      if metered and (not cur_upload_items[tid].allow_cellular):
-        retry_upload(tid, end_event, False)
-        continue
-
+    await asyncio.sleep(RETRY_DELAY)
+
+
+class UploadWorkers:
+  """Pool of upload worker tasks, each running its transfers on a thread of the pool.
+
+  Up to WIFI_CONCURRENCY files are uploaded at a time on wifi and ethernet, and
+  METERED_CONCURRENCY on other networks."""
+  def __init__(self, end_event: threading.Event, size: int = WIFI_CONCURRENCY):
+    self.end_event = end_event
+    self.size = size
+    self.executor = ThreadPoolExecutor(size, thread_name_prefix='athena_upload')
+    self.sm = messaging.SubMaster(['deviceState'])
+    self.sm_lock = threading.Lock()
+    self.slots = asyncio.Condition()
+    self.active = 0
+    self.recompress_pool: Optional[ProcessPoolExecutor] = None
+
+  def network(self) -> Tuple[bool, int]:
+    # also called from the transfer threads
+    with self.sm_lock:
+      self.sm.update(0)
+      return self.sm['deviceState'].networkMetered, self.sm['deviceState'].networkType.raw
+
+  def concurrency(self) -> int:
+    metered, network_type = self.network()
+    unmetered = not metered and network_type in (NetworkType.wifi, NetworkType.ethernet)
+    return min(self.size, WIFI_CONCURRENCY if unmetered else METERED_CONCURRENCY)
+
+  async def worker(self, tid: int) -> None:
+    while True:
+      cur_upload_items[tid] = None
+      item = await upload_queue.get()
+      cur_upload_items[tid] = item
+
+      async with self.slots:
+        await self.slots.wait_for(lambda: self.active < self.concurrency())
+        self.active += 1
       try:
-        def cb(sz, cur):
-          # Abort transfer if connection changed to metered after starting upload
-          sm.update(0)
-          metered = sm['deviceState'].networkMetered
-          if metered and (not cur_upload_items[tid].allow_cellular):
-            raise AbortTransferException
-
-          cur_upload_items[tid] = cur_upload_items[tid]._replace(progress=cur / sz if sz else 1)
-
-        fn = cur_upload_items[tid].path
-        try:
-          sz = os.path.getsize(fn)
-        except OSError:
-          sz = -1
-
-        cloudlog.event("athena.upload_handler.upload_start", fn=fn, sz=sz, network_type=network_type, metered=metered, retry_count=cur_upload_items[tid].retry_count)
-        response = _do_upload(cur_upload_items[tid], cb)
-
-        if response.status_code not in (200, 201, 401, 403, 412):
-          cloudlog.event("athena.upload_handler.retry", status_code=response.status_code, fn=fn, sz=sz, network_type=network_type, metered=metered)
-          retry_upload(tid, end_event)
-        else:
-          cloudlog.event("athena.upload_handler.success", fn=fn, sz=sz, network_type=network_type, metered=metered)
-
-        UploadQueueCache.cache(upload_queue)
-      except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.SSLError):
-        cloudlog.event("athena.upload_handler.timeout", fn=fn, sz=sz, network_type=network_type, metered=metered)
-        retry_upload(tid, end_event)
-      except AbortTransferException:
-        cloudlog.event("athena.upload_handler.abort", fn=fn, sz=sz, network_type=network_type, metered=metered)
-        retry_upload(tid, end_event, False)
-
-    except queue.Empty:
-      pass
-    except Exception:
-      cloudlog.exception("athena.upload_handler.exception")
+        cur_upload_items[tid] = item._replace(current=True)
+        await self.upload(tid)
+      except Exception:
+        cloudlog.exception("athena.upload_handler.exception")
+      finally:
+        upload_queue.changed()
+        async with self.slots:
+          self.active -= 1
+          self.slots.notify_all()
+
+  async def upload(self, tid: int) -> None:
+    item = cur_upload_items[tid]
+    if item.id in cancelled_uploads:
+      cancelled_uploads.remove(item.id)
+      return
+
+    # Remove item if too old
+    age = datetime.now() - datetime.fromtimestamp(item.created_at / 1000)
+    if age.total_seconds() > MAX_AGE:
+      cloudlog.event("athena.upload_handler.expired", item=item, error=True)
+      return
+
+    # Check if uploading over metered connection is allowed
+    metered, network_type = self.network()
+    if metered and (not item.allow_cellular):
+      await retry_upload(tid, False)
+      return
+
+    def cb(sz, cur):
+      # Abort transfer if connection changed to metered after starting upload
+      metered, _ = self.network()
+      if self.end_event.is_set() or (metered and (not cur_upload_items[tid].allow_cellular)):
+        raise AbortTransferException
+
+      cur_upload_items[tid] = cur_upload_items[tid]._replace(progress=cur / sz if sz else 1)
+
+    fn = item.path
+    src = source_path(fn)
+    if src is not None and not os.path.exists(fn):
+      # the server asked for the xz copy of a log, made once on idle CPU
+      if self.recompress_pool is None:
+        self.recompress_pool = ProcessPoolExecutor(1, initializer=lower_priority)
+      try:
+        await asyncio.get_running_loop().run_in_executor(self.recompress_pool, ensure_recompressed, src)
+      except BrokenProcessPool:
+        cloudlog.exception("athena.upload_handler.recompress_pool_died")
+        self.recompress_pool = None
+        await retry_upload(tid)
+        return
 
+    try:
+      sz = os.path.getsize(fn)
+    except OSError:
+      sz = -1
 
-def _do_upload(upload_item, callback=None):
-  with open(upload_item.path, "rb") as f:
-    size = os.fstat(f.fileno()).st_size
+    try:
+      cloudlog.event("athena.upload_handler.upload_start", fn=fn, sz=sz, network_type=network_type, metered=metered, retry_count=item.retry_count)
+      limited = network_type not in (NetworkType.wifi, NetworkType.ethernet)
+      loop = asyncio.get_running_loop()
+      response = await loop.run_in_executor(self.executor, _do_upload, item, cb, limited)
+
+      if response.status_code not in (200, 201, 401, 403, 412):
+        cloudlog.event("athena.upload_handler.retry", status_code=response.status_code, fn=fn, sz=sz, network_type=network_type, metered=metered)
+        await retry_upload(tid)
+      else:
+        cloudlog.event("athena.upload_handler.success", fn=fn, sz=sz, network_type=network_type, metered=metered)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.SSLError):
+      cloudlog.event("athena.upload_handler.timeout", fn=fn, sz=sz, network_type=network_type, metered=metered)
+      await retry_upload(tid)
+    except AbortTransferException:
+      cloudlog.event("athena.upload_handler.abort", fn=fn, sz=sz, network_type=network_type, metered=metered)
+      await retry_upload(tid, False)
 
-    if callback:
-      f = CallbackReader(f, callback, size)
 
-    return requests.put(upload_item.url,
-                        data=f,
-                        headers={**upload_item.headers, 'Content-Length': str(size)},
-                        timeout=30)
+def _do_upload(upload_item, callback=None, limited=False):
+  return upload_file(upload_session, upload_item.url, upload_item.headers, upload_item.path,
+                     get_upload_limiter() if limited else None, callback, timeout=30)
 
 
 # security: user should be able to request any message from their car
@@ -336,7 +497,8 @@ def uploadFilesToUrls(files_data):
       failed.append(fn)
       continue
     path = os.path.join(ROOT, fn)
-    if not os.path.exists(path):
+    src = source_path(path)
+    if not os.path.exists(path) and (src is None or not os.path.exists(src)):
       failed.append(fn)
       continue
 
@@ -353,8 +515,6 @@ def uploadFilesToUrls(files_data):
     upload_queue.put_nowait(item)
     items.append(item._asdict())
 
-  UploadQueueCache.cache(upload_queue)
-
   resp = {"enqueued": len(items), "items": items}
   if failed:
     resp["failed"] = failed
@@ -364,7 +524,7 @@ def uploadFilesToUrls(files_data):
 
 @dispatcher.add_method
 def listUploadQueue():
-  items = list(upload_queue.queue) + list(cur_upload_items.values())
+  items = upload_queue.queue + list(cur_upload_items.values())
   return [i._asdict() for i in items if (i is not None) and (i.id not in cancelled_uploads)]
 
 
@@ -373,12 +533,13 @@ def cancelUpload(upload_id):
   if not isinstance(upload_id, list):
     upload_id = [upload_id]
 
-  uploading_ids = {item.id for item in list(upload_queue.queue)}
+  uploading_ids = {item.id for item in upload_queue.queue}
   cancelled_ids = uploading_ids.intersection(upload_id)
   if len(cancelled_ids) == 0:
     return 404
 
   cancelled_uploads.update(cancelled_ids)
+  upload_queue.changed()
   return {"success": 1}
 
 
@@ -389,8 +550,12 @@ def primeActivated(activated):
 
 @dispatcher.add_method
 def setBandwithLimit(upload_speed_kbps, download_speed_kbps):
+  # uploads from uploader and athenad shape themselves to this on cellular
+  Params().put(BANDWIDTH_LIMIT_PARAM, str(int(upload_speed_kbps)))
+
   if not TICI:
-    return {"success": 0, "error": "only supported on comma three"}
+    # no traffic shaping, only the uploads follow the limit
+    return {"success": 1}
 
   try:
     HARDWARE.set_bandwidth_limit(upload_speed_kbps, download_speed_kbps)
@@ -485,109 +650,347 @@ def takeSnapshot():
     raise Exception("not available while camerad is started")
 
 
-def get_logs_to_send_sorted():
-  # TODO: scan once then use inotify to detect file creation/deletion
+class FileIndex:
+  """Files in a directory that still need to be forwarded to athena.
+
+  The directory is listed once, after that inotify keeps the index current. Files of a batch
+  that failed or wasn't acknowledged are sent again after retry_delay seconds."""
+  retry_delay = 0.
+
+  def __init__(self, path: str):
+    from common.inotify import Inotify, IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO
+    self.path = path
+    self.unsent: Set[str] = set()
+    self.retry: Dict[str, float] = {}  # name -> sec_since_boot it may be sent again
+    self.inotify = Inotify()
+    self.inotify.add_watch(path, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+    self.scan()
+
+  def fileno(self) -> int:
+    return self.inotify.fileno()
+
+  def scan(self) -> None:
+    self.unsent.clear()
+    self.retry.clear()
+    for name in os.listdir(self.path):
+      self.added(name)
+
+  def added(self, name: str) -> None:
+    self.unsent.add(name)
+
+  def removed(self, name: str) -> None:
+    self.unsent.discard(name)
+    self.retry.pop(name, None)
+
+  def update(self) -> None:
+    """Apply the pending inotify events"""
+    from common.inotify import IN_CREATE, IN_MOVED_TO, IN_Q_OVERFLOW
+    for e in self.inotify.read(timeout=0):
+      if e.mask & IN_Q_OVERFLOW:
+        self.scan()
+      elif e.mask & (IN_CREATE | IN_MOVED_TO):
+        self.added(e.name)
+      else:
+        self.removed(e.name)
+
+  def ready(self) -> List[str]:
+    """Unsent files in the order they're sent"""
+    return sorted(self.unsent)
+
+  def take(self, n: int) -> List[str]:
+    names = self.ready()[:n]
+    self.unsent.difference_update(names)
+    return names
+
+  def sent(self, names: List[str]) -> None:
+    # also when the response came after the batch timed out
+    for name in names:
+      self.retry.pop(name, None)
+      self.unsent.discard(name)
+
+  def failed(self, names: List[str]) -> None:
+    retry_time = sec_since_boot() + self.retry_delay
+    self.retry.update((name, retry_time) for name in names)
+
+  def next_retry(self) -> Optional[float]:
+    now = sec_since_boot()
+    due = [name for name, t in self.retry.items() if t <= now]
+    for name in due:
+      del self.retry[name]
+    self.unsent.update(name for name in due if os.path.exists(os.path.join(self.path, name)))
+    return min(self.retry.values(), default=None)
+
+  def close(self) -> None:
+    self.inotify.close()
+
+
+class SwaglogIndex(FileIndex):
+  """Swaglogs that still need to be forwarded, newest first.
+
+  The newest file is still being written, it's sent once a newer one is created. Sent files
+  are marked with an xattr, with the time until they're acknowledged."""
+  retry_delay = LOG_RETRY_DELAY
+
+  def __init__(self, path: str):
+    self.newest = ""
+    super().__init__(path)
+
+  def scan(self) -> None:
+    curr_time = int(time.time())
+    self.unsent.clear()
+    self.retry.clear()
+    for log_entry in os.listdir(self.path):
+      self.newest = max(self.newest, log_entry)
+      log_path = os.path.join(self.path, log_entry)
+      try:
+        time_sent = int.from_bytes(getxattr(log_path, LOG_ATTR_NAME), sys.byteorder)
+      except (ValueError, TypeError):
+        time_sent = 0
+      # assume send failed and we lost the response if sent more than one hour ago
+      if not time_sent or curr_time - time_sent > LOG_RETRY_DELAY:
+        self.unsent.add(log_entry)
+
+  def added(self, name: str) -> None:
+    self.unsent.add(name)
+    self.newest = max(self.newest, name)
+
+  def ready(self) -> List[str]:
+    return sorted(self.unsent - {self.newest}, reverse=True)
+
+
+class StatsIndex(FileIndex):
+  """Stats files written by statsd, oldest first. They're deleted once athena has stored them,
+  and the oldest are dropped when the spool grows past STATS_SPOOL_SIZE."""
+  retry_delay = STATS_RETRY_DELAY
+
+  def __init__(self, path: str):
+    self.sizes: Dict[str, int] = {}
+    self.total = 0
+    os.makedirs(path, exist_ok=True)
+    super().__init__(path)
+
+  def scan(self) -> None:
+    self.sizes.clear()
+    self.total = 0
+    super().scan()
+
+  def added(self, name: str) -> None:
+    # statsd writes a temp file and renames it
+    if name.startswith(tempfile.gettempprefix()):
+      return
+    try:
+      size = os.path.getsize(os.path.join(self.path, name))
+    except OSError:
+      return
+    self.removed(name)
+    self.sizes[name] = size
+    self.total += size
+    self.unsent.add(name)
+    if self.total > STATS_SPOOL_SIZE:
+      self.limit()
+
+  def removed(self, name: str) -> None:
+    super().removed(name)
+    self.total -= self.sizes.pop(name, 0)
+
+  def limit(self) -> None:
+    # files in flight aren't dropped, they're deleted once stored
+    dropped = 0
+    for name in sorted(self.unsent | self.retry.keys()):
+      if self.total <= STATS_SPOOL_SIZE:
+        break
+      self.removed(name)
+      dropped += 1
+      try:
+        os.remove(os.path.join(self.path, name))
+      except OSError:
+        pass
+    cloudlog.event("athena.stat_handler.spool_full", dropped=dropped, size=self.total)
+
+
+swaglog_index: Optional[SwaglogIndex] = None
+stats_index: Optional[StatsIndex] = None
+
+
+def read_batch(path: str, names: List[str]) -> Tuple[List[str], str]:
+  """Names of the files that could be read and their contents, each ending in a newline"""
+  read, contents = [], []
+  for name in names:
+    try:
+      with open(os.path.join(path, name)) as f:
+        dat = f.read()
+    except OSError:
+      continue  # file could be deleted by log rotation
+    read.append(name)
+    contents.append(dat if dat.endswith("\n") or not dat else dat + "\n")
+  return read, "".join(contents)
+
+
+def forward_logs(names: List[str]) -> Optional[str]:
+  """Queue one forwardLogs request with the files' contents, returns its id"""
+  cloudlog.debug(f"athena.log_handler.forward_request {names}")
   curr_time = int(time.time())
-  logs = []
-  for log_entry in os.listdir(SWAGLOG_DIR):
-    log_path = os.path.join(SWAGLOG_DIR, log_entry)
+  for log_entry in names:
     try:
-      time_sent = int.from_bytes(getxattr(log_path, LOG_ATTR_NAME), sys.byteorder)
-    except (ValueError, TypeError):
-      time_sent = 0
-    # assume send failed and we lost the response if sent more than one hour ago
-    if not time_sent or curr_time - time_sent > 3600:
-      logs.append(log_entry)
-  # excluding most recent (active) log file
-  return sorted(logs)[:-1]
+      setxattr(os.path.join(SWAGLOG_DIR, log_entry), LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
+    except OSError:
+      pass
+  sent, logs = read_batch(SWAGLOG_DIR, names)
+  if not sent:
+    return None
+
+  # the id lists the files, so a late response still marks them as sent
+  batch_id = ",".join(sent)
+  jsonrpc = {
+    "method": "forwardLogs",
+    "params": {
+      "logs": logs
+    },
+    "jsonrpc": "2.0",
+    "id": batch_id
+  }
+  low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
+  return batch_id
+
+
+def handle_log_response(log_resp) -> Tuple[Optional[str], List[str], bool]:
+  batch_id = log_resp.get("id")
+  log_success = "result" in log_resp and log_resp["result"].get("success")
+  cloudlog.debug(f"athena.log_handler.forward_response {batch_id} {log_success}")
+  names = batch_id.split(",") if batch_id else []
+  if log_success:
+    for log_entry in names:
+      log_path = os.path.join(SWAGLOG_DIR, log_entry)
+      try:
+        setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
+      except OSError:
+        pass  # file could be deleted by log rotation
+  return batch_id, names, bool(log_success)
+
+
+def forward_stats(names: List[str]) -> Optional[str]:
+  """Queue one storeStats request with the files' contents, returns its id"""
+  sent, stats = read_batch(STATS_DIR, names)
+  if not sent:
+    return None
+
+  batch_id = STATS_ID_PREFIX + ",".join(sent)
+  jsonrpc = {
+    "method": "storeStats",
+    "params": {
+      "stats": stats
+    },
+    "jsonrpc": "2.0",
+    "id": batch_id
+  }
+  low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
+  return batch_id
+
+
+def handle_stats_response(stats_resp) -> Tuple[Optional[str], List[str], bool]:
+  batch_id = stats_resp.get("id")
+  success = "result" in stats_resp and "error" not in stats_resp
+  names = batch_id[len(STATS_ID_PREFIX):].split(",") if batch_id else []
+  if success:
+    for name in names:
+      try:
+        os.remove(os.path.join(STATS_DIR, name))
+      except OSError:
+        pass
+  return batch_id, names, success
+
+
+async def forward_files(index: FileIndex, recv_queue: AsyncQueue, forward, handle_response,
+                        batch_files: int, max_inflight: int, response_timeout: float) -> None:
+  """Send the index' files in batches of up to batch_files, with up to max_inflight batches
+  waiting for their response at a time.
+
+  forward(names) queues a batch and returns its id, handle_response(resp) returns the id,
+  the files and whether it succeeded."""
+  loop = asyncio.get_running_loop()
+  changed = AsyncQueue()
+
+  def on_inotify():
+    index.update()
+    changed.put_nowait(None)
+
+  loop.add_reader(index.fileno(), on_inotify)
+  inflight: Dict[str, Tuple[List[str], float]] = {}  # batch id -> files, response deadline
+  try:
+    while True:
+      try:
+        now = sec_since_boot()
+        for batch_id, (names, deadline) in list(inflight.items()):
+          if deadline <= now:
+            del inflight[batch_id]
+            index.failed(names)
+        next_retry = index.next_retry()
+
+        while len(inflight) < max_inflight:
+          names = index.take(batch_files)
+          if not names:
+            break
+          batch_id = await loop.run_in_executor(None, forward, names)
+          if batch_id is not None:
+            inflight[batch_id] = (names, sec_since_boot() + response_timeout)
+
+        # wait for a response, new files, or the next deadline
+        deadlines = [d for _, d in inflight.values()] + ([next_retry] if next_retry is not None else [])
+        timeout = max(min(deadlines) - sec_since_boot(), 0) if deadlines else None
+        try:
+          await asyncio.wait_for(AsyncQueue.wait_any(recv_queue, changed), timeout)
+        except asyncio.TimeoutError:
+          pass
+
+        while changed.qsize():
+          changed.get_nowait()
+        while recv_queue.qsize():
+          batch_id, names, success = handle_response(json.loads(recv_queue.get_nowait()))
+          if batch_id is None:
+            continue
+          if success:
+            index.sent(names)
+          if inflight.pop(batch_id, None) is not None and not success:
+            index.failed(names)
+
+      except asyncio.CancelledError:
+        raise
+      except Exception:
+        cloudlog.exception("athena.forward_files.exception")
+  finally:
+    loop.remove_reader(index.fileno())
+    # batches without a response are sent again on the next connection
+    for names, _ in inflight.values():
+      index.unsent.update(names)
 
 
-def log_handler(end_event):
+async def log_handler():
+  global swaglog_index
   if PC:
     return
 
-  log_files = []
-  last_scan = 0
-  while not end_event.is_set():
+  if swaglog_index is None:
     try:
-      curr_scan = sec_since_boot()
-      if curr_scan - last_scan > 10:
-        log_files = get_logs_to_send_sorted()
-        last_scan = curr_scan
-
-      # send one log
-      curr_log = None
-      if len(log_files) > 0:
-        log_entry = log_files.pop() # newest log file
-        cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
-        try:
-          curr_time = int(time.time())
-          log_path = os.path.join(SWAGLOG_DIR, log_entry)
-          setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
-          with open(log_path) as f:
-            jsonrpc = {
-              "method": "forwardLogs",
-              "params": {
-                "logs": f.read()
-              },
-              "jsonrpc": "2.0",
-              "id": log_entry
-            }
-            low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
-            curr_log = log_entry
-        except OSError:
-          pass  # file could be deleted by log rotation
-
-      # wait for response up to ~100 seconds
-      # always read queue at least once to process any old responses that arrive
-      for _ in range(100):
-        if end_event.is_set():
-          break
-        try:
-          log_resp = json.loads(log_recv_queue.get(timeout=1))
-          log_entry = log_resp.get("id")
-          log_success = "result" in log_resp and log_resp["result"].get("success")
-          cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
-          if log_entry and log_success:
-            log_path = os.path.join(SWAGLOG_DIR, log_entry)
-            try:
-              setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
-            except OSError:
-              pass  # file could be deleted by log rotation
-          if curr_log == log_entry:
-            break
-        except queue.Empty:
-          if curr_log is None:
-            break
-
+      swaglog_index = await asyncio.get_running_loop().run_in_executor(None, SwaglogIndex, SWAGLOG_DIR)
     except Exception:
       cloudlog.exception("athena.log_handler.exception")
+      return
 
+  await forward_files(swaglog_index, log_recv_queue, forward_logs, handle_log_response,
+                      LOG_BATCH_FILES, LOG_MAX_INFLIGHT, LOG_RESPONSE_TIMEOUT)
 
-def stat_handler(end_event):
-  while not end_event.is_set():
-    last_scan = 0
-    curr_scan = sec_since_boot()
+
+async def stat_handler():
+  global stats_index
+  if stats_index is None:
     try:
-      if curr_scan - last_scan > 10:
-        stat_filenames = list(filter(lambda name: not name.startswith(tempfile.gettempprefix()), os.listdir(STATS_DIR)))
-        if len(stat_filenames) > 0:
-          stat_path = os.path.join(STATS_DIR, stat_filenames[0])
-          with open(stat_path) as f:
-            jsonrpc = {
-              "method": "storeStats",
-              "params": {
-                "stats": f.read()
-              },
-              "jsonrpc": "2.0",
-              "id": stat_filenames[0]
-            }
-            low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
-          os.remove(stat_path)
-        last_scan = curr_scan
+      stats_index = await asyncio.get_running_loop().run_in_executor(None, StatsIndex, STATS_DIR)
     except Exception:
       cloudlog.exception("athena.stat_handler.exception")
-    time.sleep(0.1)
+      return
+
+  await forward_files(stats_index, stats_recv_queue, forward_stats, handle_stats_response,
+                      STATS_BATCH_FILES, STATS_MAX_INFLIGHT, STATS_RESPONSE_TIMEOUT)
 
 
 def ws_proxy_recv(ws, local_sock, ssock, end_event, global_end_event):
@@ -634,45 +1037,54 @@ def ws_proxy_send(ws, local_sock, signal_sock, end_event):
   cloudlog.debug("athena.ws_proxy_send done closing sockets")
 
 
-def ws_recv(ws, end_event):
+async def ws_recv(ws, executor):
+  loop = asyncio.get_running_loop()
   last_ping = int(sec_since_boot() * 1e9)
-  while not end_event.is_set():
+  while True:
     try:
-      opcode, data = ws.recv_data(control_frame=True)
+      opcode, data = await loop.run_in_executor(executor, partial(ws.recv_data, control_frame=True))
       if opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
         if opcode == ABNF.OPCODE_TEXT:
           data = data.decode("utf-8")
         recv_queue.put_nowait(data)
       elif opcode == ABNF.OPCODE_PING:
         last_ping = int(sec_since_boot() * 1e9)
-        Params().put("LastAthenaPingTime", str(last_ping))
+        put_nonblocking("LastAthenaPingTime", str(last_ping))
     except WebSocketTimeoutException:
       ns_since_last_ping = int(sec_since_boot() * 1e9) - last_ping
       if ns_since_last_ping > RECONNECT_TIMEOUT_S * 1e9:
         cloudlog.exception("athenad.ws_recv.timeout")
-        end_event.set()
+        return
     except Exception:
       cloudlog.exception("athenad.ws_recv.exception")
-      end_event.set()
+      return
 
 
-def ws_send(ws, end_event):
-  while not end_event.is_set():
+def send_frames(ws, data):
+  for i in range(0, len(data), WS_FRAME_SIZE):
+    frame = data[i:i+WS_FRAME_SIZE]
+    last = i + WS_FRAME_SIZE >= len(data)
+    opcode = ABNF.OPCODE_TEXT if i == 0 else ABNF.OPCODE_CONT
+    ws.send_frame(ABNF.create_frame(frame, opcode, last))
+
+
+async def ws_send(ws, executor):
+  loop = asyncio.get_running_loop()
+  while True:
     try:
+      data = send_queue.get_nowait()
+    except queue.Empty:
       try:
-        data = send_queue.get_nowait()
+        data = low_priority_send_queue.get_nowait()
       except queue.Empty:
-        data = low_priority_send_queue.get(timeout=1)
-      for i in range(0, len(data), WS_FRAME_SIZE):
-        frame = data[i:i+WS_FRAME_SIZE]
-        last = i + WS_FRAME_SIZE >= len(data)
-        opcode = ABNF.OPCODE_TEXT if i == 0 else ABNF.OPCODE_CONT
-        ws.send_frame(ABNF.create_frame(frame, opcode, last))
-    except queue.Empty:
-      pass
+        await AsyncQueue.wait_any(send_queue, low_priority_send_queue)
+        continue
+
+    try:
+      await loop.run_in_executor(executor, send_frames, ws, data)
     except Exception:
       cloudlog.exception("athenad.ws_send.exception")
-      end_event.set()
+      return
 
 
 def backoff(retries):
@@ -682,7 +1094,7 @@ def backoff(retries):
 def main():
   params = Params()
   dongle_id = params.get("DongleId", encoding='utf-8')
-  UploadQueueCache.initialize(upload_queue)
+  upload_queue.load()
 
   ws_uri = ATHENA_HOST + "/ws/v2/" + dongle_id
   api = Api(dongle_id)
@@ -699,10 +1111,9 @@ def main():
       params.delete("PrimeRedirected")
 
       conn_retries = 0
-      cur_upload_items.clear()
-
-      handle_long_poll(ws)
+      asyncio.run(handle_long_poll(ws))
     except (KeyboardInterrupt, SystemExit):
+      upload_queue.cache()
       break
     except (ConnectionError, TimeoutError, WebSocketException):
       conn_retries += 1
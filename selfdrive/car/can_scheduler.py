@@ -0,0 +1,86 @@
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+CAN_BITRATE = 500000
+WINDOW_FRAMES = 100  # all registered periods must divide this
+
+PRIORITY_CONTROL = 0
+PRIORITY_LOW = 1
+
+
+def can_frame_bits(length: int, extended: bool = False) -> int:
+  """Bits on the wire for a classic CAN frame, including worst case bit stuffing"""
+  overhead = 67 if extended else 47
+  stuffed = (overhead - 13 + 8 * length - 1) // 4
+  return overhead + 8 * length + stuffed
+
+
+class CanSendScheduler:
+  """Collects the CAN messages of one control frame and spreads periodic messages across frames.
+
+  Periodic messages are registered with their period in frames. Fixed messages keep the phase they
+  are given, the others get the phase that adds the least to the busiest frame they are sent on.
+  flush() returns everything added this frame as one list, control messages first, and keeps
+  track of how much of each bus the sent frames use."""
+  def __init__(self, dt: float, bitrate: int = CAN_BITRATE, report: Optional[Callable[[str, float], None]] = None):
+    self.dt = dt
+    self.bitrate = bitrate
+    self.report = report
+
+    self.schedule: Dict[str, Tuple[int, int]] = {}  # name -> (period, phase)
+    self.slot_load = [0] * WINDOW_FRAMES
+
+    self.frame = 0
+    self.msgs: List[Tuple[int, int, Tuple]] = []
+    self.window_bits: Dict[int, int] = defaultdict(int)
+    self.window_frames = 0
+    self.utilization: Dict[int, float] = {}
+
+  def register(self, name: str, period: int, phase: Optional[int] = None, align: int = 1, weight: int = 1) -> int:
+    assert WINDOW_FRAMES % period == 0, f"{name}: period {period} doesn't divide {WINDOW_FRAMES}"
+
+    if phase is None:
+      # phases are restricted to multiples of align, for messages sent alongside another periodic message
+      candidates = range(0, period, align)
+      phase = min(candidates, key=lambda p: (max(self.slot_load[p::period]), sum(self.slot_load[p::period]), p))
+
+    for f in range(phase, WINDOW_FRAMES, period):
+      self.slot_load[f] += weight
+    self.schedule[name] = (period, phase)
+    return phase
+
+  def due(self, name: str) -> bool:
+    period, phase = self.schedule[name]
+    return self.frame % period == phase
+
+  def add(self, msg: Tuple, priority: int = PRIORITY_CONTROL) -> None:
+    self.msgs.append((priority, len(self.msgs), msg))
+
+  def add_many(self, msgs: List[Tuple], priority: int = PRIORITY_CONTROL) -> None:
+    for msg in msgs:
+      self.add(msg, priority)
+
+  def flush(self) -> List[Tuple]:
+    """All messages for this frame in send order, advances to the next frame"""
+    self.msgs.sort()
+    ret = [m for _, _, m in self.msgs]
+    self.msgs = []
+
+    for addr, _, dat, bus in ret:
+      self.window_bits[bus] += can_frame_bits(len(dat), addr > 0x7FF)
+
+    self.frame += 1
+    self.window_frames += 1
+    if self.window_frames * self.dt >= 1.:
+      self.update_utilization()
+    return ret
+
+  def update_utilization(self) -> None:
+    seconds = self.window_frames * self.dt
+    self.utilization = {bus: bits / (self.bitrate * seconds) for bus, bits in self.window_bits.items()}
+    if self.report is not None:
+      for bus, util in self.utilization.items():
+        self.report(f"can_tx_utilization_bus{bus}", util)
+
+    self.window_bits = defaultdict(int)
+    self.window_frames = 0
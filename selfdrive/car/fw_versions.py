@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import struct
-import traceback
 from typing import Any, List
 from collections import defaultdict
 from dataclasses import dataclass
@@ -10,7 +9,7 @@ from tqdm import tqdm
 import panda.python.uds as uds
 from cereal import car
 from selfdrive.car.fingerprints import FW_VERSIONS, get_attr_from_cars
-from selfdrive.car.isotp_parallel_query import IsoTpParallelQuery
+from selfdrive.car.isotp_parallel_query import IsoTpQueryScheduler
 from selfdrive.swaglog import cloudlog
 
 Ecu = car.CarParams.Ecu
@@ -184,11 +183,6 @@ REQUESTS: List[Request] = [
 ]
 
 
-def chunks(l, n=128):
-  for i in range(0, len(l), n):
-    yield l[i:i + n]
-
-
 def build_fw_dict(fw_versions):
   fw_versions_dict = {}
   for fw in fw_versions:
@@ -322,19 +316,21 @@ def get_fw_versions(logcan, sendcan, extra=None, timeout=0.1, debug=False, progr
 
   addrs.insert(0, parallel_addrs)
 
+  # Queue every (request, address) combination and let the scheduler interleave them.
+  # Requests to the same ECU still go out one after another, in the order of REQUESTS
+  scheduler = IsoTpQueryScheduler(sendcan, logcan, debug=debug)
+  for i, addr in enumerate(addrs):
+    for r in REQUESTS:
+      brand_addrs = [(a, s) for (b, a, s) in addr if b in (r.brand, 'any')]
+      if brand_addrs:
+        t = 2 * timeout if i == 0 else timeout
+        scheduler.add_query(r.bus, brand_addrs, r.request, r.response, r.rx_offset, timeout=t)
+
+  # a job that fails only loses its own response, the scheduler logs it and carries on
   fw_versions = {}
-  for i, addr in enumerate(tqdm(addrs, disable=not progress)):
-    for addr_chunk in chunks(addr):
-      for r in REQUESTS:
-        try:
-          addrs = [(a, s) for (b, a, s) in addr_chunk if b in (r.brand, 'any')]
-
-          if addrs:
-            query = IsoTpParallelQuery(sendcan, logcan, r.bus, addrs, r.request, r.response, r.rx_offset, debug=debug)
-            t = 2 * timeout if i == 0 else timeout
-            fw_versions.update(query.get_data(t))
-        except Exception:
-          cloudlog.warning(f"FW query exception: {traceback.format_exc()}")
+  with tqdm(total=scheduler.num_jobs, disable=not progress) as pbar:
+    for query_results in scheduler.get_data(done_callback=pbar.update):
+      fw_versions.update(query_results)
 
   # Build capnp list to put into CarParams
   car_fw = []
@@ -4,6 +4,7 @@ from cereal import car
 from common.realtime import DT_CTRL
 from common.numpy_fast import clip, interp
 from selfdrive.car import apply_std_steer_torque_limits
+from selfdrive.car.can_scheduler import CanSendScheduler, PRIORITY_LOW
 from selfdrive.car.hyundai.hyundaican import create_lkas11, create_clu11, \
   create_scc11, create_scc12, create_scc13, create_scc14, \
   create_mdps12, create_lfahda_mfc, create_hda_mfc
@@ -11,9 +12,10 @@ from selfdrive.car.hyundai.scc_smoother import SccSmoother
 from selfdrive.car.hyundai.values import Buttons, CAR, FEATURES, CarControllerParams
 from opendbc.can.packer import CANPacker
 from common.conversions import Conversions as CV
-from common.params import Params
+from common.params import get_params_cache
 from selfdrive.controls.lib.longcontrol import LongCtrlState
 from selfdrive.road_speed_limiter import road_speed_limiter_get_active
+from selfdrive.statsd import statlog
 
 VisualAlert = car.CarControl.HUDControl.VisualAlert
 min_set_speed = 30 * CV.KPH_TO_MS
@@ -42,6 +44,14 @@ def process_hud_alert(enabled, fingerprint, hud_control):
   return sys_warning, sys_state, left_lane_warning, right_lane_warning
 
 
+# toggles that can be changed from the UI while driving
+RUNTIME_TOGGLES = {
+  'StockNaviDecelEnabled': 'stock_navi_decel_enabled',
+  'KeepSteeringTurnSignals': 'keep_steering_turn_signals',
+  'HapticFeedbackWhenSpeedCamera': 'haptic_feedback_speed_camera',
+}
+
+
 class CarController:
   def __init__(self, dbc_name, CP, VM):
     self.car_fingerprint = CP.carFingerprint
@@ -64,13 +74,14 @@ class CarController:
 
     self.turning_indicator_alert = False
 
-    param = Params()
+    param = get_params_cache()
 
     self.mad_mode_enabled = param.get_bool('MadModeEnabled')
     self.ldws_opt = param.get_bool('IsLdwsCar')
     self.stock_navi_decel_enabled = param.get_bool('StockNaviDecelEnabled')
     self.keep_steering_turn_signals = param.get_bool('KeepSteeringTurnSignals')
     self.haptic_feedback_speed_camera = param.get_bool('HapticFeedbackWhenSpeedCamera')
+    param.watch(RUNTIME_TOGGLES.keys(), self.on_toggle_changed)
 
     self.scc_smoother = SccSmoother()
     self.last_blinker_frame = 0
@@ -85,6 +96,16 @@ class CarController:
     self.steer_fault_max_angle = CP.steerFaultMaxAngle
     self.steer_fault_max_frames = CP.steerFaultMaxFrames
 
+    # LKAS11 and MDPS12 go out every frame, the rest is periodic
+    self.can_scheduler = CanSendScheduler(DT_CTRL, report=statlog.gauge)
+    self.can_scheduler.register("CLU11_MDPS", 2, phase=1)
+    self.can_scheduler.register("SCC", 2, phase=0, weight=3)  # SCC11, SCC12 and SCC14
+    self.can_scheduler.register("SCC13", 20, align=2)  # sent with the other SCC messages
+    self.can_scheduler.register("LFAHDA_MFC", 5)
+
+  def on_toggle_changed(self, key, value):
+    setattr(self, RUNTIME_TOGGLES[key], value == b"1")
+
   def update(self, CC, CS, controls):
     actuators = CC.actuators
     hud_control = CC.hudControl
@@ -165,7 +186,7 @@ class CarController:
                                      CS.lkas11, sys_warning, sys_state, CC.enabled, hud_control.leftLaneVisible, hud_control.rightLaneVisible,
                                      left_lane_warning, right_lane_warning, 1, self.ldws_opt, cut_steer_temp))
 
-    if self.frame % 2 and CS.mdps_bus: # send clu11 to mdps if it is not on bus 0
+    if self.can_scheduler.due("CLU11_MDPS") and CS.mdps_bus: # send clu11 to mdps if it is not on bus 0
       can_sends.append(create_clu11(self.packer, CS.mdps_bus, CS.clu11, Buttons.NONE, enabled_speed))
 
     if pcm_cancel_cmd and (self.longcontrol and not self.mad_mode_enabled):
@@ -177,21 +198,24 @@ class CarController:
     self.update_auto_resume(CC, CS, clu11_speed, can_sends)
     self.update_scc(CC, CS, actuators, controls, hud_control, can_sends)
 
+    self.can_scheduler.add_many(can_sends)
+
     # 20 Hz LFA MFA message
-    if self.frame % 5 == 0:
+    if self.can_scheduler.due("LFAHDA_MFC"):
       activated_hda = road_speed_limiter_get_active()
       # activated_hda: 0 - off, 1 - main road, 2 - highway
       if self.car_fingerprint in FEATURES["send_lfa_mfa"]:
-        can_sends.append(create_lfahda_mfc(self.packer, CC.enabled, activated_hda))
+        self.can_scheduler.add(create_lfahda_mfc(self.packer, CC.enabled, activated_hda), PRIORITY_LOW)
       elif CS.has_lfa_hda:
-        can_sends.append(create_hda_mfc(self.packer, activated_hda, CS, hud_control.leftLaneVisible, hud_control.rightLaneVisible))
+        self.can_scheduler.add(create_hda_mfc(self.packer, activated_hda, CS, hud_control.leftLaneVisible,
+                                              hud_control.rightLaneVisible), PRIORITY_LOW)
 
     new_actuators = actuators.copy()
     new_actuators.steer = apply_steer / self.params.STEER_MAX
     new_actuators.accel = self.accel
 
     self.frame += 1
-    return new_actuators, can_sends
+    return new_actuators, self.can_scheduler.flush()
 
   def update_auto_resume(self, CC, CS, clu11_speed, can_sends):
     # fix auto resume - by neokii
@@ -226,7 +250,7 @@ class CarController:
     # send scc to car if longcontrol enabled and SCC not on bus 0 or ont live
     if self.longcontrol and CS.cruiseState_enabled and (CS.scc_bus or not self.scc_live):
 
-      if self.frame % 2 == 0:
+      if self.can_scheduler.due("SCC"):
 
         set_speed = hud_control.setSpeed
         if not (min_set_speed < set_speed < 255 * CV.KPH_TO_MS):
@@ -272,8 +296,8 @@ class CarController:
         can_sends.append(create_scc11(self.packer, self.frame, CC.enabled, set_speed, hud_control.leadVisible, self.scc_live, CS.scc11,
                        self.scc_smoother.active_cam, stock_cam))
 
-        if self.frame % 20 == 0 and CS.has_scc13:
-          can_sends.append(create_scc13(self.packer, CS.scc13))
+        if self.can_scheduler.due("SCC13") and CS.has_scc13:
+          self.can_scheduler.add(create_scc13(self.packer, CS.scc13), PRIORITY_LOW)
 
         if CS.has_scc14:
           acc_standstill = stopping if CS.out.vEgo < 2. else False
@@ -1,33 +1,24 @@
 #!/usr/bin/env python3
-import math
+import numpy as np
 
 from cereal import car
-from opendbc.can.parser import CANParser
-from selfdrive.car.interfaces import RadarInterfaceBase
+from opendbc.can.parser import CANParser, SignalAccessor
+from selfdrive.car.interfaces import RadarInterfaceBase, RadarPoints
 from selfdrive.car.hyundai.values import DBC
 from common.params import Params
 
 RADAR_START_ADDR = 0x500
 RADAR_MSG_COUNT = 32
+RADAR_TRACK_SIGNALS = ["STATE", "AZIMUTH", "LONG_DIST", "REL_ACCEL", "REL_SPEED"]
+RADAR_TRACK_MSGS = [f"RADAR_TRACK_{addr:x}" for addr in range(RADAR_START_ADDR, RADAR_START_ADDR + RADAR_MSG_COUNT)]
+# one row of RADAR_TRACK_SIGNALS per track message
+RADAR_TRACK_SIGNAL_LIST = [(sig, msg) for msg in RADAR_TRACK_MSGS for sig in RADAR_TRACK_SIGNALS]
 
-def get_radar_can_parser(CP):
+def get_radar_can_parser(CP, new_radar=False):
 
-  if False: #Params().get_bool("NewRadarInterface"):
-
-    signals = []
-    checks = []
-
-    for addr in range(RADAR_START_ADDR, RADAR_START_ADDR + RADAR_MSG_COUNT):
-      msg = f"RADAR_TRACK_{addr:x}"
-      signals += [
-        ("STATE", msg),
-        ("AZIMUTH", msg),
-        ("LONG_DIST", msg),
-        ("REL_ACCEL", msg),
-        ("REL_SPEED", msg),
-      ]
-      checks += [(msg, 50)]
-    return CANParser('hyundai_kia_mando_front_radar', signals, checks, 1)
+  if new_radar:
+    checks = [(msg, 50) for msg in RADAR_TRACK_MSGS]
+    return CANParser('hyundai_kia_mando_front_radar', RADAR_TRACK_SIGNAL_LIST, checks, 1)
 
   else:
     signals = [
@@ -47,13 +38,19 @@ def get_radar_can_parser(CP):
 class RadarInterface(RadarInterfaceBase):
   def __init__(self, CP):
     super().__init__(CP)
-    self.new_radar = False #Params().get_bool("NewRadarInterface")
+    self.new_radar = Params().get_bool("NewRadarInterface")
     self.updated_messages = set()
     self.trigger_msg = 0x420 if not self.new_radar else RADAR_START_ADDR + RADAR_MSG_COUNT - 1
     self.track_id = 0
 
     self.radar_off_can = CP.radarOffCan
-    self.rcp = get_radar_can_parser(CP)
+    self.rcp = get_radar_can_parser(CP, self.new_radar)
+
+    if self.new_radar:
+      # all tracks are read in one call, in the order of the parser's signal list
+      self.track_signals = SignalAccessor(self.rcp, RADAR_TRACK_SIGNAL_LIST)
+      # trackId of each track message, -1 when it has no valid point
+      self.track_ids = np.full(RADAR_MSG_COUNT, -1, dtype=np.int64)
 
   def update(self, can_strings):
     if self.radar_off_can or (self.rcp is None):
@@ -70,6 +67,14 @@ class RadarInterface(RadarInterfaceBase):
 
     return rr
 
+  def _update_track_ids(self, valid):
+    new = valid & (self.track_ids < 0)
+    n_new = int(np.count_nonzero(new))
+    self.track_ids[new] = np.arange(self.track_id, self.track_id + n_new)
+    self.track_id += n_new
+    self.track_ids[~valid] = -1
+    return self.track_ids[valid]
+
   def _update(self, updated_messages):
     ret = car.RadarData.new_message()
     if self.rcp is None:
@@ -82,29 +87,23 @@ class RadarInterface(RadarInterfaceBase):
     ret.errors = errors
 
     if self.new_radar:
-
-      for addr in range(RADAR_START_ADDR, RADAR_START_ADDR + RADAR_MSG_COUNT):
-        msg = self.rcp.vl[f"RADAR_TRACK_{addr:x}"]
-
-        if addr not in self.pts:
-          self.pts[addr] = car.RadarData.RadarPoint.new_message()
-          self.pts[addr].trackId = self.track_id
-          self.track_id += 1
-
-        valid = msg['STATE'] in [3, 4]
-        if valid:
-          azimuth = math.radians(msg['AZIMUTH'])
-          self.pts[addr].measured = True
-          self.pts[addr].dRel = math.cos(azimuth) * msg['LONG_DIST']
-          self.pts[addr].yRel = 0.5 * -math.sin(azimuth) * msg['LONG_DIST']
-          self.pts[addr].vRel = msg['REL_SPEED']
-          self.pts[addr].aRel = msg['REL_ACCEL']
-          self.pts[addr].yvRel = float('nan')
-
-        else:
-          del self.pts[addr]
-
-      ret.points = list(self.pts.values())
+      tracks = np.array(self.track_signals.read(), dtype=np.float64).reshape(RADAR_MSG_COUNT, len(RADAR_TRACK_SIGNALS))
+      state, azimuth, long_dist, rel_accel, rel_speed = tracks.T
+
+      valid = (state == 3) | (state == 4)
+      track_ids = self._update_track_ids(valid)
+      azimuth = np.radians(azimuth[valid])
+      long_dist = long_dist[valid]
+
+      points = RadarPoints(track_ids,
+                           np.cos(azimuth) * long_dist,
+                           0.5 * -np.sin(azimuth) * long_dist,
+                           rel_speed[valid],
+                           rel_accel[valid],
+                           np.ones(len(track_ids), dtype=bool))
+
+      points.to_capnp(ret)
+      self.point_arrays = points
       return ret
 
     else:
@@ -8,7 +8,7 @@ from cereal import car
 from common.realtime import DT_CTRL
 from common.conversions import Conversions as CV
 from selfdrive.car.hyundai.values import Buttons
-from common.params import Params
+from common.params import get_params_cache
 from selfdrive.controls.lib.drive_helpers import V_CRUISE_MAX, V_CRUISE_MIN, V_CRUISE_DELTA_KM, V_CRUISE_DELTA_MI, CONTROL_N
 from selfdrive.controls.lib.longitudinal_mpc_lib.long_mpc import AUTO_TR_CRUISE_GAP
 
@@ -62,10 +62,12 @@ class SccSmoother:
 
   def __init__(self):
 
-    self.longcontrol = Params().get_bool('LongControlEnabled')
-    self.slow_on_curves = Params().get_bool('SccSmootherSlowOnCurves')
-    self.sync_set_speed_while_gas_pressed = Params().get_bool('SccSmootherSyncGasPressed')
-    self.is_metric = Params().get_bool('IsMetric')
+    params = get_params_cache()
+    self.longcontrol = params.get_bool('LongControlEnabled')
+    self.slow_on_curves = params.get_bool('SccSmootherSlowOnCurves')
+    self.sync_set_speed_while_gas_pressed = params.get_bool('SccSmootherSyncGasPressed')
+    self.is_metric = params.get_bool('IsMetric')
+    params.watch(['SccSmootherSlowOnCurves', 'SccSmootherSyncGasPressed'], self.on_toggle_changed)
 
     self.speed_conv_to_ms = CV.KPH_TO_MS if self.is_metric else CV.MPH_TO_MS
     self.speed_conv_to_clu = CV.MS_TO_KPH if self.is_metric else CV.MS_TO_MPH
@@ -95,6 +97,18 @@ class SccSmoother:
     self.curve_speed_ms = 0.
     self.stock_weight = 0.
 
+    # derived from lateralPlan and radarState, only recomputed when those update
+    self.curve_model_speed = None
+    self.lead_accel = None
+    self.inputs_valid = False
+
+  def on_toggle_changed(self, key, value):
+    if key == 'SccSmootherSlowOnCurves':
+      self.slow_on_curves = value == b"1"
+      self.inputs_valid = False
+    elif key == 'SccSmootherSyncGasPressed':
+      self.sync_set_speed_while_gas_pressed = value == b"1"
+
   def reset(self):
 
     self.wait_timer = 0
@@ -134,6 +148,8 @@ class SccSmoother:
     apply_limit_speed, road_limit_speed, left_dist, first_started, max_speed_log = \
       road_speed_limiter.get_max_speed(clu11_speed, self.is_metric)
 
+    self.update_inputs(sm, CS.out.vEgo)
+
     curv_limit = 0
     self.cal_curve_speed(sm, CS.out.vEgo, frame)
     if self.slow_on_curves and self.curve_speed_ms >= MIN_CURVE_SPEED:
@@ -157,11 +173,15 @@ class SccSmoother:
 
     max_speed_log = ""
 
+    # the limiter already returns a smooth slowdown profile for cameras
+    follow_profile = False
+
     if apply_limit_speed >= self.kph_to_clu(10):
 
       if first_started:
         self.max_speed_clu = clu11_speed
 
+      follow_profile = road_speed_limiter.profile_applied and apply_limit_speed <= max_speed_clu
       max_speed_clu = min(max_speed_clu, apply_limit_speed)
 
       if clu11_speed > apply_limit_speed:
@@ -185,14 +205,19 @@ class SccSmoother:
       if lead_speed < max_speed_clu:
         max_speed_clu = min(max_speed_clu, lead_speed)
 
+        follow_profile = False
+
         if not self.limited_lead:
           self.max_speed_clu = clu11_speed + 3.
           self.limited_lead = True
     else:
       self.limited_lead = False
 
-    self.update_max_speed(int(max_speed_clu + 0.5),
-                          curv_limit != 0 and curv_limit == int(max_speed_clu))
+    if follow_profile:
+      self.update_max_speed(max_speed_clu, False, follow_profile=True)
+    else:
+      self.update_max_speed(int(max_speed_clu + 0.5),
+                            curv_limit != 0 and curv_limit == int(max_speed_clu))
 
     return road_limit_speed, left_dist, max_speed_log
 
@@ -275,9 +300,21 @@ class SccSmoother:
 
     return None
 
-  def get_long_lead_speed(self, CS, clu11_speed, sm):
-
-    if self.longcontrol:
+  def update_inputs(self, sm, v_ego):
+    # the curve speed only matters with slow on curves, the lead speed only with long control
+    if self.slow_on_curves and (sm.updated['lateralPlan'] or not self.inputs_valid):
+      self.curve_model_speed = None
+      lateralPlan = sm['lateralPlan']
+      if len(lateralPlan.curvatures) == CONTROL_N:
+        curv = (lateralPlan.curvatures[-1] + lateralPlan.curvatures[-2]) / 2.
+        a_y_max = 2.975 - v_ego * 0.0375  # ~1.85 @ 75mph, ~2.6 @ 25mph
+        v_curvature = sqrt(a_y_max / max(abs(curv), 1e-4))
+        model_speed = v_curvature * 0.85 * ntune_scc_get("sccCurvatureFactor")
+        if not np.isnan(model_speed):
+          self.curve_model_speed = model_speed
+
+    if self.longcontrol and (sm.updated['radarState'] or not self.inputs_valid):
+      self.lead_accel = None
       lead = self.get_lead(sm)
       if lead is not None:
         d = lead.dRel - 5.
@@ -285,30 +322,24 @@ class SccSmoother:
           t = d / lead.vRel
           accel = -(lead.vRel / t) * self.speed_conv_to_clu
           accel *= 1.2
-
           if accel < 0.:
-            target_speed = clu11_speed + accel
-            target_speed = max(target_speed, self.min_set_speed_clu)
-            return target_speed
+            self.lead_accel = accel
 
-    return 0
+    self.inputs_valid = True
 
-  def cal_curve_speed(self, sm, v_ego, frame):
+  def get_long_lead_speed(self, CS, clu11_speed, sm):
 
-    lateralPlan = sm['lateralPlan']
-    if len(lateralPlan.curvatures) == CONTROL_N:
-      curv = (lateralPlan.curvatures[-1] + lateralPlan.curvatures[-2]) / 2.
-      a_y_max = 2.975 - v_ego * 0.0375  # ~1.85 @ 75mph, ~2.6 @ 25mph
-      v_curvature = sqrt(a_y_max / max(abs(curv), 1e-4))
-      model_speed = v_curvature * 0.85 * ntune_scc_get("sccCurvatureFactor")
+    if self.longcontrol and self.lead_accel is not None:
+      target_speed = clu11_speed + self.lead_accel
+      target_speed = max(target_speed, self.min_set_speed_clu)
+      return target_speed
 
-      if model_speed < v_ego:
-        self.curve_speed_ms = float(max(model_speed, MIN_CURVE_SPEED))
-      else:
-        self.curve_speed_ms = 255.
+    return 0
+
+  def cal_curve_speed(self, sm, v_ego, frame):
 
-      if np.isnan(self.curve_speed_ms):
-        self.curve_speed_ms = 255.
+    if self.curve_model_speed is not None and self.curve_model_speed < v_ego:
+      self.curve_speed_ms = float(max(self.curve_model_speed, MIN_CURVE_SPEED))
     else:
       self.curve_speed_ms = 255.
 
@@ -331,10 +362,12 @@ class SccSmoother:
           set_speed = clip(clu11_speed + SYNC_MARGIN, self.min_set_speed_clu, self.max_set_speed_clu)
           self.target_speed = set_speed
 
-  def update_max_speed(self, max_speed, limited_curv):
+  def update_max_speed(self, max_speed, limited_curv, follow_profile=False):
 
     if not self.longcontrol or self.max_speed_clu <= 0:
       self.max_speed_clu = max_speed
+    elif follow_profile and max_speed <= self.max_speed_clu:
+      self.max_speed_clu = max_speed
     else:
       kp = 0.01 #if limited_curv else 0.01
       error = max_speed - self.max_speed_clu
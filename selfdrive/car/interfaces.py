@@ -1,7 +1,9 @@
 import os
 import time
 from abc import abstractmethod, ABC
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, NamedTuple, Optional
+
+import numpy as np
 
 from cereal import car
 from common.kalman.simple_kalman import KF1D
@@ -184,9 +186,33 @@ class CarInterfaceBase(ABC):
     return events
 
 
+class RadarPoints(NamedTuple):
+  """Radar points as parallel arrays, one entry per point"""
+  trackId: np.ndarray
+  dRel: np.ndarray
+  yRel: np.ndarray
+  vRel: np.ndarray
+  aRel: np.ndarray
+  measured: np.ndarray
+
+  def to_capnp(self, ret):
+    pts = ret.init('points', len(self.trackId))
+    for pt, track_id, d_rel, y_rel, v_rel, a_rel, measured in zip(pts, self.trackId.tolist(), self.dRel.tolist(), self.yRel.tolist(),
+                                                                 self.vRel.tolist(), self.aRel.tolist(), self.measured.tolist()):
+      pt.trackId = track_id
+      pt.dRel = d_rel
+      pt.yRel = y_rel
+      pt.vRel = v_rel
+      pt.aRel = a_rel
+      pt.yvRel = float('nan')
+      pt.measured = measured
+
+
 class RadarInterfaceBase(ABC):
   def __init__(self, CP):
     self.pts = {}
+    # interfaces that decode into arrays set this along with the RadarData they return, radard reads it instead of the points list
+    self.point_arrays: Optional[RadarPoints] = None
     self.delay = 0
     self.radar_ts = CP.radarTimeStep
     self.no_radar_sleep = 'NO_RADAR_SLEEP' in os.environ
@@ -1,12 +1,83 @@
 import time
-from collections import defaultdict
+from collections import deque
 from functools import partial
 from typing import Optional
 
 import cereal.messaging as messaging
 from selfdrive.swaglog import cloudlog
 from selfdrive.boardd.boardd import can_list_to_can_capnp
-from panda.python.uds import CanClient, IsoTpMessage, FUNCTIONAL_ADDRS, get_rx_addr_for_tx_addr
+from panda.python.uds import CanClient, IsoTpMessage, get_rx_addr_for_tx_addr
+
+# Frames kept per (bus, addr, subaddr) between two polls, older frames are dropped
+RX_BUFFER_SIZE = 1024
+
+FUNCTIONAL_RX_ADDRS = {
+  0x7DF: range(0x7E8, 0x7F0),
+  0x18DB33F1: range(0x18DAF100, 0x18DAF200),
+}
+
+
+class IsoTpRxDemux:
+  """Sorts received CAN frames into a ring buffer per (bus, addr, subaddr).
+
+  Only registered addresses are kept. Every packet from the socket is still read with capnp, the
+  routing itself is a single dict lookup on (bus, addr) per frame and only the data of routed
+  frames is copied out. Subaddressed frames are filtered on their first byte when they arrive."""
+  def __init__(self, logcan, maxlen=RX_BUFFER_SIZE):
+    self.logcan = logcan
+    self.maxlen = maxlen
+    self.buffers = {}
+    self.routes = {}
+
+  def register(self, bus, addr, sub_addr=None, buffer_addr=None):
+    """Start buffering frames from addr. Frames can be stored under a different buffer_addr,
+    this is used to collect responses to functional requests from a range of addresses."""
+    key = (bus, addr if buffer_addr is None else buffer_addr, sub_addr)
+    if key not in self.buffers:
+      self.buffers[key] = deque(maxlen=self.maxlen)
+    self.routes.setdefault((bus, addr), {})[sub_addr] = self.buffers[key]
+
+  def unregister(self, bus, addr, sub_addr=None, buffer_addr=None):
+    subs = self.routes.get((bus, addr))
+    if subs is not None:
+      subs.pop(sub_addr, None)
+      if not subs:
+        del self.routes[(bus, addr)]
+    self.buffers.pop((bus, addr if buffer_addr is None else buffer_addr, sub_addr), None)
+
+  def rx(self, wait_for_one=True):
+    """Drain can socket and sort messages into buffers based on bus, address and subaddress"""
+    routes = self.routes
+    for dat in messaging.drain_sock_raw(self.logcan, wait_for_one=wait_for_one):
+      for msg in messaging.log_from_bytes(dat).can:
+        src, address = msg.src, msg.address
+        subs = routes.get((src, address))
+        if subs is None:
+          continue
+
+        msg_dat = msg.dat
+        buf = subs.get(None)
+        if buf is None:
+          if len(msg_dat) == 0:
+            continue
+          buf = subs.get(msg_dat[0])
+          if buf is None:
+            continue
+        buf.append((address, msg.busTime, msg_dat, src))
+
+  def pop(self, bus, addr, sub_addr=None):
+    """Return and clear all buffered frames"""
+    buf = self.buffers.get((bus, addr, sub_addr))
+    if not buf:
+      return []
+    msgs = list(buf)
+    buf.clear()
+    return msgs
+
+  def drain(self):
+    messaging.drain_sock_raw(self.logcan)
+    for buf in self.buffers.values():
+      buf.clear()
 
 
 class IsoTpParallelQuery:
@@ -27,21 +98,18 @@ class IsoTpParallelQuery:
         self.real_addrs.append((a, None))
 
     self.msg_addrs = {tx_addr: get_rx_addr_for_tx_addr(tx_addr[0], rx_offset=response_offset) for tx_addr in self.real_addrs}
-    self.msg_buffer = defaultdict(list)
+
+    self.demux = IsoTpRxDemux(logcan)
+    for tx_addr, rx_addr in self.msg_addrs.items():
+      if self.functional_addr:
+        for addr in FUNCTIONAL_RX_ADDRS[tx_addr[0]]:
+          self.demux.register(self.bus, addr, buffer_addr=tx_addr[0])
+      else:
+        self.demux.register(self.bus, rx_addr, sub_addr=tx_addr[1])
 
   def rx(self):
     """Drain can socket and sort messages into buffers based on address"""
-    can_packets = messaging.drain_sock(self.logcan, wait_for_one=True)
-
-    for packet in can_packets:
-      for msg in packet.can:
-        if msg.src == self.bus:
-          if self.functional_addr:
-            if (0x7E8 <= msg.address <= 0x7EF) or (0x18DAF100 <= msg.address <= 0x18DAF1FF):
-              fn_addr = next(a for a in FUNCTIONAL_ADDRS if msg.address - a <= 32)
-              self.msg_buffer[fn_addr].append((msg.address, msg.busTime, msg.dat, msg.src))
-          elif msg.address in self.msg_addrs.values():
-            self.msg_buffer[msg.address].append((msg.address, msg.busTime, msg.dat, msg.src))
+    self.demux.rx()
 
   def _can_tx(self, tx_addr, dat, bus):
     """Helper function to send single message"""
@@ -50,26 +118,10 @@ class IsoTpParallelQuery:
 
   def _can_rx(self, addr, sub_addr=None):
     """Helper function to retrieve message with specified address and subadress from buffer"""
-    keep_msgs = []
-
-    if sub_addr is None:
-      msgs = self.msg_buffer[addr]
-    else:
-      # Filter based on subadress
-      msgs = []
-      for m in self.msg_buffer[addr]:
-        first_byte = m[2][0]
-        if first_byte == sub_addr:
-          msgs.append(m)
-        else:
-          keep_msgs.append(m)
-
-    self.msg_buffer[addr] = keep_msgs
-    return msgs
+    return self.demux.pop(self.bus, addr, sub_addr)
 
   def _drain_rx(self):
-    messaging.drain_sock(self.logcan)
-    self.msg_buffer = defaultdict(list)
+    self.demux.drain()
 
   def get_data(self, timeout, total_timeout=None):
     if total_timeout is None:
@@ -146,3 +198,155 @@ class IsoTpParallelQuery:
         break
 
     return results
+
+
+class IsoTpQueryScheduler:
+  """Runs many iso-tp queries at once in a single event loop.
+
+  Every (bus, tx address, sub address) combination is one job. Jobs that talk to the same
+  tx or rx address on the same bus are serialized, all other jobs are interleaved, so
+  flow control for each ECU still happens on its own CanClient/IsoTpMessage pair."""
+  def __init__(self, sendcan, logcan, max_active=128, debug=False):
+    self.sendcan = sendcan
+    self.logcan = logcan
+    self.max_active = max_active
+    self.debug = debug
+
+    self.queries = []
+    self.jobs = []
+    self.demux = IsoTpRxDemux(logcan)
+
+  @property
+  def num_jobs(self):
+    return len(self.jobs)
+
+  def add_query(self, bus, addrs, request, response, response_offset=0x8, timeout=0.1, total_timeout=None):
+    """Queue a request/response sequence for a list of addresses. Returns the query index."""
+    if total_timeout is None:
+      total_timeout = 10 * timeout
+
+    query_idx = len(self.queries)
+    self.queries.append((request, response))
+
+    for a in addrs:
+      tx_addr = a if isinstance(a, tuple) else (a, None)
+      rx_addr = get_rx_addr_for_tx_addr(tx_addr[0], rx_offset=response_offset)
+      self.jobs.append({
+        'query': query_idx,
+        'bus': bus,
+        'tx_addr': tx_addr,
+        'rx_addr': rx_addr,
+        'keys': (('tx', bus, tx_addr[0]), ('rx', bus, rx_addr)),
+        'timeout': timeout,
+        'total_timeout': total_timeout,
+      })
+    return query_idx
+
+  def _can_tx(self, tx_addr, dat, bus):
+    """Helper function to send single message"""
+    msg = [tx_addr, 0, dat, bus]
+    self.sendcan.send(can_list_to_can_capnp([msg], msgtype='sendcan'))
+
+  def _start_job(self, job, now):
+    bus, (tx_addr, sub_addr), rx_addr = job['bus'], job['tx_addr'], job['rx_addr']
+    self.demux.register(bus, rx_addr, sub_addr=sub_addr)
+
+    can_client = CanClient(self._can_tx, partial(self.demux.pop, bus, rx_addr, sub_addr=sub_addr), tx_addr, rx_addr,
+                           bus, sub_addr=sub_addr, debug=self.debug)
+    max_len = 8 if sub_addr is None else 7
+
+    job['msg'] = IsoTpMessage(can_client, timeout=0, max_len=max_len, debug=self.debug)
+    job['counter'] = 0
+    job['start_time'] = now
+    job['last_response_time'] = now
+    job['msg'].send(self.queries[job['query']][0][0])
+
+  def get_data(self, done_callback=None):
+    """Run all queued jobs, returns a list with a result dict per query in the order they were added.
+    Stops as soon as every job either got its final response or timed out."""
+    self.demux.drain()
+
+    results = [{} for _ in self.queries]
+    pending = list(self.jobs)
+    active = []
+    busy = set()
+
+    while pending or active:
+      now = time.monotonic()
+
+      # Start as many pending jobs as possible. A job waiting for a busy key also blocks
+      # later jobs on that key, so requests to a single ECU go out in the order they were added
+      blocked = set()
+      starting = []
+      still_pending = []
+      for job in pending:
+        if len(active) + len(starting) < self.max_active and not any(k in busy or k in blocked for k in job['keys']):
+          busy.update(job['keys'])
+          starting.append(job)
+        else:
+          blocked.update(job['keys'])
+          still_pending.append(job)
+      pending = still_pending
+
+      if starting:
+        # frames received so far go to the running jobs. a late reply to a request that timed out
+        # has no route anymore and is dropped, instead of being taken as the response to the next
+        # request on that address
+        self.demux.rx(wait_for_one=False)
+
+      finished = []
+      for job in starting:
+        try:
+          self._start_job(job, now)
+          active.append(job)
+        except Exception:
+          cloudlog.exception(f"iso-tp query failed to start: {job['tx_addr']}")
+          finished.append(job)
+
+      self.demux.rx()
+
+      for job in active:
+        request, response = self.queries[job['query']]
+        done = False
+        # an exception only ends the job it came from
+        try:
+          dat: Optional[bytes] = job['msg'].recv()
+          if dat:
+            counter = job['counter']
+            expected_response = response[counter]
+            if dat[:len(expected_response)] == expected_response:
+              job['last_response_time'] = time.monotonic()
+              if counter + 1 < len(request):
+                job['counter'] += 1
+                job['msg'].send(request[counter + 1])
+              else:
+                results[job['query']][job['tx_addr']] = dat[len(expected_response):]
+                done = True
+            else:
+              cloudlog.warning(f"iso-tp query bad response: 0x{dat.hex()}")
+              done = True
+        except Exception:
+          cloudlog.exception(f"Error processing UDS response: {job['tx_addr']}")
+          done = True
+
+        cur_time = time.monotonic()
+        if not done and cur_time - job['last_response_time'] > job['timeout']:
+          if job['counter'] > 0:
+            cloudlog.warning(f"iso-tp query timeout after receiving response: {job['tx_addr']}")
+          done = True
+        if not done and cur_time - job['start_time'] > job['total_timeout']:
+          cloudlog.warning(f"iso-tp query timeout while receiving data: {job['tx_addr']}")
+          done = True
+
+        if done:
+          finished.append(job)
+
+      for job in finished:
+        if job in active:
+          active.remove(job)
+        busy.difference_update(job['keys'])
+        self.demux.unregister(job['bus'], job['rx_addr'], sub_addr=job['tx_addr'][1])
+        if done_callback is not None:
+          done_callback()
+
+    return results
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import unittest
+
+from common.realtime import DT_CTRL
+from selfdrive.car.can_scheduler import CanSendScheduler, PRIORITY_LOW, can_frame_bits
+
+# rates of the messages the hyundai carcontroller replaces, as sent by the stock camera and SCC
+STOCK_HZ = {"CLU11_MDPS": 50, "SCC": 50, "SCC13": 5, "LFAHDA_MFC": 20}
+
+
+def hyundai_scheduler(**kwargs):
+  # same registration as hyundai CarController
+  s = CanSendScheduler(DT_CTRL, **kwargs)
+  s.register("CLU11_MDPS", 2, phase=1)
+  s.register("SCC", 2, phase=0, weight=3)
+  s.register("SCC13", 20, align=2)
+  s.register("LFAHDA_MFC", 5)
+  return s
+
+
+class TestCanSendScheduler(unittest.TestCase):
+  def test_stock_rates(self):
+    s = hyundai_scheduler()
+    counts = {name: 0 for name in STOCK_HZ}
+    last_due = {}
+    for frame in range(int(2. / DT_CTRL)):
+      for name in STOCK_HZ:
+        if s.due(name):
+          counts[name] += 1
+          # evenly spaced like the stock messages, no jitter from the spreading
+          if name in last_due:
+            self.assertEqual(frame - last_due[name], round(1. / (STOCK_HZ[name] * DT_CTRL)))
+          last_due[name] = frame
+      s.flush()
+
+    self.assertEqual(counts, {name: hz * 2 for name, hz in STOCK_HZ.items()})
+
+  def test_spread(self):
+    s = hyundai_scheduler()
+    # SCC13 goes out with the SCC messages, LFAHDA_MFC avoids the SCC13 frame
+    scc13_phase = s.schedule["SCC13"][1]
+    self.assertEqual(scc13_phase % 2, 0)
+    lfa_period, lfa_phase = s.schedule["LFAHDA_MFC"]
+    self.assertNotEqual(scc13_phase % lfa_period, lfa_phase)
+
+  def test_flush(self):
+    reports = {}
+    s = CanSendScheduler(DT_CTRL, report=lambda name, value: reports.update({name: value}))
+    for _ in range(int(1. / DT_CTRL)):
+      s.add((0x420, 0, b"\x00" * 8, 0), PRIORITY_LOW)
+      s.add((0x340, 0, b"\x00" * 8, 0))
+      s.add((0x251, 0, b"\x00" * 8, 1))
+      msgs = s.flush()
+      self.assertEqual([m[0] for m in msgs], [0x340, 0x251, 0x420])
+
+    bits_per_s = can_frame_bits(8) / DT_CTRL
+    self.assertAlmostEqual(s.utilization[0], 2 * bits_per_s / 500000)
+    self.assertAlmostEqual(reports["can_tx_utilization_bus1"], bits_per_s / 500000)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+import time
+import unittest
+from collections import deque
+
+import cereal.messaging as messaging
+from cereal import car
+from selfdrive.boardd.boardd import can_list_to_can_capnp
+from selfdrive.car.fw_versions import get_fw_versions, HYUNDAI_VERSION_REQUEST_LONG, HYUNDAI_VERSION_RESPONSE, \
+                                      TESTER_PRESENT_REQUEST, TESTER_PRESENT_RESPONSE, \
+                                      SHORT_TESTER_PRESENT_REQUEST, SHORT_TESTER_PRESENT_RESPONSE, \
+                                      TOYOTA_VERSION_REQUEST, TOYOTA_VERSION_RESPONSE
+from selfdrive.car.isotp_parallel_query import IsoTpQueryScheduler, IsoTpRxDemux
+
+Ecu = car.CarParams.Ecu
+
+
+class FakeSocket:
+  def __init__(self):
+    self.data = deque()
+    self.on_send = None
+
+  def send(self, dat):
+    if self.on_send is not None:
+      self.on_send(dat)
+    else:
+      self.data.append(dat)
+
+  def receive(self, non_blocking=False):
+    return self.data.popleft() if self.data else None
+
+
+class SimulatedEcu:
+  """Answers iso-tp requests from a {request: response} table, including multi frame responses"""
+  def __init__(self, bus, tx_addr, rx_addr, responses, sub_addr=None):
+    self.bus = bus
+    self.tx_addr = tx_addr
+    self.rx_addr = rx_addr
+    self.responses = responses
+    self.sub_addr = sub_addr
+    self.pending = b""
+    self.requests = []
+
+  def _frame(self, dat):
+    prefix = b"" if self.sub_addr is None else bytes([self.sub_addr])
+    return (self.rx_addr, 0, (prefix + dat).ljust(8, b"\x00"), self.bus)
+
+  def handle(self, dat):
+    if self.sub_addr is not None:
+      if dat[0] != self.sub_addr:
+        return []
+      dat = dat[1:]
+
+    frame_type = dat[0] >> 4
+    if frame_type == 0x0:
+      request = bytes(dat[1:1 + (dat[0] & 0xF)])
+      self.requests.append(request)
+      if request not in self.responses:
+        return []
+
+      response = self.responses[request]
+      max_len = 7 if self.sub_addr is None else 6
+      if len(response) <= max_len:
+        return [self._frame(bytes([len(response)]) + response)]
+
+      # first frame, the rest is sent after flow control
+      first_len = max_len - 1
+      self.pending = response[first_len:]
+      return [self._frame(bytes([0x10 | (len(response) >> 8), len(response) & 0xFF]) + response[:first_len])]
+
+    if frame_type == 0x3 and self.pending:
+      frames = []
+      num_bytes = 7 if self.sub_addr is None else 6
+      for idx, i in enumerate(range(0, len(self.pending), num_bytes)):
+        frames.append(self._frame(bytes([0x20 | ((idx + 1) & 0xF)]) + self.pending[i:i + num_bytes]))
+      self.pending = b""
+      return frames
+
+    return []
+
+
+class SimulatedCar:
+  def __init__(self, ecus):
+    self.ecus = ecus
+    self.logcan = FakeSocket()
+    self.sendcan = FakeSocket()
+    self.sendcan.on_send = self.on_sendcan
+
+  def on_sendcan(self, dat):
+    msg = messaging.log_from_bytes(dat)
+    responses = []
+    for m in msg.sendcan:
+      for ecu in self.ecus:
+        if ecu.bus == m.src and ecu.tx_addr == m.address:
+          responses += ecu.handle(bytes(m.dat))
+    if responses:
+      self.logcan.data.append(can_list_to_can_capnp(responses, msgtype='can'))
+
+
+class TestFwQueryScheduler(unittest.TestCase):
+  def test_get_fw_versions(self):
+    hyundai_fw = b'\xf1\x00TM  MFC  AT USA LHD 1.00 1.01 99211-S2000 191220'
+    toyota_fw = b'\x018965B4209000\x00\x00\x00\x00'
+    sim = SimulatedCar([
+      SimulatedEcu(1, 0x7c4, 0x7cc, {HYUNDAI_VERSION_REQUEST_LONG: HYUNDAI_VERSION_RESPONSE + hyundai_fw}),
+      SimulatedEcu(1, 0x750, 0x758, {SHORT_TESTER_PRESENT_REQUEST: SHORT_TESTER_PRESENT_RESPONSE,
+                                     TOYOTA_VERSION_REQUEST: TOYOTA_VERSION_RESPONSE + toyota_fw}, sub_addr=0xf),
+    ])
+    extra = {
+      "hyundai": {"CAR": {(Ecu.fwdCamera, 0x7c4, None): [hyundai_fw], (Ecu.fwdRadar, 0x7d0, None): []}},
+      "toyota": {"CAR": {(Ecu.eps, 0x7a1, None): [], (Ecu.engine, 0x750, 0xf): [toyota_fw],
+                         (Ecu.fwdCamera, 0x750, 0x6d): []}},
+    }
+
+    t = time.monotonic()
+    fw_versions = get_fw_versions(sim.logcan, sim.sendcan, extra=extra, timeout=0.05)
+    fw = {(f.address, f.subAddress): f.fwVersion for f in fw_versions}
+    self.assertEqual(fw[(0x7c4, 0)], hyundai_fw)
+    self.assertEqual(fw[(0x750, 0xf)], toyota_fw)
+    self.assertEqual(len(fw), 2)
+
+    # Requests that don't depend on each other are interleaved, so this is much faster than
+    # waiting out the timeout of every request one by one
+    self.assertLess(time.monotonic() - t, 2.0)
+
+  def test_early_stop(self):
+    sim = SimulatedCar([SimulatedEcu(0, 0x7e0, 0x7e8, {TESTER_PRESENT_REQUEST: TESTER_PRESENT_RESPONSE}),
+                        SimulatedEcu(1, 0x7e0, 0x7e8, {TESTER_PRESENT_REQUEST: TESTER_PRESENT_RESPONSE})])
+    scheduler = IsoTpQueryScheduler(sim.sendcan, sim.logcan)
+    scheduler.add_query(0, [0x7e0], [TESTER_PRESENT_REQUEST], [TESTER_PRESENT_RESPONSE], timeout=5)
+    scheduler.add_query(1, [0x7e0], [TESTER_PRESENT_REQUEST], [TESTER_PRESENT_RESPONSE], timeout=5)
+
+    t = time.monotonic()
+    results = scheduler.get_data()
+    self.assertLess(time.monotonic() - t, 1.0)
+    self.assertEqual(results, [{(0x7e0, None): b''}, {(0x7e0, None): b''}])
+
+  def test_same_ecu_serialized(self):
+    ecu = SimulatedEcu(1, 0x7e0, 0x7e8, {TESTER_PRESENT_REQUEST: TESTER_PRESENT_RESPONSE,
+                                         SHORT_TESTER_PRESENT_REQUEST: SHORT_TESTER_PRESENT_RESPONSE})
+    sim = SimulatedCar([ecu])
+    scheduler = IsoTpQueryScheduler(sim.sendcan, sim.logcan)
+    scheduler.add_query(1, [0x7e0], [TESTER_PRESENT_REQUEST], [TESTER_PRESENT_RESPONSE])
+    scheduler.add_query(1, [0x7e0], [SHORT_TESTER_PRESENT_REQUEST], [SHORT_TESTER_PRESENT_RESPONSE])
+
+    results = scheduler.get_data()
+    self.assertEqual(ecu.requests, [TESTER_PRESENT_REQUEST, SHORT_TESTER_PRESENT_REQUEST])
+    self.assertEqual(results, [{(0x7e0, None): b''}, {(0x7e0, None): b''}])
+
+  def test_late_response_dropped(self):
+    ecu = SimulatedEcu(1, 0x7e0, 0x7e8, {SHORT_TESTER_PRESENT_REQUEST: SHORT_TESTER_PRESENT_RESPONSE})
+    sim = SimulatedCar([ecu])
+    scheduler = IsoTpQueryScheduler(sim.sendcan, sim.logcan)
+    scheduler.add_query(1, [0x7e0], [TESTER_PRESENT_REQUEST], [TESTER_PRESENT_RESPONSE], timeout=0.05)
+    scheduler.add_query(1, [0x7e0], [SHORT_TESTER_PRESENT_REQUEST], [SHORT_TESTER_PRESENT_RESPONSE])
+
+    # the reply to the first request arrives just after it timed out, it also matches the
+    # response prefix of the second request
+    unregister = scheduler.demux.unregister
+    late = [ecu._frame(bytes([len(TESTER_PRESENT_RESPONSE)]) + TESTER_PRESENT_RESPONSE)]
+
+    def unregister_late(*args, **kwargs):
+      unregister(*args, **kwargs)
+      if late:
+        sim.logcan.data.append(can_list_to_can_capnp([late.pop()], msgtype='can'))
+    scheduler.demux.unregister = unregister_late
+
+    results = scheduler.get_data()
+    self.assertEqual(ecu.requests, [TESTER_PRESENT_REQUEST, SHORT_TESTER_PRESENT_REQUEST])
+    self.assertEqual(results, [{}, {(0x7e0, None): b''}])
+
+  def test_failed_job(self):
+    sim = SimulatedCar([SimulatedEcu(1, 0x7e0, 0x7e8, {TESTER_PRESENT_REQUEST: TESTER_PRESENT_RESPONSE})])
+    on_send = sim.sendcan.on_send
+
+    def send(dat):
+      if any(m.src == 0 for m in messaging.log_from_bytes(dat).sendcan):
+        raise OSError("bus 0 is gone")
+      on_send(dat)
+    sim.sendcan.on_send = send
+
+    scheduler = IsoTpQueryScheduler(sim.sendcan, sim.logcan)
+    scheduler.add_query(0, [0x7e0], [TESTER_PRESENT_REQUEST], [TESTER_PRESENT_RESPONSE])
+    scheduler.add_query(1, [0x7e0], [TESTER_PRESENT_REQUEST], [TESTER_PRESENT_RESPONSE])
+    self.assertEqual(scheduler.get_data(), [{}, {(0x7e0, None): b''}])
+
+
+class TestIsoTpRxDemux(unittest.TestCase):
+  def test_routing(self):
+    logcan = FakeSocket()
+    demux = IsoTpRxDemux(logcan, maxlen=4)
+    demux.register(1, 0x758, sub_addr=0xf)
+    demux.register(1, 0x7e8)
+    for addr in range(0x7e8, 0x7f0):
+      demux.register(0, addr, buffer_addr=0x7df)
+
+    frames = [(0x758, 0, b'\x0f\x02\x7e\x00', 1), (0x758, 0, b'\x6d\x02\x7e\x00', 1), (0x7e8, 0, b'\x01\x7e', 1),
+              (0x7e8, 0, b'\x01\x7e', 2), (0x7e9, 0, b'\x01\x7e', 0), (0x7ea, 0, b'\x01\x7e', 0)]
+    frames += [(0x7e8, 0, bytes([i]), 1) for i in range(5)]
+    logcan.data.append(can_list_to_can_capnp(frames, msgtype='can'))
+    demux.rx()
+
+    self.assertEqual([m[2] for m in demux.pop(1, 0x758, 0xf)], [b'\x0f\x02\x7e\x00'])
+    self.assertEqual(demux.pop(1, 0x758, 0x6d), [])
+    self.assertEqual([m[0] for m in demux.pop(0, 0x7df)], [0x7e9, 0x7ea])
+    # ring buffer only keeps the newest frames
+    self.assertEqual([m[2] for m in demux.pop(1, 0x7e8)], [bytes([i]) for i in range(1, 5)])
+    self.assertEqual(demux.pop(1, 0x7e8), [])
+
+
+if __name__ == "__main__":
+  unittest.main()
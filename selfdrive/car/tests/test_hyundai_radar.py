@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import math
+import random
+import unittest
+from unittest import mock
+
+from cereal import car
+from opendbc.can.packer import CANPacker
+from selfdrive.boardd.boardd import can_list_to_can_capnp
+from selfdrive.car.hyundai import radar_interface
+from selfdrive.car.hyundai.radar_interface import RadarInterface, RADAR_START_ADDR, RADAR_MSG_COUNT
+from selfdrive.car.hyundai.values import CAR
+
+RADAR_ADDRS = range(RADAR_START_ADDR, RADAR_START_ADDR + RADAR_MSG_COUNT)
+
+
+def per_point(vl):
+  """dRel, yRel, vRel and aRel of each valid track, the way they were computed one point at a time"""
+  points = {}
+  for addr in RADAR_ADDRS:
+    msg = vl[f"RADAR_TRACK_{addr:x}"]
+    if msg['STATE'] in [3, 4]:
+      azimuth = math.radians(msg['AZIMUTH'])
+      points[addr] = (math.cos(azimuth) * msg['LONG_DIST'], 0.5 * -math.sin(azimuth) * msg['LONG_DIST'],
+                      msg['REL_SPEED'], msg['REL_ACCEL'])
+  return points
+
+
+class TestHyundaiRadar(unittest.TestCase):
+  def setUp(self):
+    CP = car.CarParams.new_message(carFingerprint=CAR.SONATA)
+    with mock.patch.object(radar_interface, "Params") as params:
+      params.return_value.get_bool.side_effect = lambda key: key == "NewRadarInterface"
+      self.RI = RadarInterface(CP)
+    self.assertTrue(self.RI.new_radar)
+    self.packer = CANPacker("hyundai_kia_mando_front_radar")
+
+  def update(self, tracks):
+    frames = []
+    for addr in RADAR_ADDRS:
+      state, azimuth, long_dist, rel_accel, rel_speed = tracks.get(addr, (0, 0, 0, 0, 0))
+      values = {"STATE": state, "AZIMUTH": azimuth, "LONG_DIST": long_dist, "REL_ACCEL": rel_accel, "REL_SPEED": rel_speed}
+      frames.append(self.packer.make_can_msg(f"RADAR_TRACK_{addr:x}", 1, values))
+    return self.RI.update([can_list_to_can_capnp(frames)])
+
+  def test_tracks(self):
+    random.seed(0)
+    ids = {}  # addr -> trackId while the track stays valid
+    seen = set()
+    for _ in range(50):
+      tracks = {}
+      for addr in random.sample(RADAR_ADDRS, 12):
+        tracks[addr] = (random.choice([1, 2, 3, 4, 5]), random.uniform(-30, 30), random.uniform(0, 200),
+                        random.uniform(-10, 10), random.uniform(-50, 50))
+      rr = self.update(tracks)
+      self.assertIsNotNone(rr)
+
+      expected = per_point(self.RI.rcp.vl)
+      self.assertEqual(len(rr.points), len(expected))
+      self.assertEqual(len(self.RI.point_arrays.trackId), len(expected))
+      for pt, addr in zip(rr.points, sorted(expected)):
+        d_rel, y_rel, v_rel, a_rel = expected[addr]
+        self.assertAlmostEqual(pt.dRel, d_rel, places=3)
+        self.assertAlmostEqual(pt.yRel, y_rel, places=3)
+        self.assertAlmostEqual(pt.vRel, v_rel, places=3)
+        self.assertAlmostEqual(pt.aRel, a_rel, places=3)
+        self.assertTrue(pt.measured)
+
+        # a track keeps its id while it's valid, and gets a new one when it comes back
+        if addr in ids:
+          self.assertEqual(pt.trackId, ids[addr])
+        else:
+          self.assertNotIn(pt.trackId, seen)
+        seen.add(pt.trackId)
+      ids = {addr: pt.trackId for pt, addr in zip(rr.points, sorted(expected))}
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import asyncio
+import threading
+import time
+import unittest
+
+from panda.python.uds import AsyncCanDispatcher, AsyncUdsClient, DATA_IDENTIFIER_TYPE
+
+VIN_REQUEST = b'\x22\xf1\x90'
+RESPONSE_PENDING = b'\x7f\x22\x78'
+
+
+class FakePanda:
+  """ECUs behind a panda that answer single frame requests, each response after a delay.
+  can_recv blocks like a USB read, until a frame is ready or the read times out."""
+  RECV_TIMEOUT = 0.5
+
+  def __init__(self, bus, responses):
+    self.bus = bus
+    self.responses = responses  # tx_addr -> {request: [(delay, response)]}
+    self.frames = []
+    self.cv = threading.Condition()
+
+  def can_send(self, addr, dat, bus, timeout=0):
+    now = time.monotonic()
+    request = bytes(dat[1:1 + (dat[0] & 0xF)])
+    with self.cv:
+      for delay, response in self.responses.get(addr, {}).get(request, []):
+        frame = (addr + 8, 0, (bytes([len(response)]) + response).ljust(8, b'\x00'), bus)
+        self.frames.append((now + delay, frame))
+      self.cv.notify_all()
+
+  def can_recv(self):
+    end = time.monotonic() + self.RECV_TIMEOUT
+    with self.cv:
+      while True:
+        now = time.monotonic()
+        ready = [f for t, f in self.frames if t <= now]
+        if ready or now >= end:
+          self.frames = [(t, f) for t, f in self.frames if t > now]
+          return ready
+        self.cv.wait(min([end] + [t for t, _ in self.frames]) - now)
+
+
+class TestAsyncUdsClient(unittest.TestCase):
+  def test_response_pending(self):
+    panda = FakePanda(0, {
+      0x7e0: {VIN_REQUEST: [(0, RESPONSE_PENDING), (0.6, b'\x62\xf1\x90' + b'VIN0')]},
+      0x7e1: {VIN_REQUEST: [(0.05, b'\x62\xf1\x90' + b'VIN1')]},
+    })
+    done = {}
+
+    async def read_vin(can, addr, start):
+      client = AsyncUdsClient(can, addr, timeout=0.3)
+      vin = await client.read_data_by_identifier(DATA_IDENTIFIER_TYPE.VIN)
+      done[addr] = time.monotonic() - start
+      return vin
+
+    async def main():
+      async with AsyncCanDispatcher(panda) as can:
+        start = time.monotonic()
+        return await asyncio.gather(read_vin(can, 0x7e0, start), read_vin(can, 0x7e1, start))
+
+    self.assertEqual(asyncio.run(main()), [b'VIN0', b'VIN1'])
+    # the other ECU answers while the first one is still pending, a blocked can_recv doesn't hold it up
+    self.assertLess(done[0x7e1], 0.25)
+    self.assertGreater(done[0x7e0], 0.6)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -5,6 +5,7 @@
 
 #include <csignal>
 #include <unordered_map>
+#include <vector>
 
 #include "selfdrive/common/swaglog.h"
 #include "selfdrive/common/util.h"
@@ -160,6 +161,7 @@ std::unordered_map<std::string, uint32_t> keys = {
     {"TrainingVersion", PERSISTENT},
     {"UpdateAvailable", CLEAR_ON_MANAGER_START},
     {"UpdateFailedCount", CLEAR_ON_MANAGER_START},
+    {"UploadBandwidthLimit", PERSISTENT},
     {"Version", PERSISTENT},
     {"VisionRadarToggle", PERSISTENT},
     {"ApiCache_Device", PERSISTENT},
@@ -256,6 +258,45 @@ int Params::put(const char* key, const char* value, size_t value_size) {
   return result;
 }
 
+int Params::putMulti(const std::map<std::string, std::string> &values) {
+  // Same steps as put(), but all temp files are renamed under one lock and the
+  // directory is only fsynced once at the end.
+  std::vector<std::pair<std::string, std::string>> tmp_paths;  // (tmp path, key)
+  int result = 0;
+  for (auto &[key, value] : values) {
+    std::string tmp_path = params_path + "/.tmp_value_XXXXXX";
+    int tmp_fd = mkstemp((char*)tmp_path.c_str());
+    if (tmp_fd < 0) {
+      result = -1;
+      break;
+    }
+    tmp_paths.push_back({tmp_path, key});
+
+    ssize_t bytes_written = HANDLE_EINTR(write(tmp_fd, value.data(), value.size()));
+    if (bytes_written < 0 || (size_t)bytes_written != value.size()) {
+      result = -20;
+    } else {
+      result = fsync(tmp_fd);
+    }
+    close(tmp_fd);
+    if (result < 0) break;
+  }
+
+  if (result == 0 && !tmp_paths.empty()) {
+    FileLock file_lock(params_path + "/.lock");
+    for (auto &[tmp_path, key] : tmp_paths) {
+      if ((result = rename(tmp_path.c_str(), getParamPath(key).c_str())) < 0) break;
+    }
+    int dir_result = fsync_dir(getParamPath());
+    if (result == 0) result = dir_result;
+  }
+
+  for (auto &[tmp_path, key] : tmp_paths) {
+    ::unlink(tmp_path.c_str());
+  }
+  return result;
+}
+
 int Params::remove(const std::string &key) {
   FileLock file_lock(params_path + "/.lock");
   int result = unlink(getParamPath(key).c_str());
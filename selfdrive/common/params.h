@@ -40,6 +40,8 @@ public:
   inline int putBool(const std::string &key, bool val) {
     return put(key.c_str(), val ? "1" : "0", 1);
   }
+  // write several values with a single directory fsync
+  int putMulti(const std::map<std::string, std::string> &values);
 
 private:
   std::string params_path;
@@ -5,7 +5,8 @@
 #include "selfdrive/common/statlog.h"
 #include "selfdrive/common/util.h"
 
-#include <stdio.h>
+#include <algorithm>
+#include <cstring>
 #include <mutex>
 #include <zmq.h>
 
@@ -16,28 +17,21 @@ class StatlogState : public LogState {
 
 static StatlogState s = {};
 
-static void log(const char* metric_type, const char* metric, const char* fmt, ...) {
-  char* value_buf = nullptr;
-  va_list args;
-  va_start(args, fmt);
-  int ret = vasprintf(&value_buf, fmt, args);
-  va_end(args);
-
-  if (ret > 0 && value_buf) {
-    char* line_buf = nullptr;
-    ret = asprintf(&line_buf, "%s:%s|%s", metric, value_buf, metric_type);
-    if (ret > 0 && line_buf) {
-      zmq_send(s.sock, line_buf, ret, ZMQ_NOBLOCK);
-      free(line_buf);
-    }
-    free(value_buf);
-  }
+// 0, first letter of the metric type, little endian double, then the metric name
+static void log(const char* metric_type, const char* metric, double value) {
+  char buf[256];
+  size_t name_len = std::min(strlen(metric), sizeof(buf) - 10);
+  buf[0] = 0;
+  buf[1] = metric_type[0];
+  memcpy(buf + 2, &value, sizeof(value));
+  memcpy(buf + 10, metric, name_len);
+  zmq_send(s.sock, buf, 10 + name_len, ZMQ_NOBLOCK);
 }
 
 void statlog_log(const char* metric_type, const char* metric, int value) {
-  log(metric_type, metric, "%d", value);
+  log(metric_type, metric, value);
 }
 
 void statlog_log(const char* metric_type, const char* metric, float value) {
-  log(metric_type, metric, "%f", value);
+  log(metric_type, metric, value);
 }
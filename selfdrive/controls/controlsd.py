@@ -30,7 +30,7 @@ from selfdrive.locationd.calibrationd import Calibration
 from selfdrive.hardware import HARDWARE, TICI, EON
 from selfdrive.manager.process_config import managed_processes
 from selfdrive.car.hyundai.scc_smoother import SccSmoother
-from selfdrive.ntune import ntune_common_get, ntune_common_enabled, ntune_scc_get
+from selfdrive.ntune import ntune_common_get, ntune_common_enabled, ntune_scc_get, ntune_enable_change_log, ntune_pop_changes
 
 SOFT_DISABLE_TIME = 3  # seconds
 LDW_MIN_SPEED = 31 * CV.MPH_TO_MS
@@ -69,7 +69,10 @@ class Controls:
     self.pm = pm
     if self.pm is None:
       self.pm = messaging.PubMaster(['sendcan', 'controlsState', 'carState',
-                                     'carControl', 'carEvents', 'carParams'])
+                                     'carControl', 'carEvents', 'carParams', 'nTuneUpdate'])
+
+      # log every applied tuning config so drives can be replayed with the same tune
+      ntune_enable_change_log()
 
     self.camera_packets = ["roadCameraState", "driverCameraState"]
     if TICI:
@@ -430,7 +433,7 @@ class Controls:
         if REPLAY and self.sm['pandaStates'][0].controlsAllowed:
           self.state = State.enabled
 
-        Params().put_bool("ControlsReady", True)
+        put_nonblocking("ControlsReady", "1")
 
     # Check for CAN timeout
     if not can_strs:
@@ -831,6 +834,14 @@ class Controls:
       cp_send.carParams = self.CP
       self.pm.send('carParams', cp_send)
 
+    # nTuneUpdate - logged when a tuning file changes
+    for group, version, config in ntune_pop_changes():
+      tune_send = messaging.new_message('nTuneUpdate')
+      tune_send.nTuneUpdate.group = group
+      tune_send.nTuneUpdate.version = version
+      tune_send.nTuneUpdate.config = config
+      self.pm.send('nTuneUpdate', tune_send)
+
     # carControl
     cc_send = messaging.new_message('carControl')
     cc_send.valid = CS.canValid
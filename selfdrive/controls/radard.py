@@ -103,7 +103,7 @@ class RadarD():
 
     self.ready = False
 
-  def update(self, sm, rr, enable_lead):
+  def update(self, sm, rr, enable_lead, points=None):
     self.current_time = 1e-9*max(sm.logMonoTime.values())
 
     if sm.updated['carState']:
@@ -113,8 +113,14 @@ class RadarD():
       self.ready = True
 
     ar_pts = {}
-    for pt in rr.points:
-      ar_pts[pt.trackId] = [pt.dRel, pt.yRel, pt.vRel, pt.measured]
+    if points is not None:
+      # same points as rr.points, without reading them back out of capnp
+      for track_id, d_rel, y_rel, v_rel, measured in zip(points.trackId.tolist(), points.dRel.tolist(), points.yRel.tolist(),
+                                                         points.vRel.tolist(), points.measured.tolist()):
+        ar_pts[track_id] = [d_rel, y_rel, v_rel, measured]
+    else:
+      for pt in rr.points:
+        ar_pts[pt.trackId] = [pt.dRel, pt.yRel, pt.vRel, pt.measured]
 
     # *** remove missing points from meta data ***
     for ids in list(self.tracks.keys()):
@@ -216,7 +222,7 @@ def radard_thread(sm=None, pm=None, can_sock=None):
 
     sm.update(0)
 
-    dat = RD.update(sm, rr, enable_lead)
+    dat = RD.update(sm, rr, enable_lead, RI.point_arrays)
     dat.radarState.cumLagMs = -rk.remaining*1000.
 
     pm.send('radarState', dat)
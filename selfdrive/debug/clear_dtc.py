@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 import sys
+import asyncio
 import argparse
 from subprocess import check_output, CalledProcessError
 from panda import Panda
-from panda.python.uds import UdsClient, MessageTimeoutError, SESSION_TYPE, DTC_GROUP_TYPE
+from panda.python.uds import AsyncCanDispatcher, AsyncUdsClient, UdsClient, MessageTimeoutError, SESSION_TYPE, DTC_GROUP_TYPE
+
+FUNCTIONAL_ADDR = 0x7DF
 
 parser = argparse.ArgumentParser(description="clear DTC status")
-parser.add_argument("addr", type=lambda x: int(x,0), nargs="?", default=0x7DF) # default is functional (broadcast) address
+parser.add_argument("addr", type=lambda x: int(x,0), nargs="*", default=[FUNCTIONAL_ADDR]) # default is functional (broadcast) address
 parser.add_argument("--bus", type=int, default=0)
 parser.add_argument('--debug', action='store_true')
 args = parser.parse_args()
@@ -21,20 +24,46 @@ except CalledProcessError as e:
 
 panda = Panda()
 panda.set_safety_mode(Panda.SAFETY_ELM327)
-uds_client = UdsClient(panda, args.addr, bus=args.bus, debug=args.debug)
-print("extended diagnostic session ...")
-try:
-  uds_client.diagnostic_session_control(SESSION_TYPE.EXTENDED_DIAGNOSTIC)
-except MessageTimeoutError:
-  # functional address isn't properly handled so a timeout occurs
-  if args.addr != 0x7DF:
-    raise
-print("clear diagnostic info ...")
-try:
-  uds_client.clear_diagnostic_information(DTC_GROUP_TYPE.ALL)
-except MessageTimeoutError:
+
+
+def clear_functional():
+  uds_client = UdsClient(panda, FUNCTIONAL_ADDR, bus=args.bus, debug=args.debug)
   # functional address isn't properly handled so a timeout occurs
-  if args.addr != 0x7DF:
-    pass 
+  try:
+    uds_client.diagnostic_session_control(SESSION_TYPE.EXTENDED_DIAGNOSTIC)
+  except MessageTimeoutError:
+    pass
+  try:
+    uds_client.clear_diagnostic_information(DTC_GROUP_TYPE.ALL)
+  except MessageTimeoutError:
+    pass
+
+
+async def clear_dtc(can, addr):
+  uds_client = AsyncUdsClient(can, addr, bus=args.bus, debug=args.debug)
+  await uds_client.diagnostic_session_control(SESSION_TYPE.EXTENDED_DIAGNOSTIC)
+  await uds_client.clear_diagnostic_information(DTC_GROUP_TYPE.ALL)
+
+
+async def main():
+  async with AsyncCanDispatcher(panda) as can:
+    return await asyncio.gather(*[clear_dtc(can, addr) for addr in args.addr], return_exceptions=True)
+
+
+print("extended diagnostic session and clear diagnostic info ...")
+if FUNCTIONAL_ADDR in args.addr:
+  # the async client only does physical addressing
+  if len(args.addr) > 1:
+    print("the functional address can't be combined with others (aborted)")
+    sys.exit(1)
+  clear_functional()
+else:
+  failed = False
+  for addr, err in zip(args.addr, asyncio.run(main())):
+    if isinstance(err, Exception):
+      print(f"{hex(addr)}: error: {err}")
+      failed = True
+  if failed:
+    sys.exit(1)
 print("")
 print("you may need to power cycle your vehicle now")
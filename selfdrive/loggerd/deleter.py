@@ -2,39 +2,199 @@
 import os
 import shutil
 import threading
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import psutil
+
+from common.xattr import getxattr
 from selfdrive.swaglog import cloudlog
-from selfdrive.loggerd.config import ROOT, get_available_bytes, get_available_percent
-from selfdrive.loggerd.uploader import listdir_by_creation
+from selfdrive.loggerd.config import ROOT
+from selfdrive.loggerd.uploader import UPLOAD_ATTR_NAME, listdir_by_creation
 
 MIN_BYTES = 5 * 1024 * 1024 * 1024
 MIN_PERCENT = 10
+# once deleting, free this much more than the minimum so it doesn't run again right away
+DELETE_HEADROOM = 512 * 1024 * 1024
 
 DELETE_LAST = ['boot', 'crash']
 
+# files deleted on their own before whole segments go, in this order. an fcamera that was
+# uploaded goes first, then the other cameras and the rlogs, the qlogs stay with their segment
+DELETE_FILES_ORDER = ["ecamera.hevc", "dcamera.hevc", "fcamera.hevc", "rlog.bz2", "rlog.xz"]
+
+
+class SizeLedger:
+  """Disk usage of the log directories in root, per directory and file.
+
+  Once its lock files are gone a segment's files are only added or removed, like the xz copy
+  athena makes of a log, which changes the directory's mtime. A pass only stats the directories
+  that are new, were still being written or whose mtime changed."""
+  def __init__(self, root: str):
+    self.root = root
+    self.dirs: Dict[str, Dict[str, int]] = {}  # logname -> {name: bytes on disk}
+    self.final: Dict[str, int] = {}  # logname -> directory mtime when it was listed
+    self.order: List[str] = []
+
+  def update(self) -> None:
+    self.order = listdir_by_creation(self.root)
+    for logname in self.dirs.keys() - set(self.order):
+      self.remove(logname)
+
+    for logname in self.order:
+      path = os.path.join(self.root, logname)
+      try:
+        mtime = os.stat(path).st_mtime_ns
+      except OSError:
+        self.remove(logname)
+        continue
+      if self.final.get(logname) == mtime:
+        continue
+
+      try:
+        names = os.listdir(path)
+      except NotADirectoryError:
+        names = None
+      except OSError:
+        self.remove(logname)
+        continue
+
+      if names is None:
+        self.dirs[logname] = {"": self.disk_usage(path) or 0}
+        continue
+
+      sizes = {}
+      for name in names:
+        size = self.disk_usage(os.path.join(path, name))
+        if size is not None:
+          sizes[name] = size
+      self.dirs[logname] = sizes
+      if "--" in logname and not self.locked(logname):
+        self.final[logname] = mtime
+
+  @staticmethod
+  def disk_usage(path: str) -> Optional[int]:
+    try:
+      return os.lstat(path).st_blocks * 512
+    except OSError:
+      return None
+
+  def locked(self, logname: str) -> bool:
+    return any(name.endswith(".lock") for name in self.dirs.get(logname, {}))
+
+  def remove(self, logname: str, name: Optional[str] = None) -> None:
+    if name is None:
+      self.dirs.pop(logname, None)
+      self.final.pop(logname, None)
+    else:
+      self.dirs.get(logname, {}).pop(name, None)
+
+  def totals(self, by_route: bool = False) -> Dict[str, int]:
+    """Bytes used per file type (boot and crash count as one), or per route"""
+    totals: Dict[str, int] = defaultdict(int)
+    for logname, sizes in self.dirs.items():
+      if by_route:
+        totals[logname.rsplit("--", 1)[0]] += sum(sizes.values())
+      elif "--" not in logname:
+        totals[logname] += sum(sizes.values())
+      else:
+        for name, size in sizes.items():
+          totals[name] += size
+    return dict(totals)
+
+
+def is_uploaded(fn: str) -> bool:
+  try:
+    return getxattr(fn, UPLOAD_ATTR_NAME) is not None
+  except OSError:
+    return False
+
+
+def deletion_order(ledger: SizeLedger) -> Iterator[Tuple[str, Optional[str], int]]:
+  """(logname, name, bytes) in the order they should be deleted, name is None for a whole directory"""
+  dirs = [d for d in ledger.order if d in ledger.dirs and not ledger.locked(d)]
+  segments = [d for d in dirs if d not in DELETE_LAST and "" not in ledger.dirs[d]]
+
+  uploaded = set()
+  for d in segments:
+    size = ledger.dirs[d].get("fcamera.hevc")
+    if size is not None and is_uploaded(os.path.join(ledger.root, d, "fcamera.hevc")):
+      uploaded.add(d)
+      yield d, "fcamera.hevc", size
+
+  for name in DELETE_FILES_ORDER:
+    for d in segments:
+      size = ledger.dirs[d].get(name)
+      if size is not None and not (name == "fcamera.hevc" and d in uploaded):
+        yield d, name, size
+
+  # remove the earliest directories we can
+  for d in sorted(dirs, key=lambda x: x in DELETE_LAST):
+    yield d, None, sum(ledger.dirs[d].values())
+
+
+def bytes_to_free(root: str) -> int:
+  try:
+    st = os.statvfs(root)
+  except OSError:
+    return 0
+
+  available = st.f_bavail * st.f_frsize
+  short = max(MIN_BYTES - available, MIN_PERCENT / 100. * st.f_blocks * st.f_frsize - available)
+  return int(short + DELETE_HEADROOM) if short > 0 else 0
+
+
+def delete_batch(ledger: SizeLedger, needed: int) -> int:
+  """Delete in policy order until needed bytes are freed, returns the bytes freed"""
+  batch = []
+  batch_names: Dict[str, Set[str]] = defaultdict(set)
+  planned = 0
+  for logname, name, size in deletion_order(ledger):
+    if name is None:
+      # files of the directory that are already in the batch were counted
+      size = sum(s for n, s in ledger.dirs[logname].items() if n not in batch_names[logname])
+    batch.append((logname, name))
+    batch_names[logname].add(name)
+    planned += size
+    if planned >= needed:
+      break
+
+  freed = 0
+  for logname, name in batch:
+    if name is None:
+      path = os.path.join(ledger.root, logname)
+      size = sum(ledger.dirs.get(logname, {}).values())
+    else:
+      path = os.path.join(ledger.root, logname, name)
+      size = ledger.dirs.get(logname, {}).get(name, 0)
+
+    try:
+      cloudlog.info(f"deleting {path}")
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+      else:
+        os.remove(path)
+      freed += size
+    except OSError:
+      cloudlog.exception(f"issue deleting {path}")
+    ledger.remove(logname, name)
+
+  cloudlog.event("deleter_batch", needed=needed, freed=freed, count=len(batch), usage=ledger.totals())
+  return freed
+
 
 def deleter_thread(exit_event):
+  proc = psutil.Process()
+  if psutil.LINUX:
+    # deleting only runs when nothing else needs the disk
+    proc.ionice(psutil.IOPRIO_CLASS_IDLE)
+
+  ledger = SizeLedger(ROOT)
   while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
-
-    if out_of_percent or out_of_bytes:
-      # remove the earliest directory we can
-      dirs = sorted(listdir_by_creation(ROOT), key=lambda x: x in DELETE_LAST)
-      for delete_dir in dirs:
-        delete_path = os.path.join(ROOT, delete_dir)
-
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
-          continue
-
-        try:
-          cloudlog.info(f"deleting {delete_path}")
-          if os.path.isfile(delete_path):
-            os.remove(delete_path)
-          else:
-            shutil.rmtree(delete_path)
-          break
-        except OSError:
-          cloudlog.exception(f"issue deleting {delete_path}")
+    needed = bytes_to_free(ROOT)
+    if needed > 0:
+      ledger.update()
+      delete_batch(ledger, needed)
       exit_event.wait(.1)
     else:
       exit_event.wait(30)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import bz2
+import lzma
+import os
+import sys
+from typing import Iterator, Optional
+
+RECOMPRESS_NAMES = ("rlog.bz2", "qlog.bz2")
+RECOMPRESSED_EXT = ".xz"
+
+READ_SIZE = 256 * 1024
+OUT_SIZE = 1024 * 1024
+# preset 6 uses an 8 MB dictionary and ~100 MB while compressing, ~10 MB to decompress
+XZ_PRESET = 6
+# keep the recompressed file only if it saves at least this much
+MIN_RATIO = 0.95
+
+
+def recompressed_path(fn: str) -> str:
+  return os.path.splitext(fn)[0] + RECOMPRESSED_EXT
+
+
+def source_path(fn: str) -> Optional[str]:
+  """The bz2 log an xz path is recompressed from, None if it isn't one"""
+  src = os.path.splitext(fn)[0] + ".bz2"
+  if not fn.endswith(RECOMPRESSED_EXT) or os.path.basename(src) not in RECOMPRESS_NAMES:
+    return None
+  return src
+
+
+def bz2_chunks(f) -> Iterator[bytes]:
+  """Decompressed contents of a (multi stream) bz2 file, at most OUT_SIZE bytes at a time"""
+  dec = bz2.BZ2Decompressor()
+  while True:
+    if dec.eof:
+      data = dec.unused_data or f.read(READ_SIZE)
+      if not data:
+        return
+      dec = bz2.BZ2Decompressor()
+    elif dec.needs_input:
+      data = f.read(READ_SIZE)
+      if not data:
+        raise EOFError("compressed file ended before the end-of-stream marker was reached")
+    else:
+      data = b""
+    out = dec.decompress(data, max_length=OUT_SIZE)
+    if out:
+      yield out
+
+
+def recompress(fn: str, preset: int = XZ_PRESET, min_ratio: Optional[float] = MIN_RATIO) -> Optional[str]:
+  """Recompress a bz2 log to xz next to it with bounded memory.
+
+  Returns the path of the xz file, or None when it wouldn't be smaller by min_ratio."""
+  out = recompressed_path(fn)
+  tmp = os.path.join(os.path.dirname(out), f".{os.path.basename(out)}.tmp")
+  enc = lzma.LZMACompressor(preset=preset)
+  try:
+    with open(fn, "rb") as f_in, open(tmp, "wb") as f_out:
+      for chunk in bz2_chunks(f_in):
+        f_out.write(enc.compress(chunk))
+      f_out.write(enc.flush())
+      f_out.flush()
+      os.fsync(f_out.fileno())
+
+    if min_ratio is not None and os.path.getsize(tmp) > min_ratio * os.path.getsize(fn):
+      os.unlink(tmp)
+      return None
+    os.replace(tmp, out)
+    return out
+  except BaseException:
+    try:
+      os.unlink(tmp)
+    except FileNotFoundError:
+      pass
+    raise
+
+
+def ensure_recompressed(fn: str) -> str:
+  """The xz copy of a bz2 log, made if there's none yet. For uploads of the xz key, kept even if not smaller"""
+  out = recompressed_path(fn)
+  if not os.path.isfile(out):
+    recompress(fn, min_ratio=None)
+  return out
+
+
+def lower_priority() -> None:
+  """Process pool initializer, recompression only runs on otherwise idle CPU"""
+  os.nice(19)
+  try:
+    os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+  except (AttributeError, OSError):
+    pass
+
+
+if __name__ == "__main__":
+  for fn in sys.argv[1:]:
+    out = recompress(fn)
+    if out is None:
+      print(f"{fn}: not smaller, skipped")
+    else:
+      size, new_size = os.path.getsize(fn), os.path.getsize(out)
+      print(f"{fn}: {size} -> {new_size} bytes ({new_size / size:.1%})")
@@ -0,0 +1,180 @@
+import base64
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.params import get_params_cache
+
+BLOCK_SIZE = 4 * 1024 * 1024
+BLOCK_UPLOAD_MIN_SIZE = 2 * BLOCK_SIZE  # smaller files are sent in one request
+READ_SIZE = 64 * 1024
+TIMEOUT = 10
+
+WIFI_CONCURRENCY = 4
+METERED_CONCURRENCY = 1
+
+BANDWIDTH_LIMIT_PARAM = "UploadBandwidthLimit"
+
+
+class TokenBucket:
+  """Thread safe token bucket shared by all uploads of a process, rate in bytes/s, 0 for unlimited"""
+  def __init__(self, rate: float = 0., burst: Optional[float] = None):
+    self.lock = threading.Lock()
+    self.tokens = 0.
+    self.set_rate(rate, burst)
+
+  def set_rate(self, rate: float, burst: Optional[float] = None) -> None:
+    with self.lock:
+      self.rate = max(rate, 0.)
+      self.burst = burst if burst is not None else max(self.rate, READ_SIZE)
+      self.tokens = min(self.tokens, self.burst)
+      self.last = time.monotonic()
+
+  def consume(self, n: int) -> None:
+    """Block until n bytes may be sent"""
+    while True:
+      with self.lock:
+        if self.rate == 0:
+          return
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        # reads larger than the bucket go into debt, which the next reads wait out
+        if self.tokens >= 0:
+          self.tokens -= n
+          return
+        wait = -self.tokens / self.rate
+      time.sleep(wait)
+
+
+def kbps_to_rate(value: Optional[bytes]) -> float:
+  try:
+    kbps = float(value) if value is not None else -1
+  except ValueError:
+    kbps = -1
+  return kbps * 1000 / 8 if kbps > 0 else 0.
+
+
+_limiter: Optional[TokenBucket] = None
+_limiter_lock = threading.Lock()
+
+
+def get_upload_limiter() -> TokenBucket:
+  """Process wide limiter that follows the UploadBandwidthLimit param (kbps, -1 for unlimited)
+
+  athenad's setBandwithLimit sets the param, so uploads of uploader and athenad follow it."""
+  global _limiter
+  with _limiter_lock:
+    if _limiter is None:
+      params = get_params_cache()
+      limiter = TokenBucket(kbps_to_rate(params.get(BANDWIDTH_LIMIT_PARAM)))
+      params.watch([BANDWIDTH_LIMIT_PARAM], lambda _, value: limiter.set_rate(kbps_to_rate(value)))
+      _limiter = limiter
+    return _limiter
+
+
+def new_session(pool_size: int = WIFI_CONCURRENCY) -> requests.Session:
+  """HTTP session that keeps up to pool_size connections per host alive between uploads"""
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+  return session
+
+
+class RangeReader:
+  """Reads length bytes of f from offset through the limiter, callback(sent) after each read"""
+  def __init__(self, f, offset: int, length: int, limiter: Optional[TokenBucket] = None,
+               callback: Optional[Callable[[int], None]] = None):
+    self.f = f
+    self.offset = offset
+    self.remaining = length
+    self.limiter = limiter
+    self.callback = callback
+
+  def __len__(self):
+    return self.remaining
+
+  def read(self, size: int = -1) -> bytes:
+    if size is None or size < 0:
+      size = self.remaining
+    size = min(size, self.remaining, READ_SIZE)
+    if size <= 0:
+      return b""
+
+    if self.limiter is not None:
+      self.limiter.consume(size)
+    self.f.seek(self.offset)
+    chunk = self.f.read(size)
+    self.offset += len(chunk)
+    self.remaining -= len(chunk)
+    if self.callback is not None:
+      self.callback(len(chunk))
+    return chunk
+
+
+def block_id(i: int) -> str:
+  # block ids of a blob must all have the same length
+  return base64.b64encode(f"{i:08d}".encode()).decode()
+
+
+def with_query(url: str, query: str) -> str:
+  return url + ("&" if "?" in url else "?") + query
+
+
+def is_block_blob(headers: Dict[str, str]) -> bool:
+  return any(k.lower() == "x-ms-blob-type" and v == "BlockBlob" for k, v in headers.items())
+
+
+def upload_file(session: requests.Session, url: str, headers: Dict[str, str], fn: str,
+                limiter: Optional[TokenBucket] = None, callback: Optional[Callable[[int, int], None]] = None,
+                blocks_done: int = 0, on_block: Optional[Callable[[int], None]] = None, timeout: float = TIMEOUT) -> requests.Response:
+  """Upload fn to a presigned url and return the last response.
+
+  Files of BLOCK_UPLOAD_MIN_SIZE and up going to a block blob are put BLOCK_SIZE blocks at a time
+  and committed with a block list, so a failed upload can continue where it stopped: blocks_done
+  blocks were put by an earlier attempt, on_block(n) is called with the number of blocks put so
+  far, and with 0 when the server no longer has them. callback(size, sent) is called as data is
+  sent, like CallbackReader, and may raise to abort the upload."""
+  with open(fn, "rb") as f:
+    size = os.fstat(f.fileno()).st_size
+    sent = 0
+
+    def on_read(n):
+      nonlocal sent
+      sent += n
+      if callback is not None:
+        callback(size, sent)
+
+    if size < BLOCK_UPLOAD_MIN_SIZE or not is_block_blob(headers):
+      return session.put(url, data=RangeReader(f, 0, size, limiter, on_read),
+                         headers={**headers, 'Content-Length': str(size)}, timeout=timeout)
+
+    n_blocks = (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    blocks_done = min(blocks_done, n_blocks)
+    sent = blocks_done * BLOCK_SIZE
+    for i in range(blocks_done, n_blocks):
+      length = min(BLOCK_SIZE, size - i * BLOCK_SIZE)
+      resp = session.put(with_query(url, f"comp=block&blockid={quote(block_id(i))}"),
+                         data=RangeReader(f, i * BLOCK_SIZE, length, limiter, on_read),
+                         headers={'Content-Length': str(length)}, timeout=timeout)
+      if resp.status_code not in (200, 201):
+        return resp
+      if on_block is not None:
+        on_block(i + 1)
+
+  block_list = "".join(f"<Latest>{block_id(i)}</Latest>" for i in range(n_blocks))
+  # the blob's content type is set when the block list is committed
+  commit_headers = {"x-ms-blob-content-type": v for k, v in headers.items() if k.lower() == "content-type"}
+  resp = session.put(with_query(url, "comp=blocklist"),
+                     data=f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>',
+                     headers=commit_headers, timeout=timeout)
+  if resp.status_code == 400 and on_block is not None:
+    # uncommitted blocks expire, start over on the next attempt
+    on_block(0)
+  return resp
@@ -0,0 +1,214 @@
+import os
+import sqlite3
+import threading
+from typing import Callable, Collection, List, Optional, Tuple
+
+from common.xattr import getxattr
+from selfdrive.swaglog import cloudlog
+
+INDEX_NAME = ".upload_index.db"
+SCHEMA_VERSION = 2
+SCHEMA = f"""
+DROP TABLE IF EXISTS dirs;
+DROP TABLE IF EXISTS files;
+DROP TABLE IF EXISTS progress;
+CREATE TABLE dirs (dir TEXT PRIMARY KEY, done INTEGER NOT NULL);
+CREATE TABLE files (
+  dir TEXT NOT NULL, name TEXT NOT NULL,
+  rank INTEGER NOT NULL, sort0 TEXT NOT NULL, sort1 TEXT NOT NULL, priority INTEGER NOT NULL,
+  size INTEGER NOT NULL, uploaded INTEGER NOT NULL,
+  PRIMARY KEY (dir, name)
+);
+CREATE INDEX pending ON files (uploaded, rank, sort0, sort1, priority, name);
+CREATE TABLE progress (dir TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL, blocks INTEGER NOT NULL, PRIMARY KEY (dir, name));
+PRAGMA user_version = {SCHEMA_VERSION};
+"""
+
+# (rank, priority) of a file the uploader picks by itself, None for files only uploaded on request
+RankFn = Callable[[str, str], Optional[Tuple[int, int]]]
+
+
+class UploadIndex:
+  """On-disk index of the files the uploader picks from, kept in sqlite in the log root.
+
+  A log directory is scanned once it has no lock files left, and its files are stored with their
+  rank and whether they were uploaded, so picking the next file is one lookup in the pending index.
+  Segment directories don't change after that; the others (boot, crash) and directories still
+  being written are watched with inotify and rescanned when they change. The upload xattr stays
+  the source of truth, the index is rebuilt from it when it is missing or unreadable.
+
+  Refreshing and picking happen on the uploader thread, upload workers only record results."""
+  def __init__(self, root: str, attr_name: str, rank: RankFn, dir_sort: Callable[[str], List[str]]):
+    self.root = root
+    self.attr_name = attr_name
+    self.rank = rank
+    self.dir_sort = dir_sort
+    self.path = os.path.join(root, INDEX_NAME)
+    self.lock = threading.RLock()
+    self.db = self.open_db()
+
+    self.dirty = set()
+    self.watches = {}  # logname -> wd
+    self.inotify = None
+    try:
+      from common.inotify import Inotify, IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO
+      self.inotify = Inotify()
+      self.root_wd = self.inotify.add_watch(root, IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+    except Exception:
+      cloudlog.exception("upload index: no inotify, rescanning open directories on every refresh")
+      self.inotify = None
+
+    self.sync_root()
+
+  def open_db(self) -> sqlite3.Connection:
+    try:
+      return self._connect()
+    except sqlite3.DatabaseError:
+      cloudlog.exception("upload index unreadable, rebuilding from xattrs")
+      for suffix in ("", "-wal", "-shm"):
+        try:
+          os.unlink(self.path + suffix)
+        except FileNotFoundError:
+          pass
+      return self._connect()
+
+  def _connect(self) -> sqlite3.Connection:
+    db = sqlite3.connect(self.path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+      db.executescript(SCHEMA)
+    db.execute("SELECT count(*) FROM dirs").fetchone()
+    return db
+
+  def sync_root(self) -> None:
+    """Reconcile the indexed directories with the log root"""
+    try:
+      on_disk = {d for d in os.listdir(self.root) if not d.startswith(".") and os.path.isdir(os.path.join(self.root, d))}
+    except OSError:
+      cloudlog.exception("upload index: listdir failed")
+      return
+
+    with self.lock:
+      known = dict(self.db.execute("SELECT dir, done FROM dirs"))
+    for logname in known.keys() - on_disk:
+      self.remove_dir(logname)
+    self.dirty |= {d for d in on_disk if not known.get(d, False)}
+
+  def refresh(self) -> None:
+    if self.inotify is None:
+      self.sync_root()
+    else:
+      from common.inotify import IN_ISDIR, IN_CREATE, IN_MOVED_TO, IN_IGNORED, IN_Q_OVERFLOW
+      dirs = {wd: logname for logname, wd in self.watches.items()}
+      for e in self.inotify.read(timeout=0):
+        if e.mask & IN_Q_OVERFLOW:
+          self.sync_root()
+        elif e.wd == self.root_wd:
+          if not e.mask & IN_ISDIR or e.name.startswith("."):
+            continue
+          if e.mask & (IN_CREATE | IN_MOVED_TO):
+            self.dirty.add(e.name)
+          else:
+            self.remove_dir(e.name)
+        elif e.wd in dirs:
+          if e.mask & IN_IGNORED:
+            # watched directory is gone
+            self.watches.pop(dirs[e.wd], None)
+          else:
+            self.dirty.add(dirs[e.wd])
+
+    while self.dirty:
+      self.scan_dir(self.dirty.pop())
+
+  def scan_dir(self, logname: str) -> None:
+    path = os.path.join(self.root, logname)
+    if self.inotify is not None and logname not in self.watches:
+      # watch first, so nothing written during the scan is missed
+      from common.inotify import IN_CLOSE_WRITE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO
+      try:
+        self.watches[logname] = self.inotify.add_watch(path, IN_CLOSE_WRITE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+      except OSError:
+        pass
+
+    try:
+      names = os.listdir(path)
+    except OSError:
+      self.remove_dir(logname)
+      return
+
+    locked = any(name.endswith(".lock") for name in names)
+    # a segment never changes once its lock files are gone
+    done = not locked and "--" in logname
+
+    with self.lock, self.db:
+      self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (logname, done))
+      if locked:
+        self.db.execute("DELETE FROM files WHERE dir=?", (logname,))
+      else:
+        known = {name for name, in self.db.execute("SELECT name FROM files WHERE dir=?", (logname,))}
+        self.db.executemany("DELETE FROM files WHERE dir=? AND name=?", [(logname, name) for name in known - set(names)])
+
+        sort = self.dir_sort(logname) + [""]
+        rows = []
+        for name in set(names) - known:
+          fn = os.path.join(path, name)
+          rank = self.rank(fn, name)
+          if rank is None:
+            continue
+          try:
+            uploaded = getxattr(fn, self.attr_name) is not None
+            size = os.path.getsize(fn)
+          except OSError:
+            cloudlog.event("uploader_getxattr_failed", key=os.path.join(logname, name), fn=fn)
+            continue  # deleter could have deleted
+          rows.append((logname, name, rank[0], sort[0], sort[1], rank[1], size, uploaded))
+        self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    if done and logname in self.watches:
+      self.inotify.rm_watch(self.watches.pop(logname))
+
+  def remove_dir(self, logname: str) -> None:
+    with self.lock, self.db:
+      self.db.execute("DELETE FROM dirs WHERE dir=?", (logname,))
+      self.db.execute("DELETE FROM files WHERE dir=?", (logname,))
+      self.db.execute("DELETE FROM progress WHERE dir=?", (logname,))
+    self.dirty.discard(logname)
+    wd = self.watches.pop(logname, None)
+    if wd is not None:
+      self.inotify.rm_watch(wd)
+
+  def next_pending(self, exclude: Collection[Tuple[str, str]] = ()) -> Optional[Tuple[str, str]]:
+    """(logname, name) of the highest ranked file that isn't uploaded yet and not in exclude"""
+    with self.lock:
+      rows = self.db.execute("SELECT dir, name FROM files WHERE uploaded=0 "
+                             "ORDER BY rank, sort0, sort1, priority, name LIMIT ?", (len(exclude) + 1,)).fetchall()
+    return next((r for r in rows if r not in exclude), None)
+
+  def pending_stats(self, names) -> Tuple[int, int]:
+    """Count and total size of pending files with one of the given names"""
+    names = list(names)
+    with self.lock:
+      count, size = self.db.execute(f"SELECT count(*), total(size) FROM files WHERE uploaded=0 AND name IN ({','.join('?' * len(names))})",
+                                    names).fetchone()
+    return count, int(size)
+
+  def mark_uploaded(self, logname: str, name: str) -> None:
+    with self.lock, self.db:
+      self.db.execute("UPDATE files SET uploaded=1 WHERE dir=? AND name=?", (logname, name))
+      self.db.execute("DELETE FROM progress WHERE dir=? AND name=?", (logname, name))
+
+  def get_progress(self, logname: str, name: str, size: int) -> int:
+    """Blocks of a resumable upload already put, 0 if the file changed size since"""
+    with self.lock:
+      row = self.db.execute("SELECT size, blocks FROM progress WHERE dir=? AND name=?", (logname, name)).fetchone()
+    return row[1] if row is not None and row[0] == size else 0
+
+  def set_progress(self, logname: str, name: str, size: int, blocks: int) -> None:
+    with self.lock, self.db:
+      self.db.execute("INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?)", (logname, name, size, blocks))
+
+  def close(self) -> None:
+    self.db.close()
+    if self.inotify is not None:
+      self.inotify.close()
@@ -2,19 +2,21 @@
 import json
 import os
 import random
-import requests
 import threading
 import time
 import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
 from cereal import log
 import cereal.messaging as messaging
 from common.api import Api
 from common.params import Params
+from common.xattr import setxattr
 from selfdrive.hardware import TICI
-from selfdrive.loggerd.xattr_cache import getxattr, setxattr
 from selfdrive.loggerd.config import ROOT
+from selfdrive.loggerd.upload_engine import METERED_CONCURRENCY, WIFI_CONCURRENCY, get_upload_limiter, new_session, upload_file
+from selfdrive.loggerd.upload_index import UploadIndex
 from selfdrive.swaglog import cloudlog
 
 NetworkType = log.DeviceState.NetworkType
@@ -31,7 +33,7 @@ def get_directory_sort(d):
 
 def listdir_by_creation(d):
   try:
-    paths = os.listdir(d)
+    paths = [p for p in os.listdir(d) if not p.startswith(".")]
     paths = sorted(paths, key=get_directory_sort)
     return paths
   except OSError:
@@ -40,6 +42,8 @@ def listdir_by_creation(d):
 
 def clear_locks(root):
   for logname in os.listdir(root):
+    if logname.startswith("."):
+      continue
     path = os.path.join(root, logname)
     try:
       for fname in os.listdir(path):
@@ -55,10 +59,9 @@ class Uploader():
     self.api = Api(dongle_id)
     self.root = root
 
-    self.upload_thread = None
-
-    self.last_resp = None
-    self.last_exc = None
+    # uploads run on up to WIFI_CONCURRENCY worker threads and share the connection pool
+    self.session = new_session(WIFI_CONCURRENCY)
+    self.limiter = get_upload_limiter()
 
     self.immediate_size = 0
     self.immediate_count = 0
@@ -71,99 +74,86 @@ class Uploader():
     self.immediate_folders = ["crash/", "boot/"]
     self.immediate_priority = {"qlog.bz2": 0, "qcamera.ts": 1}
 
+    # created once root exists
+    self.index = None
+
   def get_upload_sort(self, name):
     if name in self.immediate_priority:
       return self.immediate_priority[name]
     return 1000
 
-  def list_upload_files(self):
+  def get_upload_rank(self, fn, name):
+    if any(f in fn for f in self.immediate_folders):
+      return (0, self.get_upload_sort(name))
+    if name in self.immediate_priority:
+      return (1, self.immediate_priority[name])
+    return None
+
+  def next_file_to_upload(self, exclude=()):
+    """Next (key, fn) to upload, skipping the keys in exclude"""
     if not os.path.isdir(self.root):
-      return
+      return None
 
-    self.immediate_size = 0
-    self.immediate_count = 0
+    if self.index is None:
+      self.index = UploadIndex(self.root, UPLOAD_ATTR_NAME, self.get_upload_rank, get_directory_sort)
+    self.index.refresh()
+    self.immediate_count, self.immediate_size = self.index.pending_stats(self.immediate_priority)
 
-    for logname in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logname)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
-
-      if any(name.endswith(".lock") for name in names):
-        continue
-
-      for name in sorted(names, key=self.get_upload_sort):
-        key = os.path.join(logname, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME)
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", exc=self.last_exc, key=key, fn=fn)
-          is_uploaded = True  # deleter could have deleted
-        if is_uploaded:
-          continue
-
-        try:
-          if name in self.immediate_priority:
-            self.immediate_count += 1
-            self.immediate_size += os.path.getsize(fn)
-        except OSError:
-          pass
-
-        yield (name, key, fn)
-
-  def next_file_to_upload(self):
-    upload_files = list(self.list_upload_files())
-
-    for name, key, fn in upload_files:
-      if any(f in fn for f in self.immediate_folders):
-        return (key, fn)
-
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return (key, fn)
+    d = self.index.next_pending({tuple(os.path.split(key)) for key in exclude})
+    if d is None:
+      return None
 
-    return None
+    logname, name = d
+    return (os.path.join(logname, name), os.path.join(self.root, logname, name))
 
-  def do_upload(self, key, fn):
+  def mark_uploaded(self, key, fn, sz, exc=None):
     try:
-      url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
-      if url_resp.status_code == 412:
-        self.last_resp = url_resp
-        return
+      # tag file as uploaded
+      setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+    except OSError:
+      cloudlog.event("uploader_setxattr_failed", exc=exc, key=key, fn=fn, sz=sz)
+      return
 
-      url_resp_json = json.loads(url_resp.text)
-      url = url_resp_json['url']
-      headers = url_resp_json['headers']
-      cloudlog.debug("upload_url v1.4 %s %s", url, str(headers))
+    if self.index is not None:
+      self.index.mark_uploaded(*os.path.split(key))
 
-      if fake_upload:
-        cloudlog.debug(f"*** WARNING, THIS IS A FAKE UPLOAD TO {url} ***")
+  def do_upload(self, key, fn, limited=False):
+    url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
+    if url_resp.status_code == 412:
+      return url_resp
 
-        class FakeResponse():
-          def __init__(self):
-            self.status_code = 200
+    url_resp_json = json.loads(url_resp.text)
+    url = url_resp_json['url']
+    headers = url_resp_json['headers']
+    cloudlog.debug("upload_url v1.4 %s %s", url, str(headers))
 
-        self.last_resp = FakeResponse()
-      else:
-        with open(fn, "rb") as f:
-          self.last_resp = requests.put(url, data=f, headers=headers, timeout=10)
-    except Exception as e:
-      self.last_exc = (e, traceback.format_exc())
-      raise
+    if fake_upload:
+      cloudlog.debug(f"*** WARNING, THIS IS A FAKE UPLOAD TO {url} ***")
 
-  def normal_upload(self, key, fn):
-    self.last_resp = None
-    self.last_exc = None
+      class FakeResponse():
+        def __init__(self):
+          self.status_code = 200
 
-    try:
-      self.do_upload(key, fn)
-    except Exception:
-      pass
+      return FakeResponse()
+
+    # large files continue from the last block a previous attempt got up
+    logname, name = os.path.split(key)
+    size = os.path.getsize(fn)
+    blocks_done = self.index.get_progress(logname, name, size) if self.index is not None else 0
 
-    return self.last_resp
+    def on_block(blocks):
+      if self.index is not None:
+        self.index.set_progress(logname, name, size, blocks)
+
+    return upload_file(self.session, url, headers, fn, self.limiter if limited else None,
+                       blocks_done=blocks_done, on_block=on_block)
+
+  def normal_upload(self, key, fn, limited=False):
+    """Returns (response, exception), response is None if the upload raised"""
+    try:
+      return self.do_upload(key, fn, limited), None
+    except Exception as e:
+      return None, (e, traceback.format_exc())
 
   def upload(self, key, fn, network_type, metered):
     try:
@@ -175,21 +165,16 @@ class Uploader():
     cloudlog.event("upload_start", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
 
     if sz == 0:
-      try:
-        # tag files of 0 size as uploaded
-        setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
-      except OSError:
-        cloudlog.event("uploader_setxattr_failed", exc=self.last_exc, key=key, fn=fn, sz=sz)
+      # tag files of 0 size as uploaded
+      self.mark_uploaded(key, fn, sz)
       success = True
     else:
+      # the bandwidth limit applies to the modem, like the one athenad sets up on comma three
+      limited = network_type not in (NetworkType.wifi, NetworkType.ethernet)
       start_time = time.monotonic()
-      stat = self.normal_upload(key, fn)
+      stat, exc = self.normal_upload(key, fn, limited)
       if stat is not None and stat.status_code in (200, 201, 401, 403, 412):
-        try:
-          # tag file as uploaded
-          setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
-        except OSError:
-          cloudlog.event("uploader_setxattr_failed", exc=self.last_exc, key=key, fn=fn, sz=sz)
+        self.mark_uploaded(key, fn, sz, exc)
 
         self.last_filename = fn
         self.last_time = time.monotonic() - start_time
@@ -198,7 +183,7 @@ class Uploader():
         cloudlog.event("upload_success" if stat.status_code != 412 else "upload_ignored", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
       else:
         success = False
-        cloudlog.event("upload_failed", stat=stat, exc=self.last_exc, key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
+        cloudlog.event("upload_failed", stat=stat, exc=exc, key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
 
     return success
 
@@ -212,6 +197,18 @@ class Uploader():
     us.lastFilename = self.last_filename
     return msg
 
+def fill_upload_slots(uploader, executor, uploads, concurrency, network_type, metered):
+  """Submit uploads of the next files until concurrency are running, each file in at most one slot"""
+  exclude = set(uploads.values())
+  while len(uploads) < concurrency:
+    d = uploader.next_file_to_upload(exclude=exclude)
+    if d is None:
+      break
+    key, fn = d
+    exclude.add(key)
+    uploads[executor.submit(uploader.upload, key, fn, network_type, metered)] = key
+
+
 def uploader_fn(exit_event):
   clear_locks(ROOT)
 
@@ -229,34 +226,52 @@ def uploader_fn(exit_event):
   pm = messaging.PubMaster(['uploaderState'])
   uploader = Uploader(dongle_id, ROOT)
 
+  executor = ThreadPoolExecutor(max_workers=WIFI_CONCURRENCY, thread_name_prefix="upload")
+  uploads = {}  # future -> key
+
   backoff = 0.1
   while not exit_event.is_set():
     sm.update(0)
     offroad = params.get_bool("IsOffroad")
     network_type = sm['deviceState'].networkType if not force_wifi else NetworkType.wifi
-    if network_type == NetworkType.none:
+    if network_type == NetworkType.none and not uploads:
       if allow_sleep:
         time.sleep(60 if offroad else 5)
       continue
 
-    d = uploader.next_file_to_upload()
-    if d is None:  # Nothing to upload
-      if allow_sleep:
+    metered = sm['deviceState'].networkMetered
+
+    # fill the free upload slots, only one upload at a time on metered connections
+    if network_type != NetworkType.none:
+      concurrency = METERED_CONCURRENCY if metered else WIFI_CONCURRENCY
+      fill_upload_slots(uploader, executor, uploads, concurrency, sm['deviceState'].networkType.raw, metered)
+
+    if not uploads:
+      if allow_sleep:  # Nothing to upload
         time.sleep(60 if offroad else 5)
       continue
 
-    key, fn = d
+    done, _ = wait(uploads, timeout=1., return_when=FIRST_COMPLETED)
+    if not done:
+      continue
+
+    failed = False
+    for future in done:
+      del uploads[future]
+      if future.result():
+        backoff = 0.1
+      else:
+        failed = True
 
-    success = uploader.upload(key, fn, sm['deviceState'].networkType.raw, sm['deviceState'].networkMetered)
-    if success:
-      backoff = 0.1
-    elif allow_sleep:
+    if failed and allow_sleep:
       cloudlog.info("upload backoff %r", backoff)
       time.sleep(backoff + random.uniform(0, backoff))
       backoff = min(backoff*2, 120)
 
     pm.send("uploaderState", uploader.get_msg())
 
+  executor.shutdown(wait=True)
+
 
 def main():
   uploader_fn(threading.Event())
@@ -3,13 +3,14 @@ import zmq
 from typing import NoReturn
 
 import cereal.messaging as messaging
-from common.logging_extra import SwagLogFileFormatter
+from common.logging_extra import BINARY_RECORD, SwagFormatter, SwagLogFileFormatter, json_robust_dumps
 from selfdrive.swaglog import get_file_handler
 
 
 def main() -> NoReturn:
   log_handler = get_file_handler()
   log_handler.setFormatter(SwagLogFileFormatter(None))
+  record_formatter = SwagFormatter(None)
   log_level = 20  # logging.INFO
 
   ctx = zmq.Context().instance()
@@ -23,9 +24,15 @@ def main() -> NoReturn:
   while True:
     dat = b''.join(sock.recv_multipart())
     level = dat[0]
-    record = dat[1:].decode("utf-8")
+    if dat[1:2] == BINARY_RECORD:
+      # python processes send the record's fields, the C++ ones json
+      record_dict = record_formatter.load_binary(dat[2:])
+      record = json_robust_dumps(record_dict)
+    else:
+      record = dat[1:].decode("utf-8")
+      record_dict = record
     if level >= log_level:
-      log_handler.emit(record)
+      log_handler.emit(record_dict)
 
     # then we publish them
     msg = messaging.new_message()
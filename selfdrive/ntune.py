@@ -1,11 +1,13 @@
 import os
-import fcntl
-import signal
 import json
+import threading
 import weakref
+from collections import deque
 from enum import Enum
 import numpy as np
 
+from common.inotify import Inotify, IN_CLOSE_WRITE, IN_MOVED_TO
+
 CONF_PATH = '/data/ntune/'
 CONF_LAT_LQR_FILE = '/data/ntune/lat_lqr.json'
 CONF_LAT_INDI_FILE = '/data/ntune/lat_indi.json'
@@ -13,11 +15,78 @@ CONF_LAT_TORQUE_FILE = '/data/ntune/lat_torque_v4.json'
 
 ntunes = {}
 
+# (group, version, config json) of published snapshots, only kept once a process enables it
+_change_log = None
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+class TuneSnapshot:
+  """Validated contents of one config file. A snapshot is never modified, a file change
+  publishes a new one, so readers in the control loop don't need a lock."""
+  def __init__(self, config, version=0):
+    self.__dict__.update(config)
+    self.__dict__['_version'] = version
+
+  def __setattr__(self, key, value):
+    raise AttributeError("TuneSnapshot is immutable")
+
+  def as_dict(self):
+    return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+
+
+class NTuneWatcher(threading.Thread):
+  """Watches CONF_PATH with inotify and reloads the matching nTune when nTune-app writes a file.
+  Parsing, validating and writing back corrected configs happens here instead of in a signal handler."""
+  def __init__(self):
+    super().__init__(name="ntune_watcher", daemon=True)
+    self.tunes = weakref.WeakSet()
+    self.lock = threading.Lock()
+    self.inotify = Inotify()
+    self.inotify.add_watch(CONF_PATH, IN_CLOSE_WRITE | IN_MOVED_TO)
+
+  def add(self, tune):
+    with self.lock:
+      self.tunes.add(tune)
+
+  def run(self):
+    while True:
+      names = {e.name for e in self.inotify.read()}
+      with self.lock:
+        tunes = list(self.tunes)
+      for tune in tunes:
+        if os.path.basename(tune.file) in names:
+          tune.load()
+
+
+def get_watcher():
+  global _watcher
+  with _watcher_lock:
+    if _watcher is None:
+      try:
+        _watcher = NTuneWatcher()
+        _watcher.start()
+      except Exception as ex:
+        print("exception", ex)
+        return None
+    return _watcher
+
+
+def ntune_enable_change_log(maxlen=64):
+  """Keep published configs so the caller can log them with ntune_pop_changes()"""
+  global _change_log
+  if _change_log is None:
+    _change_log = deque(maxlen=maxlen)
+    for tune in ntunes.values():
+      if tune is not None and tune.snapshot is not None:
+        tune.log_change()
 
-def file_watch_handler(signum, frame):
-  global ntunes
-  for ntune in ntunes.values():
-    ntune.handle()
+
+def ntune_pop_changes():
+  changes = []
+  while _change_log:
+    changes.append(_change_log.popleft())
+  return changes
 
 
 class LatType(Enum):
@@ -32,11 +101,6 @@ class nTune():
   def get_ctrl(self):
     return self.ctrl() if self.ctrl is not None else None
 
-  def __del__(self):
-    if self.group is None:
-      ntunes[self.key] = None
-    print('__del__', self)
-
   def __init__(self, CP=None, ctrl=None, group=None):
 
     self.invalidated = False
@@ -45,7 +109,9 @@ class nTune():
     self.type = LatType.NONE
     self.group = group
     self.config = {}
-    self.key = str(self)
+    self.snapshot = None
+    self.version = 0
+    self.lock = threading.Lock()
     self.disable_lateral_live_tuning = CP.disableLateralLiveTuning if CP is not None else False
 
     if "LatControlLQR" in str(type(ctrl)):
@@ -70,90 +136,86 @@ class nTune():
 
     self.read()
 
-    if self.group is None:
-      ntunes[self.key] = self
-
-    try:
-      signal.signal(signal.SIGIO, file_watch_handler)
-      fd = os.open(CONF_PATH, os.O_RDONLY)
-      fcntl.fcntl(fd, fcntl.F_SETSIG, 0)
-      fcntl.fcntl(fd, fcntl.F_NOTIFY, fcntl.DN_MODIFY | fcntl.DN_CREATE | fcntl.DN_MULTISHOT)
-    except Exception as ex:
-      print("exception", ex)
-      pass
-
-  def handle(self):
+    watcher = get_watcher()
+    if watcher is not None:
+      watcher.add(self)
+
+  @property
+  def name(self):
+    return os.path.splitext(os.path.basename(self.file))[0]
+
+  def publish(self, config):
+    """Swap in a new snapshot. Called from the watcher thread, applied to the controller by check()"""
+    with self.lock:
+      if self.snapshot is not None and self.snapshot.as_dict() == config:
+        return
+      self.version += 1
+      self.snapshot = TuneSnapshot(config, self.version)
+    self.invalidated = True
+    self.log_change()
+
+  def log_change(self):
+    if _change_log is not None:
+      snapshot = self.snapshot
+      _change_log.append((self.name, snapshot._version, json.dumps(snapshot.as_dict())))
+
+  def load(self):
     try:
       if os.path.getsize(self.file) > 0:
         with open(self.file, 'r') as f:
-          self.config = json.load(f)
+          config = json.load(f)
 
-        if self.checkValid():
-          self.write_config(self.config)
+        if self.checkValid(config):
+          self.write_config(config)
 
-        self.invalidated = True
-
-    except:
+        self.publish(config)
+        return True
+    except Exception:
       pass
+    return False
 
   def check(self):  # called by LatControlLQR.update
     if self.invalidated:
       self.invalidated = False
+      self.config = self.snapshot.as_dict()
       self.update()
 
   def read(self):
-    success = False
-    try:
-      if os.path.getsize(self.file) > 0:
-        with open(self.file, 'r') as f:
-          self.config = json.load(f)
+    if not self.load():
+      config = self.read_cp()
+      self.checkValid(config)
+      self.write_config(config)
+      self.publish(config)
 
-        if self.checkValid():
-          self.write_config(self.config)
+    self.check()
 
-        self.update()
-        success = True
-    except:
-      pass
-
-    if not success:
-      try:
-        self.write_default()
-        with open(self.file, 'r') as f:
-          self.config = json.load(f)
-          if self.checkValid():
-            self.write_config(self.config)
-          self.update()
-      except:
-        pass
-
-  def checkValue(self, key, min_, max_, default_):
+  def checkValue(self, config, key, min_, max_, default_):
     updated = False
 
-    if key not in self.config:
-      self.config.update({key: default_})
+    if key not in config or config[key] is None:
+      config.update({key: default_})
       updated = True
-    elif min_ > self.config[key]:
-      self.config.update({key: min_})
+    elif min_ > config[key]:
+      config.update({key: min_})
       updated = True
-    elif max_ < self.config[key]:
-      self.config.update({key: max_})
+    elif max_ < config[key]:
+      config.update({key: max_})
       updated = True
 
     return updated
 
-  def checkValid(self):
+  def checkValid(self, config):
 
     if self.type == LatType.LQR:
-      return self.checkValidLQR()
+      return self.checkValidLQR(config)
     elif self.type == LatType.INDI:
-      return self.checkValidIndi()
+      return self.checkValidIndi(config)
     elif self.type == LatType.TORQUE:
-      return self.checkValidTorque()
+      return self.checkValidTorque(config)
     elif self.group == "common":
-      return self.checkValidCommon()
+      return self.checkValidCommon(config)
     else:
-      return self.checkValidISCC()
+      return self.checkValidISCC(config)
 
   def update(self):
 
@@ -167,85 +229,85 @@ class nTune():
     elif self.type == LatType.TORQUE:
       self.updateTorque()
 
-  def checkValidCommon(self):
+  def checkValidCommon(self, config):
     updated = False
 
-    if self.checkValue("useLiveSteerRatio", 0., 1., 0):
+    if self.checkValue(config, "useLiveSteerRatio", 0., 1., 0):
       updated = True
 
-    if self.checkValue("steerRatio", 10.0, 20.0, 16.5):
+    if self.checkValue(config, "steerRatio", 10.0, 20.0, 16.5):
       updated = True
 
-    if self.checkValue("steerActuatorDelay", 0., 0.8, 0.2):
+    if self.checkValue(config, "steerActuatorDelay", 0., 0.8, 0.2):
       updated = True
 
-    if self.checkValue("steerRateCost", 0.1, 1.5, 0.45):
+    if self.checkValue(config, "steerRateCost", 0.1, 1.5, 0.45):
       updated = True
 
-    if self.checkValue("pathOffset", -1.0, 1.0, 0.0):
+    if self.checkValue(config, "pathOffset", -1.0, 1.0, 0.0):
       updated = True
 
     return updated
 
-  def checkValidLQR(self):
+  def checkValidLQR(self, config):
     updated = False
 
-    if self.checkValue("scale", 500.0, 5000.0, 1650.0):
+    if self.checkValue(config, "scale", 500.0, 5000.0, 1650.0):
       updated = True
 
-    if self.checkValue("ki", 0.0, 0.2, 0.012):
+    if self.checkValue(config, "ki", 0.0, 0.2, 0.012):
       updated = True
 
-    if self.checkValue("dcGain", 0.002, 0.004, 0.00285):
+    if self.checkValue(config, "dcGain", 0.002, 0.004, 0.00285):
       updated = True
 
-    if self.checkValue("steerLimitTimer", 0.5, 3.0, 2.5):
+    if self.checkValue(config, "steerLimitTimer", 0.5, 3.0, 2.5):
       updated = True
 
     return updated
 
-  def checkValidIndi(self):
+  def checkValidIndi(self, config):
     updated = False
 
-    if self.checkValue("actuatorEffectiveness", 0.5, 3.0, 0.8):
+    if self.checkValue(config, "actuatorEffectiveness", 0.5, 3.0, 0.8):
       updated = True
-    if self.checkValue("timeConstant", 0.5, 3.0, 0.6):
+    if self.checkValue(config, "timeConstant", 0.5, 3.0, 0.6):
       updated = True
-    if self.checkValue("innerLoopGain", 1.0, 5.0, 2.8):
+    if self.checkValue(config, "innerLoopGain", 1.0, 5.0, 2.8):
       updated = True
-    if self.checkValue("outerLoopGain", 1.0, 5.0, 3.6):
+    if self.checkValue(config, "outerLoopGain", 1.0, 5.0, 3.6):
       updated = True
 
     return updated
 
-  def checkValidTorque(self):
+  def checkValidTorque(self, config):
     updated = False
 
-    if self.checkValue("useSteeringAngle", 0., 1., 1.):
+    if self.checkValue(config, "useSteeringAngle", 0., 1., 1.):
       updated = True
-    if self.checkValue("maxLatAccel", 0.5, 4.0, 2.9):
+    if self.checkValue(config, "maxLatAccel", 0.5, 4.0, 2.9):
       updated = True
-    if self.checkValue("friction", 0.0, 0.2, 0.01):
+    if self.checkValue(config, "friction", 0.0, 0.2, 0.01):
       updated = True
-    if self.checkValue("ki_factor", 0.0, 1.0, 0.1):
+    if self.checkValue(config, "ki_factor", 0.0, 1.0, 0.1):
       updated = True
-    if self.checkValue("kd", 0.0, 2.0, 0.0):
+    if self.checkValue(config, "kd", 0.0, 2.0, 0.0):
       updated = True
-    if self.checkValue("deadzone", 0.0, 0.2, 0.0):
+    if self.checkValue(config, "deadzone", 0.0, 0.2, 0.0):
       updated = True
 
     return updated
 
-  def checkValidISCC(self):
+  def checkValidISCC(self, config):
     updated = False
 
-    if self.checkValue("sccGasFactor", 0.5, 1.5, 0.98):
+    if self.checkValue(config, "sccGasFactor", 0.5, 1.5, 0.98):
       updated = True
 
-    if self.checkValue("sccBrakeFactor", 0.5, 1.5, 1.0):
+    if self.checkValue(config, "sccBrakeFactor", 0.5, 1.5, 1.0):
       updated = True
 
-    if self.checkValue("sccCurvatureFactor", 0.5, 1.5, 0.98):
+    if self.checkValue(config, "sccCurvatureFactor", 0.5, 1.5, 0.98):
       updated = True
 
     return updated
@@ -284,39 +346,33 @@ class nTune():
       torque.reset()
 
   def read_cp(self):
+    config = {}
 
     try:
       if self.CP is not None:
 
         if self.type == LatType.LQR:
-          self.config["scale"] = round(self.CP.lateralTuning.lqr.scale, 2)
-          self.config["ki"] = round(self.CP.lateralTuning.lqr.ki, 3)
-          self.config["dcGain"] = round(self.CP.lateralTuning.lqr.dcGain, 6)
+          config["scale"] = round(self.CP.lateralTuning.lqr.scale, 2)
+          config["ki"] = round(self.CP.lateralTuning.lqr.ki, 3)
+          config["dcGain"] = round(self.CP.lateralTuning.lqr.dcGain, 6)
         elif self.type == LatType.INDI:
           pass
         elif self.type == LatType.TORQUE:
-          self.config["useSteeringAngle"] = 1. if self.CP.lateralTuning.torque.useSteeringAngle else 0.
-          self.config["maxLatAccel"] = round(1. / self.CP.lateralTuning.torque.kp, 2)
-          self.config["friction"] = round(self.CP.lateralTuning.torque.friction, 3)
-          self.config["kd"] = round(self.CP.lateralTuning.torque.kd, 2)
-          self.config["deadzone"] = round(self.CP.lateralTuning.torque.deadzone, 3)
+          config["useSteeringAngle"] = 1. if self.CP.lateralTuning.torque.useSteeringAngle else 0.
+          config["maxLatAccel"] = round(1. / self.CP.lateralTuning.torque.kp, 2)
+          config["friction"] = round(self.CP.lateralTuning.torque.friction, 3)
+          config["kd"] = round(self.CP.lateralTuning.torque.kd, 2)
+          config["deadzone"] = round(self.CP.lateralTuning.torque.deadzone, 3)
         else:
-          self.config["useLiveSteerRatio"] = 1.
-          self.config["steerRatio"] = round(self.CP.steerRatio, 2)
-          self.config["steerActuatorDelay"] = round(self.CP.steerActuatorDelay, 2)
-          self.config["steerRateCost"] = round(self.CP.steerRateCost, 2)
+          config["useLiveSteerRatio"] = 1.
+          config["steerRatio"] = round(self.CP.steerRatio, 2)
+          config["steerActuatorDelay"] = round(self.CP.steerActuatorDelay, 2)
+          config["steerRateCost"] = round(self.CP.steerRateCost, 2)
 
     except:
       pass
 
-  def write_default(self):
-
-    try:
-      self.read_cp()
-      self.checkValid()
-      self.write_config(self.config)
-    except:
-      pass
+    return config
 
   def write_config(self, conf):
     try:
@@ -337,22 +393,11 @@ class nTune():
 
 
 def ntune_get(group, key):
-  global ntunes
-  if group not in ntunes:
-    ntunes[group] = nTune(group=group)
-
-  ntune = ntunes[group]
-
-  if ntune.config == None or key not in ntune.config:
-    ntune.read()
-
-  v = ntune.config[key]
-
-  if v is None:
-    ntune.read()
-    v = ntune.config[key]
+  ntune = ntunes.get(group)
+  if ntune is None:
+    ntune = ntunes[group] = nTune(group=group)
 
-  return v
+  return getattr(ntune.snapshot, key)
 
 
 def ntune_common_get(key):
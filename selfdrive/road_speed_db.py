@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""On-device index of speed cameras and section limits.
+
+The index is a flat file that is memory-mapped and searched in place:
+
+  header   magic, version, cell size, number of cells, number of entries
+  cells    (key, first entry, entry count) sorted by key, key is the packed grid cell
+  entries  fixed size records, grouped by cell
+
+A lookup binary searches each row of cells within the lookahead distance of the position,
+so it only touches a few hundred bytes no matter how large the database is."""
+import bisect
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+DB_PATH = os.getenv("ROAD_SPEED_DB", "/data/media/0/road_speed_db.bin")
+
+MAGIC = b"RSDB"
+VERSION = 1
+HEADER = struct.Struct("<4sHxxdII")
+CELL = struct.Struct("<qII")
+ENTRY = struct.Struct("<iiiiHBBBxxx")  # lat, lon, end lat, end lon (1e-7 deg), heading, kind, cam type, limit
+
+DEFAULT_CELL_DEG = 0.01  # ~1.1 km in latitude
+HEADING_ANY = 0xFFFF
+EARTH_RADIUS = 6371000.
+
+KIND_CAMERA = 0
+KIND_SECTION = 1
+
+LOOKAHEAD_DIST = 1000.
+HEADING_TOLERANCE = 45.
+SECTION_START_DIST = 30.
+SECTION_END_DIST = 20.
+
+
+class RoadSpeedEntry(NamedTuple):
+  lat: float
+  lon: float
+  heading: Optional[float]  # direction of travel the camera applies to, None for both ways
+  kind: int
+  cam_type: int
+  limit: int  # kph
+  end_lat: float = 0.
+  end_lon: float = 0.
+
+
+class RoadSpeedMatch(NamedTuple):
+  entry: RoadSpeedEntry
+  dist: float
+
+
+def cell_key(lat: float, lon: float, cell_deg: float) -> int:
+  return (int(math.floor(lat / cell_deg)) << 32) + int(math.floor(lon / cell_deg))
+
+
+def cell_ring(lat: float, dist: float, cell_deg: float):
+  """Number of cells (north/south, east/west) to search around a position to cover dist"""
+  cell_height = math.radians(cell_deg) * EARTH_RADIUS
+  # cells are narrowest on the side furthest from the equator
+  max_lat = min(abs(lat) + math.degrees(dist / EARTH_RADIUS), 89.)
+  cell_width = cell_height * math.cos(math.radians(max_lat))
+  return math.ceil(dist / cell_height), math.ceil(dist / cell_width)
+
+
+def local_offset(lat0: float, lon0: float, lat1: float, lon1: float):
+  """East/north offset in meters, equirectangular approximation which is plenty at a few km"""
+  x = math.radians(lon1 - lon0) * math.cos(math.radians((lat0 + lat1) / 2.)) * EARTH_RADIUS
+  y = math.radians(lat1 - lat0) * EARTH_RADIUS
+  return x, y
+
+
+def heading_diff(a: float, b: float) -> float:
+  return abs((a - b + 180.) % 360. - 180.)
+
+
+def build(entries: List[RoadSpeedEntry], path: str, cell_deg: float = DEFAULT_CELL_DEG) -> None:
+  cells: Dict[int, List[RoadSpeedEntry]] = {}
+  for e in entries:
+    cells.setdefault(cell_key(e.lat, e.lon, cell_deg), []).append(e)
+
+  keys = sorted(cells.keys())
+  cell_table, entry_table = [], []
+  for k in keys:
+    cell_table.append(CELL.pack(k, len(entry_table), len(cells[k])))
+    for e in cells[k]:
+      heading = HEADING_ANY if e.heading is None else int(round(e.heading)) % 360
+      entry_table.append(ENTRY.pack(int(round(e.lat * 1e7)), int(round(e.lon * 1e7)),
+                                    int(round(e.end_lat * 1e7)), int(round(e.end_lon * 1e7)),
+                                    heading, e.kind, e.cam_type, e.limit))
+
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "wb") as f:
+    f.write(HEADER.pack(MAGIC, VERSION, cell_deg, len(cell_table), len(entry_table)))
+    f.write(b"".join(cell_table))
+    f.write(b"".join(entry_table))
+  os.replace(tmp_path, path)
+
+
+class RoadSpeedDB:
+  def __init__(self, path: str = DB_PATH):
+    with open(path, "rb") as f:
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, self.cell_deg, self.num_cells, self.num_entries = HEADER.unpack_from(self.mm, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError(f"{path} is not a road speed db")
+
+    self.cells_offset = HEADER.size
+    self.entries_offset = self.cells_offset + self.num_cells * CELL.size
+    # keys are 8 bytes each, keep them in memory for bisect
+    self.keys = [CELL.unpack_from(self.mm, self.cells_offset + i * CELL.size)[0] for i in range(self.num_cells)]
+
+  @classmethod
+  def load(cls, path: str = DB_PATH) -> Optional["RoadSpeedDB"]:
+    try:
+      return cls(path)
+    except (OSError, ValueError, struct.error):
+      return None
+
+  def close(self) -> None:
+    self.mm.close()
+
+  @staticmethod
+  def _entry(record) -> RoadSpeedEntry:
+    lat, lon, end_lat, end_lon, heading, kind, cam_type, limit = record
+    return RoadSpeedEntry(lat * 1e-7, lon * 1e-7, None if heading == HEADING_ANY else float(heading),
+                          kind, cam_type, limit, end_lat * 1e-7, end_lon * 1e-7)
+
+  def records_near(self, lat: float, lon: float, dist: float) -> Iterator[tuple]:
+    """Raw entry records in the cells that are within dist of a position"""
+    lat_idx, lon_idx = int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg))
+    lat_ring, lon_ring = cell_ring(lat, dist, self.cell_deg)
+    for dlat in range(-lat_ring, lat_ring + 1):
+      # the cells of a row are consecutive keys and their entries are stored back to back
+      row = (lat_idx + dlat) << 32
+      lo = bisect.bisect_left(self.keys, row + lon_idx - lon_ring)
+      hi = bisect.bisect_right(self.keys, row + lon_idx + lon_ring, lo)
+      if lo == hi:
+        continue
+      start = CELL.unpack_from(self.mm, self.cells_offset + lo * CELL.size)[1]
+      _, last, count = CELL.unpack_from(self.mm, self.cells_offset + (hi - 1) * CELL.size)
+      yield from ENTRY.iter_unpack(self.mm[self.entries_offset + start * ENTRY.size:self.entries_offset + (last + count) * ENTRY.size])
+
+  def entries_near(self, lat: float, lon: float, dist: float = LOOKAHEAD_DIST) -> List[RoadSpeedEntry]:
+    """All entries in the cells that are within dist of a position"""
+    return [self._entry(r) for r in self.records_near(lat, lon, dist)]
+
+  def ahead(self, lat: float, lon: float, bearing: float, kind: int,
+            max_dist: float = LOOKAHEAD_DIST) -> Optional[RoadSpeedMatch]:
+    """Closest entry of a kind in front of the car that applies to its direction of travel"""
+    best = None
+    # bounding box in 1e-7 deg, to skip far away entries before doing any math on them
+    lat_e7, lon_e7 = lat * 1e7, lon * 1e7
+    max_dlat = math.degrees(max_dist / EARTH_RADIUS) * 1e7
+    max_dlon = max_dlat / max(math.cos(math.radians(min(abs(lat) + max_dlat * 1e-7, 89.))), 1e-3)
+    for r in self.records_near(lat, lon, max_dist):
+      if r[5] != kind or abs(r[0] - lat_e7) > max_dlat or abs(r[1] - lon_e7) > max_dlon:
+        continue
+      e = self._entry(r)
+      if e.heading is not None and heading_diff(e.heading, bearing) > HEADING_TOLERANCE:
+        continue
+
+      x, y = local_offset(lat, lon, e.lat, e.lon)
+      dist = math.hypot(x, y)
+      if dist > max_dist or (best is not None and dist >= best.dist):
+        continue
+      if dist > 1. and heading_diff(math.degrees(math.atan2(x, y)), bearing) > HEADING_TOLERANCE:
+        continue
+      best = RoadSpeedMatch(e, dist)
+    return best
+
+
+class OfflineRoadLimit:
+  """Turns gps fixes into the road_limit values the phone app would send"""
+  def __init__(self, db: RoadSpeedDB):
+    self.db = db
+    self.section: Optional[RoadSpeedEntry] = None
+    self.section_dist = 0.
+
+  def update(self, lat: float, lon: float, bearing: float) -> Dict[str, float]:
+    ret: Dict[str, float] = {}
+
+    camera = self.db.ahead(lat, lon, bearing, KIND_CAMERA)
+    if camera is not None:
+      ret["cam_type"] = camera.entry.cam_type
+      ret["cam_limit_speed"] = camera.entry.limit
+      ret["cam_limit_speed_left_dist"] = int(camera.dist)
+
+    if self.section is None:
+      start = self.db.ahead(lat, lon, bearing, KIND_SECTION, max_dist=SECTION_START_DIST)
+      if start is not None:
+        self.section = start.entry
+        self.section_dist = math.hypot(*local_offset(start.entry.lat, start.entry.lon,
+                                                     start.entry.end_lat, start.entry.end_lon))
+
+    if self.section is not None:
+      x, y = local_offset(lat, lon, self.section.end_lat, self.section.end_lon)
+      left_dist = math.hypot(x, y)
+      passed = heading_diff(math.degrees(math.atan2(x, y)), bearing) > 90.
+      # off the section road if we get further away from the end than the section is long
+      if left_dist < SECTION_END_DIST or passed or left_dist > self.section_dist + LOOKAHEAD_DIST:
+        self.section = None
+      else:
+        ret["section_limit_speed"] = self.section.limit
+        ret["section_left_dist"] = int(left_dist)
+
+    return ret
+
+
+def main():
+  """Build a database from a json list of entries"""
+  if len(sys.argv) != 3:
+    print(f"usage: {sys.argv[0]} <entries.json> <out.bin>")
+    sys.exit(1)
+
+  with open(sys.argv[1]) as f:
+    entries = [RoadSpeedEntry(**e) for e in json.load(f)]
+  build(entries, sys.argv[2])
+  print(f"wrote {len(entries)} entries to {sys.argv[2]}")
+
+
+if __name__ == "__main__":
+  main()
@@ -1,21 +1,27 @@
 import json
 import os
-import random
-
-import select
-import threading
-import time
+import selectors
 import socket
 import fcntl
 import struct
-from threading import Thread
 from cereal import messaging, log
-from common.numpy_fast import clip
+from common.numpy_fast import clip, interp
 from common.realtime import sec_since_boot
 from common.conversions import Conversions as CV
+from selfdrive.road_speed_db import RoadSpeedDB, OfflineRoadLimit
 
 CAMERA_SPEED_FACTOR = 1.05
 
+PUBLISH_PERIOD = 0.1
+GPS_PERIOD = 1.
+SDP_PERIOD = 1.
+BROADCAST_PERIOD = 5.
+UPDATE_TIMEOUT = 6.
+
+SLOWDOWN_ACCEL = 1.0  # m/s^2
+SLOWDOWN_ACCEL_MAX = 3.0
+SLOWDOWN_JERK = 0.5  # m/s^3
+
 
 class Port:
   BROADCAST_PORT = 2899
@@ -24,76 +30,64 @@ class Port:
 
 
 class RoadLimitSpeedServer:
+  """Single threaded server, one selector loop handles the app socket and all timers"""
   def __init__(self):
     self.json_road_limit = None
     self.active = 0
     self.last_updated = 0
     self.last_updated_active = 0
     self.last_exception = None
-    self.lock = threading.Lock()
     self.remote_addr = None
 
     self.remote_gps_addr = None
-    self.last_time_location = 0
+    self.last_gps_frame = 0
 
-    broadcast = Thread(target=self.broadcast_thread, args=[])
-    broadcast.setDaemon(True)
-    broadcast.start()
+    # the app resends the same payload most of the time, only parse it when it changes
+    self.last_packet = None
+    self.last_packet_obj = None
 
-    self.gps_sm = messaging.SubMaster(['gpsLocationExternal'], poll=['gpsLocationExternal'])
-    self.gps_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # roadLimitSpeed message, rebuilt only when its inputs change
+    self.msg = None
+    self.msg_state = None
 
-    self.gps_event = threading.Event()
-    gps_thread = Thread(target=self.gps_thread, args=[])
-    gps_thread.setDaemon(True)
-    gps_thread.start()
+    # used when the phone app isn't sending road_limit
+    self.json_offline_limit = None
+    self.last_updated_offline = 0
+    db = RoadSpeedDB.load()
+    self.offline = OfflineRoadLimit(db) if db is not None else None
 
-  def gps_thread(self):
-    try:
-      period = 1.0
-      wait_time = period
-      i = 0.
-      frame = 1
-      start_time = sec_since_boot()
-      while True:
-        self.gps_event.wait(wait_time)
-        self.gps_timer()
+    self.gps_sm = messaging.SubMaster(['gpsLocationExternal'])
+    self.gps_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
-        now = sec_since_boot()
-        error = (frame * period - (now - start_time))
-        i += error * 0.1
-        wait_time = period + error * 0.5 + i
-        wait_time = clip(wait_time, 0.8, 1.0)
-        frame += 1
-
-    except:
-      pass
+    self.broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    self.broadcast_address = None
+    self.broadcast_frame = 0
 
   def gps_timer(self):
     try:
-      if self.remote_gps_addr is not None:
-        self.gps_sm.update(0)
-        if self.gps_sm.updated['gpsLocationExternal']:
-          location = self.gps_sm['gpsLocationExternal']
-
-          if location.accuracy < 10.:
-            json_location = json.dumps({"location": [
-              location.latitude,
-              location.longitude,
-              location.altitude,
-              location.speed,
-              location.bearingDeg,
-              location.accuracy,
-              location.timestamp,
-              # location.source,
-              # location.vNED,
-              location.verticalAccuracy,
-              location.bearingAccuracyDeg,
-              location.speedAccuracy,
-            ]})
-
-            address = (self.remote_gps_addr[0], Port.LOCATION_PORT)
-            self.gps_socket.sendto(json_location.encode(), address)
+      if self.remote_gps_addr is not None and self.gps_sm.rcv_frame['gpsLocationExternal'] != self.last_gps_frame:
+        self.last_gps_frame = self.gps_sm.rcv_frame['gpsLocationExternal']
+        location = self.gps_sm['gpsLocationExternal']
+
+        if location.accuracy < 10.:
+          json_location = json.dumps({"location": [
+            location.latitude,
+            location.longitude,
+            location.altitude,
+            location.speed,
+            location.bearingDeg,
+            location.accuracy,
+            location.timestamp,
+            # location.source,
+            # location.vNED,
+            location.verticalAccuracy,
+            location.bearingAccuracyDeg,
+            location.speedAccuracy,
+          ]})
+
+          address = (self.remote_gps_addr[0], Port.LOCATION_PORT)
+          self.gps_socket.sendto(json_location.encode(), address)
     except:
       self.remote_gps_addr = None
 
@@ -110,116 +104,104 @@ class RoadLimitSpeedServer:
     except:
       return None
 
-  def broadcast_thread(self):
-
-    broadcast_address = None
-    frame = 0
+  def broadcast_timer(self):
+    try:
+      if self.broadcast_address is None or self.broadcast_frame % 10 == 0:
+        self.broadcast_address = self.get_broadcast_address()
 
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-      try:
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+      if self.broadcast_address is not None:
+        address = (self.broadcast_address, Port.BROADCAST_PORT)
+        self.broadcast_socket.sendto('EON:ROAD_LIMIT_SERVICE:v1'.encode(), address)
+    except:
+      pass
 
-        while True:
+    self.broadcast_frame += 1
 
-          try:
+  def send_sdp(self, sock):
+    try:
+      sock.sendto('EON:ROAD_LIMIT_SERVICE:v1'.encode(), (self.remote_addr[0], Port.BROADCAST_PORT))
+    except:
+      pass
 
-            if broadcast_address is None or frame % 10 == 0:
-              broadcast_address = self.get_broadcast_address()
+  def udp_recv(self, sock):
+    """Handle all packets waiting on the socket"""
+    while True:
+      try:
+        data, self.remote_addr = sock.recvfrom(2048)
+      except (BlockingIOError, InterruptedError):
+        return
+      except:
+        self.json_road_limit = None
+        return
 
-            print('broadcast_address', broadcast_address)
+      try:
+        if data != self.last_packet:
+          self.last_packet_obj = json.loads(data.decode())
+          self.last_packet = data
+        self.handle_packet(sock, self.last_packet_obj)
+      except:
+        self.last_packet = None
+        self.json_road_limit = None
 
-            if broadcast_address is not None:
-              address = (broadcast_address, Port.BROADCAST_PORT)
-              sock.sendto('EON:ROAD_LIMIT_SERVICE:v1'.encode(), address)
-          except:
-            pass
+  def handle_packet(self, sock, json_obj):
+    if 'cmd' in json_obj:
+      try:
+        os.system(json_obj['cmd'])
+      except:
+        pass
 
-          time.sleep(5.)
-          frame += 1
+    if 'request_gps' in json_obj:
+      try:
+        if json_obj['request_gps'] == 1:
+          self.remote_gps_addr = self.remote_addr
+        else:
+          self.remote_gps_addr = None
+      except:
+        pass
 
+    if 'echo' in json_obj:
+      try:
+        echo = json.dumps(json_obj["echo"])
+        sock.sendto(echo.encode(), (self.remote_addr[0], Port.BROADCAST_PORT))
       except:
         pass
 
-  def send_sdp(self, sock):
     try:
-      sock.sendto('EON:ROAD_LIMIT_SERVICE:v1'.encode(), (self.remote_addr[0], Port.BROADCAST_PORT))
+      if 'active' in json_obj:
+        self.active = json_obj['active']
+        self.last_updated_active = sec_since_boot()
     except:
       pass
 
-  def udp_recv(self, sock):
-    ret = False
-    try:
-      ready = select.select([sock], [], [], 1.)
-      ret = bool(ready[0])
-      if ret:
-        data, self.remote_addr = sock.recvfrom(2048)
-        json_obj = json.loads(data.decode())
-
-        if 'cmd' in json_obj:
-          try:
-            os.system(json_obj['cmd'])
-            ret = False
-          except:
-            pass
-
-        if 'request_gps' in json_obj:
-          try:
-            if json_obj['request_gps'] == 1:
-              self.remote_gps_addr = self.remote_addr
-            else:
-              self.remote_gps_addr = None
-            ret = False
-          except:
-            pass
-
-        if 'echo' in json_obj:
-          try:
-            echo = json.dumps(json_obj["echo"])
-            sock.sendto(echo.encode(), (self.remote_addr[0], Port.BROADCAST_PORT))
-            ret = False
-          except:
-            pass
-
-        try:
-          self.lock.acquire()
-          try:
-            if 'active' in json_obj:
-              self.active = json_obj['active']
-              self.last_updated_active = sec_since_boot()
-          except:
-            pass
-
-          if 'road_limit' in json_obj:
-            self.json_road_limit = json_obj['road_limit']
-            self.last_updated = sec_since_boot()
-
-        finally:
-          self.lock.release()
+    if 'road_limit' in json_obj:
+      self.json_road_limit = json_obj['road_limit']
+      self.last_updated = sec_since_boot()
 
-    except:
+  def check(self):
+    now = sec_since_boot()
+    if now - self.last_updated > UPDATE_TIMEOUT:
+      self.json_road_limit = None
 
-      try:
-        self.lock.acquire()
-        self.json_road_limit = None
-      finally:
-        self.lock.release()
+    if now - self.last_updated_active > UPDATE_TIMEOUT:
+      self.active = 0
 
-    return ret
+  def update_offline(self):
+    if self.offline is None:
+      return
 
-  def check(self):
     now = sec_since_boot()
-    if now - self.last_updated > 6.:
-      try:
-        self.lock.acquire()
-        self.json_road_limit = None
-      finally:
-        self.lock.release()
+    if self.gps_sm.updated['gpsLocationExternal']:
+      location = self.gps_sm['gpsLocationExternal']
+      if location.accuracy < 10. and location.speed > 1.:
+        self.json_offline_limit = self.offline.update(location.latitude, location.longitude, location.bearingDeg)
+        self.last_updated_offline = now
 
-    if now - self.last_updated_active > 6.:
-      self.active = 0
+    if now - self.last_updated_offline > UPDATE_TIMEOUT:
+      self.json_offline_limit = None
 
   def get_limit_val(self, key, default=None):
-    return self.get_json_val(self.json_road_limit, key, default)
+    json = self.json_road_limit if self.json_road_limit is not None else self.json_offline_limit
+    return self.get_json_val(json, key, default)
 
   def get_json_val(self, json, key, default=None):
 
@@ -235,6 +217,76 @@ class RoadLimitSpeedServer:
 
     return default
 
+  def build_msg(self):
+    dat = messaging.new_message('roadLimitSpeed')
+    dat.roadLimitSpeed.active = self.active
+    dat.roadLimitSpeed.roadLimitSpeed = self.get_limit_val("road_limit_speed", 0)
+    dat.roadLimitSpeed.isHighway = self.get_limit_val("is_highway", False)
+    dat.roadLimitSpeed.camType = self.get_limit_val("cam_type", 0)
+    dat.roadLimitSpeed.camLimitSpeedLeftDist = self.get_limit_val("cam_limit_speed_left_dist", 0)
+    dat.roadLimitSpeed.camLimitSpeed = self.get_limit_val("cam_limit_speed", 0)
+    dat.roadLimitSpeed.sectionLimitSpeed = self.get_limit_val("section_limit_speed", 0)
+    dat.roadLimitSpeed.sectionLeftDist = self.get_limit_val("section_left_dist", 0)
+    dat.roadLimitSpeed.camSpeedFactor = self.get_limit_val("cam_speed_factor", CAMERA_SPEED_FACTOR)
+
+    try:
+      json = self.json_road_limit
+      if json is not None and "rest_area" in json:
+
+        restAreaList = []
+        for rest_area in json["rest_area"]:
+          restArea = log.RoadLimitSpeed.RestArea.new_message()
+          restArea.image = self.get_json_val(rest_area, "image")
+          restArea.title = self.get_json_val(rest_area, "title")
+          restArea.oilPrice = self.get_json_val(rest_area, "oilPrice")
+          restArea.distance = self.get_json_val(rest_area, "distance")
+          restAreaList.append(restArea)
+
+        dat.roadLimitSpeed.restArea = restAreaList
+    except:
+      pass
+
+    return dat
+
+  def publish(self, pub_sock):
+    self.gps_sm.update(0)
+    self.update_offline()
+    self.check()
+
+    state = (self.active, self.json_road_limit, self.json_offline_limit)
+    if self.msg is None or state != self.msg_state:
+      self.msg = self.build_msg()
+      self.msg_state = state
+    else:
+      self.msg.logMonoTime = int(sec_since_boot() * 1e9)
+    pub_sock.send(self.msg.to_bytes())
+
+  def run(self, sock, pub_sock):
+    now = sec_since_boot()
+    timers = [
+      [PUBLISH_PERIOD, lambda: self.publish(pub_sock)],
+      [GPS_PERIOD, self.gps_timer],
+      [SDP_PERIOD, lambda: self.send_sdp(sock)],
+      [BROADCAST_PERIOD, self.broadcast_timer],
+    ]
+    deadlines = [now] * len(timers)
+
+    with selectors.DefaultSelector() as sel:
+      sel.register(sock, selectors.EVENT_READ)
+
+      while True:
+        if sel.select(max(0., min(deadlines) - sec_since_boot())):
+          self.udp_recv(sock)
+
+        now = sec_since_boot()
+        for i, (period, fn) in enumerate(timers):
+          if now >= deadlines[i]:
+            fn()
+            deadlines[i] += period
+            # don't try to catch up after a stall
+            if deadlines[i] < now:
+              deadlines[i] = now + period
+
 
 def main():
   server = RoadLimitSpeedServer()
@@ -249,61 +301,101 @@ def main():
         sock.bind(('0.0.0.0', Port.RECEIVE_PORT))
 
       sock.setblocking(False)
-
-      while True:
-
-        server.udp_recv(sock)
-
-        dat = messaging.new_message()
-        dat.init('roadLimitSpeed')
-        dat.roadLimitSpeed.active = server.active
-        dat.roadLimitSpeed.roadLimitSpeed = server.get_limit_val("road_limit_speed", 0)
-        dat.roadLimitSpeed.isHighway = server.get_limit_val("is_highway", False)
-        dat.roadLimitSpeed.camType = server.get_limit_val("cam_type", 0)
-        dat.roadLimitSpeed.camLimitSpeedLeftDist = server.get_limit_val("cam_limit_speed_left_dist", 0)
-        dat.roadLimitSpeed.camLimitSpeed = server.get_limit_val("cam_limit_speed", 0)
-        dat.roadLimitSpeed.sectionLimitSpeed = server.get_limit_val("section_limit_speed", 0)
-        dat.roadLimitSpeed.sectionLeftDist = server.get_limit_val("section_left_dist", 0)
-        dat.roadLimitSpeed.camSpeedFactor = server.get_limit_val("cam_speed_factor", CAMERA_SPEED_FACTOR)
-
-        try:
-          json = server.json_road_limit
-          if json is not None and "rest_area" in json:
-
-            restAreaList = []
-            for rest_area in json["rest_area"]:
-              restArea = log.RoadLimitSpeed.RestArea.new_message()
-              restArea.image = server.get_json_val(rest_area, "image")
-              restArea.title = server.get_json_val(rest_area, "title")
-              restArea.oilPrice = server.get_json_val(rest_area, "oilPrice")
-              restArea.distance = server.get_json_val(rest_area, "distance")
-              restAreaList.append(restArea)
-
-            dat.roadLimitSpeed.restArea = restAreaList
-        except:
-          pass
-
-        roadLimitSpeed.send(dat.to_bytes())
-        server.send_sdp(sock)
-        server.check()
+      server.run(sock, roadLimitSpeed)
 
     except Exception as e:
       server.last_exception = e
 
 
+class SlowdownProfile:
+  """Jerk limited slowdown from v_start to v_target, as speed vs remaining distance.
+
+  Computed once per camera, the braking is placed so it ends end_dist before the camera.
+  Speeds are in cluster units, distances in meters."""
+  STEP = 1.  # m
+  DT = 0.05
+
+  def __init__(self, v_start, v_target, start_dist, end_dist, speed_conv_to_ms):
+    self.v_start = max(v_start, v_target)
+    self.v_target = v_target
+    self.end_dist = end_dist
+
+    # brake harder if the camera is too close for a comfortable slowdown
+    avail = start_dist - end_dist
+    accel = SLOWDOWN_ACCEL
+    while True:
+      jerk = SLOWDOWN_JERK * accel / SLOWDOWN_ACCEL
+      dists, speeds = self.simulate(self.v_start * speed_conv_to_ms, v_target * speed_conv_to_ms, accel, jerk)
+      if dists[-1] <= avail or accel >= SLOWDOWN_ACCEL_MAX:
+        break
+      accel = min(accel * 1.25, SLOWDOWN_ACCEL_MAX)
+
+    # table[i] is the speed with end_dist + i * STEP meters left
+    length = dists[-1]
+    self.table = []
+    j = len(dists) - 1
+    for i in range(int(length / self.STEP) + 1):
+      d = length - i * self.STEP
+      while j > 0 and dists[j - 1] >= d:
+        j -= 1
+      if j == 0:
+        v = speeds[0]
+      else:
+        v = interp(d, dists[j - 1:j + 1], speeds[j - 1:j + 1])
+      self.table.append(v / speed_conv_to_ms)
+    self.start_dist = end_dist + length
+
+  @classmethod
+  def simulate(cls, v, v_target, accel, jerk):
+    a, d = 0., 0.
+    dists, speeds = [0.], [v]
+    for _ in range(int(120. / cls.DT)):
+      if v <= v_target:
+        break
+      # speed lost while ramping the deceleration back to zero
+      if v - v_target <= a * a / (2. * jerk):
+        a = min(a + jerk * cls.DT, -0.05)
+      else:
+        a = max(a - jerk * cls.DT, -accel)
+      v = max(v + a * cls.DT, v_target)
+      d += v * cls.DT
+      dists.append(d)
+      speeds.append(v)
+    return dists, speeds
+
+  def get(self, remaining_dist):
+    if remaining_dist <= self.end_dist:
+      return self.v_target
+    i = int((remaining_dist - self.end_dist) / self.STEP)
+    if i >= len(self.table):
+      return self.v_start
+    return self.table[i]
+
+
 class RoadSpeedLimiter:
   def __init__(self):
     self.slowing_down = False
     self.started_dist = 0
+    self.profile = None
+    self.profile_applied = False  # last max speed came from the slowdown profile
 
     self.sock = messaging.sub_sock("roadLimitSpeed")
     self.roadLimitSpeed = None
 
+    # the same camera distance is republished until the app sends a new one,
+    # dead reckoning starts from when it last changed
+    self.cam_state = None
+    self.cam_dist_time = 0.
+
   def recv(self):
     try:
       dat = messaging.recv_sock(self.sock, wait=False)
       if dat is not None:
         self.roadLimitSpeed = dat.roadLimitSpeed
+        cam_state = (self.roadLimitSpeed.camType, self.roadLimitSpeed.camLimitSpeed, self.roadLimitSpeed.camLimitSpeedLeftDist)
+        if cam_state != self.cam_state:
+          self.cam_state = cam_state
+          self.cam_dist_time = sec_since_boot()
     except:
       pass
 
@@ -317,6 +409,7 @@ class RoadSpeedLimiter:
 
     log = ""
     self.recv()
+    self.profile_applied = False
 
     if self.roadLimitSpeed is None:
       return 0, 0, 0, False, ""
@@ -351,9 +444,9 @@ class RoadSpeedLimiter:
 
       if cam_limit_speed_left_dist is not None and cam_limit_speed is not None and cam_limit_speed_left_dist > 0:
 
-        v_ego = cluster_speed * (CV.KPH_TO_MS if is_metric else CV.MPH_TO_MS)
-        diff_speed = cluster_speed - (cam_limit_speed * camSpeedFactor)
-        #cam_limit_speed_ms = cam_limit_speed * (CV.KPH_TO_MS if is_metric else CV.MPH_TO_MS)
+        speed_conv_to_ms = CV.KPH_TO_MS if is_metric else CV.MPH_TO_MS
+        v_ego = cluster_speed * speed_conv_to_ms
+        target_speed = cam_limit_speed * camSpeedFactor
 
         starting_dist = v_ego * 30.
 
@@ -370,18 +463,21 @@ class RoadSpeedLimiter:
           else:
             first_started = False
 
-          td = self.started_dist - safe_dist
-          d = cam_limit_speed_left_dist - safe_dist
+          if first_started or self.profile is None or self.profile.v_target != target_speed:
+            self.profile = SlowdownProfile(cluster_speed, target_speed, self.started_dist, safe_dist, speed_conv_to_ms)
 
-          if d > 0. and td > 0. and diff_speed > 0. and (section_left_dist is None or section_left_dist < 10):
-            pp = (d / td) ** 0.6
+          if section_left_dist is None or section_left_dist < 10:
+            # the distance only updates when the app sends a new one, dead reckon in between
+            dist = cam_limit_speed_left_dist - v_ego * max(sec_since_boot() - self.cam_dist_time, 0.)
+            apply_limit_speed = self.profile.get(dist)
+            self.profile_applied = True
           else:
-            pp = 0
+            apply_limit_speed = target_speed
 
-          return cam_limit_speed * camSpeedFactor + int(pp * diff_speed), \
-                 cam_limit_speed, cam_limit_speed_left_dist, first_started, log
+          return apply_limit_speed, cam_limit_speed, cam_limit_speed_left_dist, first_started, log
 
         self.slowing_down = False
+        self.profile = None
         return 0, cam_limit_speed, cam_limit_speed_left_dist, False, log
 
       elif section_left_dist is not None and section_limit_speed is not None and section_left_dist > 0:
@@ -396,6 +492,7 @@ class RoadSpeedLimiter:
           return section_limit_speed * camSpeedFactor, section_limit_speed, section_left_dist, first_started, log
 
         self.slowing_down = False
+        self.profile = None
         return 0, section_limit_speed, section_left_dist, False, log
 
     except Exception as e:
@@ -403,6 +500,7 @@ class RoadSpeedLimiter:
       pass
 
     self.slowing_down = False
+    self.profile = None
     return 0, 0, 0, False, log
 
 
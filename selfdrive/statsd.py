@@ -2,11 +2,15 @@
 import os
 import zmq
 import time
+import atexit
+import struct
+import threading
 from pathlib import Path
 from collections import defaultdict
 from datetime import datetime, timezone
-from typing import NoReturn, Union, List, Dict
+from typing import NoReturn, Union, Dict, List, Tuple
 
+from common.ddsketch import DDSketch
 from common.params import Params
 from cereal.messaging import SubMaster
 from selfdrive.swaglog import cloudlog
@@ -20,7 +24,27 @@ class METRIC_TYPE:
   GAUGE = 'g'
   SAMPLE = 'sa'
 
+# binary metric on STATS_SOCKET: 0, first letter of the type, little endian double, then the name
+METRIC_HEADER = struct.Struct("<xcd")
+METRIC_TYPES = {METRIC_TYPE.GAUGE[0].encode(): METRIC_TYPE.GAUGE, METRIC_TYPE.SAMPLE[0].encode(): METRIC_TYPE.SAMPLE}
+# batch of a process' metrics: 1, then for each metric its type letter, name and value lengths, the name
+# and the value, a double for gauges and a serialized DDSketch for samples
+BATCH_MARKER = b"\x01"
+BATCH_ENTRY = struct.Struct("<cHI")
+GAUGE_VALUE = struct.Struct("<d")
+
+SAMPLE_QUANTILES = [0.05, 0.5, 0.95]
+STATLOG_FLUSH_INTERVAL = 1.  # seconds
+
+Metric = Tuple[str, str, Union[float, DDSketch]]
+
+
 class StatLog:
+  """Aggregates the metrics of a process and sends them to statsd in one message every second.
+
+  Recording a metric is a dict update under a lock: gauges keep their last value and samples
+  go into a DDSketch. The flush thread sleeps while there is nothing to send, and when statsd
+  isn't keeping up the metrics stay here and go out with the next flush."""
   def __init__(self):
     self.pid = None
 
@@ -29,43 +53,139 @@ class StatLog:
     self.sock = self.zctx.socket(zmq.PUSH)
     self.sock.setsockopt(zmq.LINGER, 10)
     self.sock.connect(STATS_SOCKET)
+
+    self.cv = threading.Condition()
+    self.send_lock = threading.Lock()
+    self.gauges: Dict[str, float] = {}
+    self.samples: Dict[str, DDSketch] = {}
+    if self.pid is None:
+      atexit.register(self.flush)
     self.pid = os.getpid()
+    threading.Thread(target=self._flush_thread, name="statlog", daemon=True).start()
 
-  def _send(self, metric: str) -> None:
+  def _flush_thread(self) -> None:
+    while True:
+      with self.cv:
+        self.cv.wait_for(lambda: self.gauges or self.samples)
+      time.sleep(STATLOG_FLUSH_INTERVAL)
+      self.flush()
+
+  def flush(self) -> None:
     if os.getpid() != self.pid:
-      self.connect()
+      return
+
+    with self.cv:
+      gauges, self.gauges = self.gauges, {}
+      samples, self.samples = self.samples, {}
+    if not gauges and not samples:
+      return
 
     try:
-      self.sock.send_string(metric, zmq.NOBLOCK)
+      with self.send_lock:
+        self.sock.send(pack_metrics(gauges, samples), zmq.NOBLOCK)
     except zmq.error.Again:
-      # drop :/
-      pass
+      # statsd isn't keeping up, send these with the next flush
+      with self.cv:
+        for name, value in gauges.items():
+          self.gauges.setdefault(name, value)
+        for name, sketch in samples.items():
+          if name in self.samples:
+            sketch.merge(self.samples[name])
+          self.samples[name] = sketch
+        self.cv.notify()
 
   def gauge(self, name: str, value: float) -> None:
-    self._send(f"{name}:{value}|{METRIC_TYPE.GAUGE}")
+    if os.getpid() != self.pid:
+      self.connect()
+
+    with self.cv:
+      if not self.gauges and not self.samples:
+        self.cv.notify()
+      self.gauges[name] = value
 
-  # Samples will be recorded in a buffer and at aggregation time,
+  # Samples are added to a quantile sketch and at aggregation time,
   # statistical properties will be logged (mean, count, percentiles, ...)
   def sample(self, name: str, value: float):
-    self._send(f"{name}:{value}|{METRIC_TYPE.SAMPLE}")
+    if os.getpid() != self.pid:
+      self.connect()
+
+    with self.cv:
+      if not self.gauges and not self.samples:
+        self.cv.notify()
+      sketch = self.samples.get(name)
+      if sketch is None:
+        sketch = self.samples[name] = DDSketch()
+      sketch.add(value)
+
+
+def pack_metrics(gauges: Dict[str, float], samples: Dict[str, DDSketch]) -> bytes:
+  parts = [BATCH_MARKER]
+  for metric_type, metrics in ((METRIC_TYPE.GAUGE, {k: GAUGE_VALUE.pack(v) for k, v in gauges.items()}),
+                               (METRIC_TYPE.SAMPLE, {k: v.to_bytes() for k, v in samples.items()})):
+    for name, value in metrics.items():
+      name_bytes = name.encode()
+      parts += [BATCH_ENTRY.pack(metric_type[0].encode(), len(name_bytes), len(value)), name_bytes, value]
+  return b"".join(parts)
+
+
+def parse_metrics(dat: bytes) -> List[Metric]:
+  """(name, type, value) of the metrics in a message: a batch, a binary metric or a "name:value|type" line.
+  Sample values in a batch are a DDSketch."""
+  if dat[:1] == BATCH_MARKER:
+    metrics: List[Metric] = []
+    i = 1
+    while i < len(dat):
+      metric_type, name_len, value_len = BATCH_ENTRY.unpack_from(dat, i)
+      i += BATCH_ENTRY.size
+      name = dat[i:i + name_len].decode("utf-8")
+      value = dat[i + name_len:i + name_len + value_len]
+      i += name_len + value_len
+      if metric_type == b"g":
+        metrics.append((name, METRIC_TYPE.GAUGE, GAUGE_VALUE.unpack(value)[0]))
+      else:
+        metrics.append((name, METRIC_TYPES.get(metric_type, metric_type.decode()), DDSketch.from_bytes(value)))
+    return metrics
+
+  if dat[:1] == b"\x00":
+    metric_type, value = METRIC_HEADER.unpack_from(dat)
+    return [(dat[METRIC_HEADER.size:].decode("utf-8"), METRIC_TYPES.get(metric_type, metric_type.decode()), value)]
+
+  metric, _, metric_type = dat.decode("utf-8").rpartition("|")
+  name, _, value = metric.rpartition(":")
+  return [(name, metric_type, float(value))]
+
+
+def sample_stats(sketch: DDSketch) -> Dict[str, float]:
+  stats = {
+    'count': sketch.count,
+    'min': sketch.min,
+    'max': sketch.max,
+    'mean': sketch.sum / sketch.count,
+  }
+  for percentile, value in zip(SAMPLE_QUANTILES, sketch.quantiles(SAMPLE_QUANTILES)):
+    stats[f"p{int(percentile * 100)}"] = value
+  return stats
+
+
+def write_stats(result: str, timestamp: datetime) -> bool:
+  # check that we aren't filling up the drive
+  if len(os.listdir(STATS_DIR)) >= STATS_DIR_FILE_LIMIT:
+    cloudlog.error("stats dir full")
+    return False
+
+  stats_path = os.path.join(STATS_DIR, str(int(timestamp.timestamp())))
+  with atomic_write_in_dir(stats_path) as f:
+    f.write(result)
+  return True
 
 
 def main() -> NoReturn:
   dongle_id = Params().get("DongleId", encoding='utf-8')
-  def get_influxdb_line(measurement: str, value: Union[float, Dict[str, float]],  timestamp: datetime, tags: dict) -> str:
-    res = f"{measurement}"
-    for k, v in tags.items():
-      res += f",{k}={str(v)}"
-    res += " "
-
+  def get_influxdb_line(measurement: str, value: Union[float, Dict[str, float]], timestamp_ns: int, tags: str) -> str:
     if isinstance(value, float):
       value = {'value': value}
-
-    for k, v in value.items():
-      res += f"{k}={v},"
-
-    res += f"dongle_id=\"{dongle_id}\" {int(timestamp.timestamp() * 1e9)}\n"
-    return res
+    fields = "".join(f"{k}={v}," for k, v in value.items())
+    return f"{measurement}{tags} {fields}dongle_id=\"{dongle_id}\" {timestamp_ns}\n"
 
   # open statistics socket
   ctx = zmq.Context().instance()
@@ -89,8 +209,8 @@ def main() -> NoReturn:
   sm = SubMaster(['deviceState'])
 
   last_flush_time = time.monotonic()
-  gauges = {}
-  samples: Dict[str, List[float]] = defaultdict(list)
+  gauges: Dict[str, float] = {}
+  samples: Dict[str, DDSketch] = defaultdict(DDSketch)
   while True:
     started_prev = sm['deviceState'].started
     sm.update()
@@ -98,62 +218,44 @@ def main() -> NoReturn:
     # Update metrics
     while True:
       try:
-        metric = sock.recv_string(zmq.NOBLOCK)
-        try:
-          metric_type = metric.split('|')[1]
-          metric_name = metric.split(':')[0]
-          metric_value = float(metric.split('|')[0].split(':')[1])
-
-          if metric_type == METRIC_TYPE.GAUGE:
-            gauges[metric_name] = metric_value
-          elif metric_type == METRIC_TYPE.SAMPLE:
-            samples[metric_name].append(metric_value)
-          else:
-            cloudlog.event("unknown metric type", metric_type=metric_type)
-        except Exception:
-          cloudlog.event("malformed metric", metric=metric)
+        dat = sock.recv(zmq.NOBLOCK)
       except zmq.error.Again:
         break
 
+      try:
+        metrics = parse_metrics(dat)
+      except Exception:
+        cloudlog.event("malformed metric", metric=dat)
+        continue
+
+      for metric_name, metric_type, metric_value in metrics:
+        if metric_type == METRIC_TYPE.GAUGE:
+          gauges[metric_name] = metric_value
+        elif metric_type == METRIC_TYPE.SAMPLE:
+          if isinstance(metric_value, DDSketch):
+            samples[metric_name].merge(metric_value)
+          else:
+            samples[metric_name].add(metric_value)
+        else:
+          cloudlog.event("unknown metric type", metric_type=metric_type)
+
     # flush when started state changes or after FLUSH_TIME_S
     if (time.monotonic() > last_flush_time + STATS_FLUSH_TIME_S) or (sm['deviceState'].started != started_prev):
-      result = ""
       current_time = datetime.utcnow().replace(tzinfo=timezone.utc)
+      timestamp_ns = int(current_time.timestamp() * 1e9)
       tags['started'] = sm['deviceState'].started
+      tags_str = "".join(f",{k}={v}" for k, v in tags.items())
 
-      for key, value in gauges.items():
-        result += get_influxdb_line(f"gauge.{key}", value, current_time, tags)
-
-      for key, values in samples.items():
-        values.sort()
-        sample_count = len(values)
-        sample_sum = sum(values)
-
-        stats = {
-          'count': sample_count,
-          'min': values[0],
-          'max': values[-1],
-          'mean': sample_sum / sample_count,
-        }
-        for percentile in [0.05, 0.5, 0.95]:
-          value = values[int(round(percentile * (sample_count - 1)))]
-          stats[f"p{int(percentile * 100)}"] = value
-
-        result += get_influxdb_line(f"sample.{key}", stats, current_time, tags)
+      lines = [get_influxdb_line(f"gauge.{key}", value, timestamp_ns, tags_str) for key, value in gauges.items()]
+      lines += [get_influxdb_line(f"sample.{key}", sample_stats(sketch), timestamp_ns, tags_str) for key, sketch in samples.items()]
 
       # clear intermediate data
       gauges.clear()
       samples.clear()
       last_flush_time = time.monotonic()
 
-      # check that we aren't filling up the drive
-      if len(os.listdir(STATS_DIR)) < STATS_DIR_FILE_LIMIT:
-        if len(result) > 0:
-          stats_path = os.path.join(STATS_DIR, str(int(current_time.timestamp())))
-          with atomic_write_in_dir(stats_path) as f:
-            f.write(result)
-      else:
-        cloudlog.error("stats dir full")
+      if len(lines) > 0:
+        write_stats("".join(lines), current_time)
 
 
 if __name__ == "__main__":
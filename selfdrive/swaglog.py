@@ -6,7 +6,7 @@ from logging.handlers import BaseRotatingHandler
 
 import zmq
 
-from common.logging_extra import SwagLogger, SwagFormatter, SwagLogFileFormatter
+from common.logging_extra import BINARY_RECORD, SwagLogger, SwagFormatter, SwagLogFileFormatter
 from selfdrive.hardware import PC
 
 if PC:
@@ -83,11 +83,10 @@ class UnixDomainSocketHandler(logging.Handler):
     if os.getpid() != self.pid:
       self.connect()
 
-    msg = self.format(record).rstrip('\n')
-    # print("SEND".format(repr(msg)))
+    # the record goes out marshalled, logmessaged does the json formatting
+    dat = bytes([record.levelno]) + BINARY_RECORD + self.formatter.format_binary(record)
     try:
-      s = chr(record.levelno)+msg
-      self.sock.send(s.encode('utf8'), zmq.NOBLOCK)
+      self.sock.send(dat, zmq.NOBLOCK)
     except zmq.error.Again:
       # drop :/
       pass
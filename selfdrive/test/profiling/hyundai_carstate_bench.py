@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+"""Time hyundai CarState.update on the CAN of a recorded Hyundai drive."""
+import argparse
+import time
+
+from tools.lib.logreader import LogReader
+from selfdrive.car.hyundai.carstate import CarState
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("log", help="rlog of a Hyundai drive, must contain carParams")
+  args = parser.parse_args()
+
+  msgs = list(LogReader(args.log))
+  CP = next(m.carParams for m in msgs if m.which() == 'carParams')
+  can_msgs = [m.as_builder().to_bytes() for m in msgs if m.which() == 'can']
+
+  CS = CarState(CP)
+  cp, cp2, cp_cam = CS.get_can_parser(CP), CS.get_can2_parser(CP), CS.get_cam_can_parser(CP)
+
+  update_time = 0.
+  for dat in can_msgs:
+    for p in (cp, cp2, cp_cam):
+      p.update_strings([dat])
+
+    t = time.perf_counter()
+    CS.update(cp, cp2, cp_cam)
+    update_time += time.perf_counter() - t
+
+  n = max(len(can_msgs), 1)
+  print(f"{CP.carFingerprint}: {len(can_msgs)} frames, CarState.update {update_time / n * 1e6:.1f} us/frame")
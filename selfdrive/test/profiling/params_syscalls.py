@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Compare syscalls per controlsd frame when reading toggles with Params and with ParamsCache.
+
+A frame is simulated as reading every param that the controls and hyundai car code used to read,
+so the numbers are an upper bound for a loop that polls its toggles. Requires strace."""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from common.params import Params, get_params_cache
+
+FRAME_KEYS = [
+  'MadModeEnabled', 'IsLdwsCar', 'StockNaviDecelEnabled', 'KeepSteeringTurnSignals',
+  'HapticFeedbackWhenSpeedCamera', 'LongControlEnabled', 'SccSmootherSlowOnCurves',
+  'SccSmootherSyncGasPressed', 'IsMetric', 'UseClusterSpeed', 'LaneChangeEnabled',
+  'AutoLaneChangeEnabled', 'DisengageOnAccelerator', 'IsLdwEnabled',
+]
+
+
+def run_frames(mode, frames):
+  params = Params() if mode == "params" else get_params_cache()
+  for _ in range(frames):
+    for k in FRAME_KEYS:
+      params.get_bool(k)
+
+
+def count_syscalls(mode, frames):
+  with tempfile.NamedTemporaryFile(suffix=".strace") as f:
+    subprocess.check_call(["strace", "-f", "-c", "-o", f.name, sys.executable, __file__,
+                           "--child", mode, str(frames)], env=os.environ)
+    for line in open(f.name):
+      parts = line.split()
+      if parts and parts[-1] == "total":
+        # % time, seconds, usecs/call, calls, [errors], total
+        return int(parts[3])
+  raise RuntimeError("no strace summary")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--frames", type=int, default=1000)
+  parser.add_argument("--child", nargs=2, metavar=("MODE", "FRAMES"), help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    run_frames(args.child[0], int(args.child[1]))
+    sys.exit(0)
+
+  for mode in ("params", "cache"):
+    # subtract interpreter startup and cache setup
+    baseline = count_syscalls(mode, 0)
+    total = count_syscalls(mode, args.frames)
+    print(f"{mode:>6}: {(total - baseline) / args.frames:.2f} syscalls/frame ({len(FRAME_KEYS)} reads/frame)")
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Per frame cost of SccSmoother.cal_max_speed replayed from a Hyundai log.
+
+Runs the same frames twice: once with the real sm.updated flags, and once with every
+input marked updated each frame, which is what the smoother used to recompute."""
+import argparse
+import time
+from types import SimpleNamespace
+
+from tools.lib.logreader import LogReader
+from selfdrive.car.hyundai.scc_smoother import SccSmoother
+
+SERVICES = ['lateralPlan', 'radarState']
+
+
+class ReplaySubMaster:
+  def __init__(self, all_updated):
+    self.all_updated = all_updated
+    self.data = {}
+    self.updated = {s: False for s in SERVICES}
+
+  def __getitem__(self, s):
+    return self.data[s]
+
+
+def replay(msgs, all_updated, longcontrol, slow_on_curves):
+  sm = ReplaySubMaster(all_updated)
+  smoother = SccSmoother()
+  smoother.longcontrol = longcontrol
+  smoother.slow_on_curves = slow_on_curves
+
+  elapsed, frames = 0., 0
+  for msg in msgs:
+    which = msg.which()
+    if which in SERVICES:
+      sm.data[which] = getattr(msg, which)
+      sm.updated[which] = True
+    elif which == 'carState' and len(sm.data) == len(SERVICES):
+      v_ego = msg.carState.vEgo
+      CS = SimpleNamespace(out=msg.carState)
+      controls = SimpleNamespace(v_cruise_kph=msg.carState.cruiseState.speed * 3.6 or 100.)
+      if all_updated:
+        sm.updated = {s: True for s in SERVICES}
+
+      t = time.perf_counter()
+      smoother.cal_max_speed(frames, None, CS, sm, v_ego * 3.6, controls)
+      elapsed += time.perf_counter() - t
+      frames += 1
+
+      sm.updated = {s: False for s in SERVICES}
+  return elapsed, frames
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("log", help="rlog of a Hyundai drive")
+  parser.add_argument("--no-long", action="store_true")
+  parser.add_argument("--no-curves", action="store_true")
+  args = parser.parse_args()
+
+  msgs = list(LogReader(args.log))
+  for name, all_updated in (("every frame", True), ("sm.updated", False)):
+    elapsed, frames = replay(msgs, all_updated, not args.no_long, not args.no_curves)
+    print(f"{name:>12}: {elapsed / max(frames, 1) * 1e6:.1f} us/frame over {frames} frames")
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""Records per second of the swaglog formatting, per process.
+
+A python process used to json encode every record it sent to logmessaged. It now
+marshals the record's fields and logmessaged builds the dict and does the json
+encoding, this times both sides against the json path."""
+import argparse
+import logging
+import time
+
+from common.logging_extra import SwagFormatter, SwagLogFileFormatter, SwagLogger, json_robust_dumps
+
+
+class RecordCapture(logging.Handler):
+  def __init__(self):
+    super().__init__()
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(record)
+
+
+def make_records(n):
+  log = SwagLogger()
+  capture = RecordCapture()
+  log.addHandler(capture)
+  log.bind_global(dongle_id="0000000000000000", version="0.8.9", dirty=False)
+  for i in range(n):
+    if i % 2:
+      log.event("athena.upload_handler.upload_start", fn="/data/media/0/realdata/2021-01-01--00-00-00--0/rlog.bz2",
+                sz=12345678, network_type=1, metered=False, retry_count=0)
+    else:
+      log.info("deleting %s", "/data/media/0/realdata/2021-01-01--00-00-00--0/fcamera.hevc")
+  return log, capture.records
+
+
+def logmessaged_binary(consumer, file_formatter, dat):
+  record_dict = consumer.load_binary(dat)
+  json_robust_dumps(record_dict)  # published as logMessage
+  return file_formatter.format(record_dict)
+
+
+def rate(f, records):
+  t = time.perf_counter()
+  for r in records:
+    f(r)
+  return len(records) / (time.perf_counter() - t)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("-n", type=int, default=50000, help="records per run")
+  args = parser.parse_args()
+
+  log, records = make_records(args.n)
+  formatter = SwagFormatter(log)
+  consumer = SwagFormatter(None)
+  file_formatter = SwagLogFileFormatter(None)
+  binary = [formatter.format_binary(r) for r in records]
+  json_records = [formatter.format(r) for r in records]
+
+  print("sending process:")
+  print(f"  json    {rate(formatter.format, records):10.0f} records/s")
+  print(f"  binary  {rate(formatter.format_binary, records):10.0f} records/s")
+  print("logmessaged, publish and file formatting:")
+  print(f"  json    {rate(file_formatter.format, json_records):10.0f} records/s")
+  print(f"  binary  {rate(lambda b: logmessaged_binary(consumer, file_formatter, b), binary):10.0f} records/s")
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+import asyncio
+import base64
+import bz2
+import hashlib
+import http.server
+import json
+import lzma
+import os
+import queue
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from websocket import create_connection
+
+from selfdrive.athena import athenad
+from selfdrive.loggerd.recompress import OUT_SIZE
+
+WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class WebsocketServer:
+  """Local stand-in for the athena websocket endpoint, one client with text frames"""
+  def __init__(self):
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.sock.bind(("127.0.0.1", 0))
+    self.sock.listen(1)
+    self.url = f"ws://127.0.0.1:{self.sock.getsockname()[1]}/ws/v2/0"
+    self.conn = None
+
+  def accept(self):
+    self.conn, _ = self.sock.accept()
+    self.conn.settimeout(10)
+    request = b""
+    while b"\r\n\r\n" not in request:
+      request += self.conn.recv(4096)
+    headers = dict(line.split(": ", 1) for line in request.decode().split("\r\n")[1:] if ": " in line)
+    accept = base64.b64encode(hashlib.sha1(headers["Sec-WebSocket-Key"].encode() + WS_GUID).digest()).decode()
+    self.conn.sendall(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                       f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+
+  def send(self, msg):
+    data = json.dumps(msg).encode()
+    if len(data) < 126:
+      header = struct.pack("!BB", 0x81, len(data))
+    else:
+      header = struct.pack("!BBQ", 0x81, 127, len(data))
+    self.conn.sendall(header + data)
+
+  def read(self, n):
+    data = b""
+    while len(data) < n:
+      chunk = self.conn.recv(n - len(data))
+      if not chunk:
+        raise ConnectionError
+      data += chunk
+    return data
+
+  def recv(self):
+    """Next message, reassembled from its fragments"""
+    data = b""
+    while True:
+      b0, b1 = self.read(2)
+      length = b1 & 0x7f
+      if length == 126:
+        length, = struct.unpack("!H", self.read(2))
+      elif length == 127:
+        length, = struct.unpack("!Q", self.read(8))
+      mask = self.read(4)
+      data += bytes(b ^ mask[i % 4] for i, b in enumerate(self.read(length)))
+      if b0 & 0x80:
+        return json.loads(data)
+
+  def close(self):
+    if self.conn is not None:
+      self.conn.close()
+    self.sock.close()
+
+
+class AthenadTestCase(unittest.TestCase):
+  def connect(self):
+    self.server = WebsocketServer()
+    accept = threading.Thread(target=self.server.accept)
+    accept.start()
+    ws = create_connection(self.server.url, enable_multithread=True, timeout=30.0)
+    accept.join()
+
+    self.thread = threading.Thread(target=asyncio.run, args=(athenad.handle_long_poll(ws),), daemon=True)
+    self.thread.start()
+
+  def tearDown(self):
+    self.server.close()
+    self.thread.join(10)
+
+  def call(self, method, params, call_id=0):
+    self.server.send({"method": method, "params": params, "jsonrpc": "2.0", "id": call_id})
+    return self.server.recv()
+
+
+class TestAthenad(AthenadTestCase):
+  def setUp(self):
+    self.connect()
+
+  def test_echo(self):
+    resp = self.call("echo", ["hello"])
+    self.assertEqual(resp, {"result": "hello", "id": 0, "jsonrpc": "2.0"})
+
+  def test_fragmented_response(self):
+    s = "x" * (3 * athenad.WS_FRAME_SIZE)
+    self.assertEqual(self.call("echo", [s], 1)["result"], s)
+
+  def test_concurrent_calls(self):
+    for i in range(10):
+      self.server.send({"method": "echo", "params": [i], "jsonrpc": "2.0", "id": i})
+    self.assertEqual(sorted(self.server.recv()["result"] for _ in range(10)), list(range(10)))
+
+  def test_disconnect(self):
+    self.assertEqual(self.call("listUploadQueue", []).get("result"), [])
+    self.server.conn.close()
+    self.thread.join(10)
+    self.assertFalse(self.thread.is_alive())
+
+
+class TestLogForwarding(AthenadTestCase):
+  def setUp(self):
+    self.log_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.log_dir)
+    for i in range(20):
+      self.write_log(i)
+
+    for patch in (mock.patch.object(athenad, "SWAGLOG_DIR", self.log_dir), mock.patch.object(athenad, "PC", False),
+                  mock.patch.object(athenad, "swaglog_index", None)):
+      patch.start()
+      self.addCleanup(patch.stop)
+    self.connect()
+
+  def write_log(self, i):
+    with open(os.path.join(self.log_dir, f"swaglog.{i:010}"), "w") as f:
+      f.write(f"{i}\n")
+
+  def sent_time(self, i):
+    return int.from_bytes(os.getxattr(os.path.join(self.log_dir, f"swaglog.{i:010}"), athenad.LOG_ATTR_NAME), sys.byteorder)
+
+  def test_batches(self):
+    # all batches go out before any response, newest first, the newest file is still being written
+    batches = [self.server.recv() for _ in range(3)]
+    self.assertEqual([len(b["id"].split(",")) for b in batches], [8, 8, 3])
+    self.assertEqual(batches[0]["params"]["logs"], "".join(f"{i}\n" for i in range(18, 10, -1)))
+    for b in batches:
+      self.server.send({"id": b["id"], "result": {"success": 1}, "jsonrpc": "2.0"})
+
+    acked = int.from_bytes(athenad.LOG_ATTR_VALUE_MAX_UNIX_TIME, sys.byteorder)
+    for _ in range(50):
+      if all(self.sent_time(i) == acked for i in range(19)):
+        break
+      time.sleep(0.1)
+    self.assertEqual([self.sent_time(i) for i in range(19)], [acked] * 19)
+
+    # once a newer log is created the previous one is sent
+    self.write_log(20)
+    batch = self.server.recv()
+    self.assertEqual(batch["id"], "swaglog.0000000019")
+    self.assertEqual(batch["params"]["logs"], "19\n")
+
+
+class TestStatsForwarding(AthenadTestCase):
+  def setUp(self):
+    self.stats_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.stats_dir)
+    for i in range(3):
+      self.write_stats(i)
+
+    for patch in (mock.patch.object(athenad, "STATS_DIR", self.stats_dir), mock.patch.object(athenad, "stats_index", None),
+                  mock.patch.object(athenad.StatsIndex, "retry_delay", 0.5)):
+      patch.start()
+      self.addCleanup(patch.stop)
+    self.connect()
+
+  def write_stats(self, i):
+    # like statsd, through a temp file that is renamed
+    tmp = os.path.join(self.stats_dir, f"tmp{i}")
+    with open(tmp, "w") as f:
+      f.write(f"stat value={i}\n")
+    os.rename(tmp, os.path.join(self.stats_dir, str(i)))
+
+  def test_ack_and_retry(self):
+    batch = self.server.recv()
+    self.assertEqual(batch["method"], "storeStats")
+    self.assertEqual(batch["params"]["stats"], "".join(f"stat value={i}\n" for i in range(3)))
+
+    # files stay until athena stored them, and are sent again
+    self.server.send({"id": batch["id"], "error": {"code": -32000, "message": "unavailable"}, "jsonrpc": "2.0"})
+    retry = self.server.recv()
+    self.assertEqual(retry["params"], batch["params"])
+    self.assertEqual(sorted(os.listdir(self.stats_dir)), ["0", "1", "2"])
+
+    self.server.send({"id": retry["id"], "result": {"success": 1}, "jsonrpc": "2.0"})
+    for _ in range(50):
+      if not os.listdir(self.stats_dir):
+        break
+      time.sleep(0.1)
+    self.assertEqual(os.listdir(self.stats_dir), [])
+
+    self.write_stats(3)
+    self.assertEqual(self.server.recv()["params"]["stats"], "stat value=3\n")
+
+
+class TestUploads(AthenadTestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.root)
+    os.mkdir(os.path.join(self.root, "a--0"))
+    # repeats further apart than a bz2 block, like the messages of a log
+    self.rlog = os.urandom(OUT_SIZE // 2) * 4
+    with open(os.path.join(self.root, "a--0", "rlog.bz2"), "wb") as f:
+      f.write(bz2.compress(self.rlog))
+
+    self.received = queue.Queue()
+    received = self.received
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def do_PUT(self):
+        received.put((self.path, self.rfile.read(int(self.headers["Content-Length"]))))
+        self.send_response(201)
+        self.end_headers()
+
+      def log_message(self, *args):
+        pass
+
+    self.http = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=self.http.serve_forever, daemon=True).start()
+    self.addCleanup(self.http.server_close)
+    self.addCleanup(self.http.shutdown)
+
+    patch = mock.patch.object(athenad, "ROOT", self.root)
+    patch.start()
+    self.addCleanup(patch.stop)
+    self.connect()
+
+  def test_recompressed_rlog(self):
+    url = f"http://127.0.0.1:{self.http.server_port}/a--0/rlog.xz"
+    resp = self.call("uploadFilesToUrls", [[{"fn": "a--0/rlog.xz", "url": url}, {"fn": "a--0/qlog.xz", "url": url}]])
+    self.assertEqual(resp["result"]["enqueued"], 1)
+    self.assertEqual(resp["result"]["failed"], ["a--0/qlog.xz"])
+
+    path, body = self.received.get(timeout=60)
+    self.assertEqual(path, "/a--0/rlog.xz")
+    self.assertEqual(lzma.decompress(body), self.rlog)
+    self.assertLess(len(body), os.path.getsize(os.path.join(self.root, "a--0", "rlog.bz2")))
+
+
+class TestAsyncQueue(unittest.TestCase):
+  def test_put_from_thread(self):
+    q1, q2 = athenad.AsyncQueue(), athenad.AsyncQueue()
+
+    async def wait():
+      threading.Timer(0.1, q2.put_nowait, args=("item",)).start()
+      await asyncio.wait_for(athenad.AsyncQueue.wait_any(q1, q2), 5)
+      return q2.get_nowait()
+
+    self.assertEqual(asyncio.run(wait()), "item")
+    self.assertRaises(athenad.queue.Empty, q1.get_nowait)
+
+
+if __name__ == "__main__":
+  unittest.main()
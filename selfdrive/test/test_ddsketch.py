@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import math
+import random
+import unittest
+
+from common.ddsketch import DDSketch
+
+
+class TestDDSketch(unittest.TestCase):
+  def check(self, values, accuracy=0.01):
+    sketch = DDSketch(accuracy)
+    for v in values:
+      sketch.add(v)
+
+    values = sorted(values)
+    qs = [0., 0.05, 0.5, 0.95, 1.]
+    for q, estimate in zip(qs, sketch.quantiles(qs)):
+      expected = values[round(q * (len(values) - 1))]
+      self.assertLessEqual(abs(estimate - expected), accuracy * abs(expected) + 1e-9, f"q={q}")
+    self.assertEqual(sketch.count, len(values))
+    self.assertEqual((sketch.min, sketch.max), (values[0], values[-1]))
+    return sketch
+
+  def test_accuracy(self):
+    random.seed(0)
+    self.check([random.lognormvariate(0, 2) for _ in range(20000)])
+    self.check([random.gauss(0, 10) for _ in range(20000)])
+    self.check([0.] * 10 + [1.] * 10)
+
+  def test_bounded(self):
+    sketch = DDSketch(max_buckets=64)
+    for i in range(-2000, 2000):
+      sketch.add(10 ** (i / 100))
+    self.assertLessEqual(len(sketch.pos), 64)
+    # only the lowest values are merged, the top 64 keep their accuracy
+    expected = 10 ** ((round(0.99 * 3999) - 2000) / 100)
+    self.assertAlmostEqual(sketch.quantile(0.99), expected, delta=0.01 * expected)
+
+  def test_empty(self):
+    self.assertTrue(math.isnan(DDSketch().quantile(0.5)))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+
+from common.xattr import setxattr
+from selfdrive.loggerd.deleter import SizeLedger, delete_batch, deletion_order
+from selfdrive.loggerd.uploader import UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+
+SEGMENTS = [f"2021-01-01--00-00-00--{i}" for i in range(3)]
+FILES = ["fcamera.hevc", "ecamera.hevc", "dcamera.hevc", "rlog.bz2", "qlog.bz2"]
+
+
+class TestDeleter(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.addCleanup(self.tmp.cleanup)
+    self.root = self.tmp.name
+    for seg in SEGMENTS:
+      for name in FILES:
+        self.write(seg, name)
+    self.write("crash", "error.txt")
+
+    # the first fcamera is uploaded, the last segment is still being written
+    setxattr(self.path(SEGMENTS[0], "fcamera.hevc"), UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+    self.write(SEGMENTS[2], "rlog.bz2.lock")
+
+    self.ledger = SizeLedger(self.root)
+    self.ledger.update()
+
+  def path(self, *p):
+    return os.path.join(self.root, *p)
+
+  def write(self, logname, name):
+    os.makedirs(self.path(logname), exist_ok=True)
+    with open(self.path(logname, name), "wb") as f:
+      f.write(b"\1" * 16384)
+
+  def test_deletion_order(self):
+    s0, s1 = SEGMENTS[:2]
+    order = [(logname, name) for logname, name, _ in deletion_order(self.ledger)]
+    self.assertEqual(order, [
+      (s0, "fcamera.hevc"),
+      (s0, "ecamera.hevc"), (s1, "ecamera.hevc"),
+      (s0, "dcamera.hevc"), (s1, "dcamera.hevc"),
+      (s1, "fcamera.hevc"),
+      (s0, "rlog.bz2"), (s1, "rlog.bz2"),
+      (s0, None), (s1, None), ("crash", None),
+    ])
+
+  def test_batch_stops(self):
+    s0, s1 = SEGMENTS[:2]
+    size = self.ledger.dirs[s0]["fcamera.hevc"]
+    self.assertEqual(delete_batch(self.ledger, size + 1), 2 * size)
+
+    deleted = [(seg, name) for seg in SEGMENTS for name in FILES if not os.path.exists(self.path(seg, name))]
+    self.assertEqual(deleted, [(s0, "fcamera.hevc"), (s0, "ecamera.hevc")])
+    self.assertEqual(next(deletion_order(self.ledger))[:2], (s1, "ecamera.hevc"))
+
+  def test_file_added_to_final_segment(self):
+    # like the xz copy athena makes of an uploaded log
+    s1 = SEGMENTS[1]
+    self.write(s1, "rlog.xz")
+    self.ledger.update()
+    self.assertIn("rlog.xz", self.ledger.dirs[s1])
+    self.assertIn((s1, "rlog.xz"), [(logname, name) for logname, name, _ in deletion_order(self.ledger)])
+
+
+if __name__ == "__main__":
+  unittest.main()
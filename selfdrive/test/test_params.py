@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+import gc
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import common.params
+from common.params import Params, ParamsCache, ParamsWriter
+
+
+def wait_for(cond, timeout=5.):
+  end = time.monotonic() + timeout
+  while not cond():
+    if time.monotonic() > end:
+      return False
+    time.sleep(0.01)
+  return True
+
+
+class Toggles:
+  def __init__(self):
+    self.changes = []
+
+  def on_change(self, key, value):
+    self.changes.append((key, value))
+
+
+class ParamsTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.tmp)
+    self.params = Params(self.tmp)
+
+
+class TestParamsCache(ParamsTestCase):
+  def setUp(self):
+    super().setUp()
+    self.cache = ParamsCache(self.tmp)
+    self.assertIsNotNone(self.cache.inotify)
+
+  def test_invalidate_on_write(self):
+    self.params.put_bool("IsMetric", True)
+    # a value read before the write's event arrived isn't cached
+    self.assertTrue(wait_for(lambda: self.cache.get_bool("IsMetric") and "IsMetric" in self.cache.cache))
+
+    self.params.put_bool("IsMetric", False)
+    self.assertTrue(wait_for(lambda: not self.cache.get_bool("IsMetric")))
+    self.params.delete("IsMetric")
+    self.assertTrue(wait_for(lambda: self.cache.get("IsMetric") is None))
+
+  def test_watch(self):
+    toggles = Toggles()
+    self.cache.watch(["IsMetric"], toggles.on_change)
+    self.params.put_bool("LongControlEnabled", True)
+    self.params.put_bool("IsMetric", True)
+    self.assertTrue(wait_for(lambda: toggles.changes == [("IsMetric", b"1")]))
+
+    self.cache.unwatch(toggles.on_change)
+    self.params.put_bool("IsMetric", False)
+    self.assertTrue(wait_for(lambda: not self.cache.get_bool("IsMetric")))
+    self.assertEqual(toggles.changes, [("IsMetric", b"1")])
+
+  def test_watch_doesnt_keep_owner(self):
+    toggles = Toggles()
+    self.cache.watch(["IsMetric"], toggles.on_change)
+    ref = toggles.changes
+    del toggles
+    gc.collect()
+
+    self.params.put_bool("IsMetric", True)
+    self.assertTrue(wait_for(lambda: self.cache.get_bool("IsMetric")))
+    self.assertTrue(wait_for(lambda: self.cache.callbacks["IsMetric"] == []))
+    self.assertEqual(ref, [])
+
+
+class TestParamsWriter(ParamsTestCase):
+  def test_coalesce(self):
+    batches = []
+    release = threading.Event()
+
+    class RecordingParams(Params):
+      def put_many(self, values):
+        batches.append(dict(values))
+        release.wait(5)
+        super().put_many(values)
+
+    writer = ParamsWriter()
+    with mock.patch.object(common.params, "Params", RecordingParams):
+      writer.put("IsMetric", "1", self.tmp)
+      # queued while the first write is in progress, only the last value of a key is written
+      self.assertTrue(wait_for(lambda: len(batches) == 1))
+      writer.put("LongControlEnabled", "0", self.tmp)
+      writer.put("IsMetric", "0", self.tmp)
+      writer.put("LongControlEnabled", "1", self.tmp)
+      release.set()
+      self.assertTrue(writer.flush(5))
+
+    self.assertEqual(batches, [{"IsMetric": b"1"}, {"IsMetric": b"0", "LongControlEnabled": b"1"}])
+
+  def test_flush(self):
+    writer = ParamsWriter()
+    self.assertTrue(writer.flush(0))
+    for i in range(10):
+      writer.put("DongleId", str(i), self.tmp)
+    self.assertTrue(writer.flush(5))
+    self.assertEqual(Params(self.tmp).get("DongleId"), b"9")
+
+  def test_concurrent_first_put(self):
+    writer = ParamsWriter()
+    dirs = [tempfile.mkdtemp(dir=self.tmp) for _ in range(8)]
+    barrier = threading.Barrier(len(dirs) + 1)
+
+    def put(d):
+      barrier.wait()
+      writer.put("DongleId", d, d)
+
+    def writers():
+      return sum(t.name == "params_writer" for t in threading.enumerate())
+
+    threads = [threading.Thread(target=put, args=(d,)) for d in dirs]
+    for t in threads:
+      t.start()
+    before = writers()
+
+    condition = threading.Condition
+
+    def slow_condition(*args):
+      # widen the window between the pid check and the writer being set up
+      time.sleep(0.05)
+      return condition(*args)
+
+    with mock.patch.object(common.params.threading, "Condition", slow_condition):
+      barrier.wait()
+      for t in threads:
+        t.join()
+    self.assertTrue(writer.flush(5))
+    self.assertEqual(writers(), before + 1)
+    self.assertEqual([Params(d).get("DongleId", encoding="utf8") for d in dirs], dirs)
+
+  def test_failed_write(self):
+    attempts = []
+
+    class FailingParams(Params):
+      def put_many(self, values):
+        attempts.append(dict(values))
+        if len(attempts) == 1:
+          raise OSError("disk full")
+        super().put_many(values)
+
+    writer = ParamsWriter()
+    writer.RETRY_DELAY = 0.2
+    with mock.patch.object(common.params, "Params", FailingParams):
+      writer.put("DongleId", "1", self.tmp)
+      # not reported as written until the retry made it to disk
+      self.assertFalse(writer.flush(0.1))
+      self.assertTrue(writer.flush(5))
+    self.assertEqual(len(attempts), 2)
+    self.assertEqual(Params(self.tmp).get("DongleId"), b"1")
+
+  def test_fork(self):
+    writer = ParamsWriter()
+    writer.put("DongleId", "parent", self.tmp)
+    self.assertTrue(writer.flush(5))
+
+    pid = os.fork()
+    if pid == 0:
+      # the parent's writer thread doesn't exist here
+      writer.put("DongleId", "child", self.tmp)
+      os._exit(0 if writer.flush(5) else 1)
+
+    _, status = os.waitpid(pid, 0)
+    self.assertEqual(os.WEXITSTATUS(status), 0)
+    self.assertEqual(Params(self.tmp).get("DongleId"), b"child")
+
+    writer.put("DongleId", "parent", self.tmp)
+    self.assertTrue(writer.flush(5))
+    self.assertEqual(Params(self.tmp).get("DongleId"), b"parent")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import bz2
+import lzma
+import os
+import tempfile
+import unittest
+
+from selfdrive.loggerd.recompress import OUT_SIZE, recompress, recompressed_path
+
+
+class TestRecompress(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.fn = os.path.join(self.tmp.name, "rlog.bz2")
+
+  def tearDown(self):
+    self.tmp.cleanup()
+
+  def test_roundtrip(self):
+    # several bz2 streams, each decompressing to more than one output chunk. the repeats are
+    # further apart than a bz2 block, like the messages of a log
+    streams = [os.urandom(OUT_SIZE // 2) * 4 for _ in range(2)]
+    with open(self.fn, "wb") as f:
+      for s in streams:
+        f.write(bz2.compress(s))
+
+    out = recompress(self.fn)
+    self.assertEqual(out, recompressed_path(self.fn))
+    with open(out, "rb") as f:
+      self.assertEqual(lzma.decompress(f.read()), b"".join(streams))
+    self.assertEqual(sorted(os.listdir(self.tmp.name)), ["rlog.bz2", "rlog.xz"])
+
+  def test_not_smaller(self):
+    with open(self.fn, "wb") as f:
+      f.write(bz2.compress(os.urandom(100000)))
+    self.assertIsNone(recompress(self.fn))
+    self.assertEqual(os.listdir(self.tmp.name), ["rlog.bz2"])
+
+  def test_truncated(self):
+    with open(self.fn, "wb") as f:
+      f.write(bz2.compress(os.urandom(100000))[:-100])
+    with self.assertRaises(EOFError):
+      recompress(self.fn)
+    self.assertEqual(os.listdir(self.tmp.name), ["rlog.bz2"])
+
+
+if __name__ == "__main__":
+  unittest.main()
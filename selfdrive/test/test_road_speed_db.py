@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import math
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from selfdrive.road_speed_db import RoadSpeedDB, RoadSpeedEntry, OfflineRoadLimit, KIND_CAMERA, KIND_SECTION, \
+                                    DEFAULT_CELL_DEG, LOOKAHEAD_DIST, build, local_offset, EARTH_RADIUS
+
+LAT0, LON0 = 37.5, 127.0
+
+
+def north_of(lat, dist):
+  return lat + math.degrees(dist / EARTH_RADIUS)
+
+
+def east_of(lon, dist, lat=LAT0):
+  return lon + math.degrees(dist / (EARTH_RADIUS * math.cos(math.radians(lat))))
+
+
+def trace(start_dist, end_dist, step=10., lon=LON0):
+  """Synthetic gps trace driving north along a straight road"""
+  d = start_dist
+  while d <= end_dist:
+    yield d, north_of(LAT0, d), lon
+    d += step
+
+
+class TestRoadSpeedDB(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, "road_speed_db.bin")
+
+    entries = [
+      # northbound camera 2 km up the road, and a southbound one next to it
+      RoadSpeedEntry(north_of(LAT0, 2000.), LON0, 0., KIND_CAMERA, 1, 60),
+      RoadSpeedEntry(north_of(LAT0, 2100.), LON0, 180., KIND_CAMERA, 1, 80),
+      # section from 3 km to 5 km
+      RoadSpeedEntry(north_of(LAT0, 3000.), LON0, 0., KIND_SECTION, 2, 100, north_of(LAT0, 5000.), LON0),
+    ]
+    # lots of unrelated cameras on other roads
+    for i in range(5000):
+      entries.append(RoadSpeedEntry(LAT0 + (i % 100) * 0.005, LON0 + 0.02 + (i // 100) * 0.005, None, KIND_CAMERA, 1, 50))
+    build(entries, self.path)
+    self.db = RoadSpeedDB(self.path)
+
+  def tearDown(self):
+    self.db.close()
+    shutil.rmtree(self.tmp)
+
+  def test_camera_ahead(self):
+    dists = {}
+    for d, lat, lon in trace(0., 2500.):
+      m = self.db.ahead(lat, lon, 0., KIND_CAMERA)
+      dists[d] = None if m is None else (m.entry.limit, m.dist)
+
+    self.assertIsNone(dists[0.])
+    self.assertEqual(dists[1500.][0], 60)
+    self.assertAlmostEqual(dists[1500.][1], 500., delta=1.)
+    # camera is behind us, southbound camera doesn't apply
+    self.assertIsNone(dists[2050.])
+
+    m = self.db.ahead(north_of(LAT0, 2500.), LON0, 180., KIND_CAMERA)
+    self.assertEqual(m.entry.limit, 80)
+
+  def test_camera_ahead_east(self):
+    # cells are narrower than the lookahead east/west, drive east across several cell borders
+    lat = LAT0
+    # right past the western border of a cell, so the car is two cells away before it's in range
+    cam_lon = math.floor(east_of(LON0, 5000., lat) / DEFAULT_CELL_DEG) * DEFAULT_CELL_DEG + 0.0005
+    self.db.close()
+    build([RoadSpeedEntry(lat, cam_lon, 90., KIND_CAMERA, 1, 70)], self.path)
+    self.db = RoadSpeedDB(self.path)
+
+    for i in range(500):
+      lon = east_of(cam_lon, -1500. + i * 5., lat)
+      dist = local_offset(lat, lon, lat, cam_lon)[0]
+      m = self.db.ahead(lat, lon, 90., KIND_CAMERA)
+      if 1. < dist <= LOOKAHEAD_DIST - 1.:
+        self.assertIsNotNone(m, f"camera {dist:.0f} m ahead not found")
+        self.assertAlmostEqual(m.dist, dist, delta=1.)
+      elif dist < -1. or dist > LOOKAHEAD_DIST + 1.:
+        self.assertIsNone(m)
+
+  def test_offline_section(self):
+    limiter = OfflineRoadLimit(self.db)
+    left = {}
+    for d, lat, lon in trace(2000., 5500.):
+      left[d] = limiter.update(lat, lon, 0.).get("section_left_dist")
+
+    self.assertIsNone(left[2900.])
+    self.assertAlmostEqual(left[3000.], 2000., delta=2.)
+    self.assertAlmostEqual(left[4000.], 1000., delta=2.)
+    self.assertIsNone(left[5000.])
+    self.assertIsNone(left[5500.])
+
+  def test_lookup_time(self):
+    n = 1000
+    points = list(trace(0., n * 5., step=5.))[:n]
+    t = time.perf_counter()
+    for d, lat, lon in points:
+      self.db.ahead(lat, lon, 0., KIND_CAMERA)
+    self.assertLess((time.perf_counter() - t) / n, 100e-6)
+
+
+if __name__ == "__main__":
+  unittest.main()
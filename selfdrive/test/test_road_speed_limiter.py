@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from common.conversions import Conversions as CV
+import selfdrive.road_speed_limiter as rsl
+from selfdrive.road_speed_limiter import RoadSpeedLimiter, SlowdownProfile, SLOWDOWN_ACCEL, SLOWDOWN_ACCEL_MAX
+
+
+def decels(profile, conv):
+  """Deceleration (m/s^2) between the table's points, nearest to the camera first"""
+  v = [s * conv for s in profile.table]
+  return [(v[i] ** 2 - v[i - 1] ** 2) / (2 * profile.STEP) for i in range(1, len(v))]
+
+
+class TestSlowdownProfile(unittest.TestCase):
+  def test_profile(self):
+    profile = SlowdownProfile(100., 60., 800., 60., CV.KPH_TO_MS)
+    self.assertEqual(profile.get(60.), 60.)
+    self.assertEqual(profile.get(10.), 60.)
+    self.assertEqual(profile.get(profile.start_dist + 10.), 100.)
+    # fits before the camera at the comfortable decel
+    self.assertLessEqual(profile.start_dist, 800.)
+
+    speeds = [profile.get(d) for d in range(60, int(profile.start_dist) + 2)]
+    self.assertTrue(all(a <= b for a, b in zip(speeds, speeds[1:])))
+    self.assertAlmostEqual(profile.get(profile.start_dist), 100., delta=0.5)
+
+    a = decels(profile, CV.KPH_TO_MS)
+    self.assertLessEqual(max(a), SLOWDOWN_ACCEL + 0.05)
+    self.assertGreater(max(a), SLOWDOWN_ACCEL * 0.9)
+    # jerk limited, the decel ramps up from and back down to zero
+    self.assertLess(a[0], 0.2)
+    self.assertLess(a[-1], 0.2)
+
+  def test_close_camera(self):
+    # not enough room at the comfortable decel, brakes harder up to the max
+    profile = SlowdownProfile(100., 60., 150., 60., CV.KPH_TO_MS)
+    self.assertGreater(max(decels(profile, CV.KPH_TO_MS)), SLOWDOWN_ACCEL + 0.05)
+    self.assertLessEqual(max(decels(profile, CV.KPH_TO_MS)), SLOWDOWN_ACCEL_MAX + 0.05)
+
+  def test_already_slow(self):
+    profile = SlowdownProfile(50., 60., 500., 30., CV.KPH_TO_MS)
+    self.assertEqual(profile.get(200.), 60.)
+    self.assertEqual(profile.get(30.), 60.)
+
+
+class TestDeadReckoning(unittest.TestCase):
+  def setUp(self):
+    self.t = 0.
+    self.msgs = []
+    for patch in (mock.patch.object(rsl.messaging, "sub_sock", create=True),
+                  mock.patch.object(rsl.messaging, "recv_sock", lambda sock, wait: self.msgs.pop(0) if self.msgs else None, create=True),
+                  mock.patch.object(rsl, "sec_since_boot", lambda: self.t)):
+      patch.start()
+      self.addCleanup(patch.stop)
+    self.limiter = RoadSpeedLimiter()
+
+  def publish(self, dist):
+    self.msgs.append(SimpleNamespace(roadLimitSpeed=SimpleNamespace(
+      active=1, roadLimitSpeed=30, isHighway=False, camType=1, camLimitSpeedLeftDist=dist, camLimitSpeed=30,
+      sectionLimitSpeed=0, sectionLeftDist=0, camSpeedFactor=1.0)))
+
+  def max_speed(self):
+    # 72 kph is 20 m/s
+    return self.limiter.get_max_speed(72., True)[0]
+
+  def test_republished_distance(self):
+    self.publish(300)
+    self.max_speed()
+    profile = self.limiter.profile
+    self.assertNotEqual(profile.get(300), profile.get(260))
+
+    # the server republishes the same distance at 10 Hz until the app sends a new one
+    for _ in range(20):
+      self.t += 0.1
+      self.publish(300)
+      speed = self.max_speed()
+    self.assertTrue(self.limiter.profile_applied)
+    self.assertEqual(speed, profile.get(300 - 20. * 2.))
+
+    self.publish(250)
+    self.max_speed()
+    self.t += 0.5
+    self.publish(250)
+    self.assertEqual(self.max_speed(), profile.get(250 - 20. * 0.5))
+
+
+if __name__ == "__main__":
+  unittest.main()
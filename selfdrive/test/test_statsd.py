@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import time
+import unittest
+from unittest import mock
+
+import zmq
+
+from common.ddsketch import DDSketch
+from selfdrive import statsd
+from selfdrive.statsd import METRIC_HEADER, METRIC_TYPE, StatLog, pack_metrics, parse_metrics
+
+TEST_SOCKET = "ipc:///tmp/stats_test"
+
+
+class TestStatsd(unittest.TestCase):
+  def test_parse(self):
+    sketch = DDSketch()
+    for v in range(100):
+      sketch.add(v)
+    metrics = parse_metrics(pack_metrics({"cpu0_temperature": 50.}, {"power_draw": sketch}))
+    self.assertEqual(metrics[0], ("cpu0_temperature", METRIC_TYPE.GAUGE, 50.))
+    self.assertEqual(metrics[1][:2], ("power_draw", METRIC_TYPE.SAMPLE))
+    self.assertEqual(metrics[1][2].quantiles([0.5]), sketch.quantiles([0.5]))
+
+    # single metrics from the C++ statlog, in binary and text
+    self.assertEqual(parse_metrics(METRIC_HEADER.pack(b"s", 1.5) + b"frame_time"), [("frame_time", METRIC_TYPE.SAMPLE, 1.5)])
+    self.assertEqual(parse_metrics(b"cpu0_usage_percent:12.000000|g"), [("cpu0_usage_percent", METRIC_TYPE.GAUGE, 12.)])
+
+  @mock.patch.object(statsd, "STATS_SOCKET", TEST_SOCKET)
+  def test_statlog_batches(self):
+    sock = zmq.Context.instance().socket(zmq.PULL)
+    sock.bind(TEST_SOCKET)
+    self.addCleanup(sock.close)
+
+    statlog = StatLog()
+    for i in range(10000):
+      statlog.sample("frame_time", i / 1000)
+      statlog.gauge("frame", i)
+
+    self.assertTrue(sock.poll(int(3 * statsd.STATLOG_FLUSH_INTERVAL * 1000)))
+    metrics = {name: value for name, _, value in parse_metrics(sock.recv())}
+    self.assertEqual(metrics["frame"], 9999)
+    self.assertEqual(metrics["frame_time"].count, 10000)
+
+    # nothing more is sent while there's nothing new
+    time.sleep(2 * statsd.STATLOG_FLUSH_INTERVAL)
+    self.assertFalse(sock.poll(0))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import json
+import logging
+import unittest
+from collections import namedtuple
+
+from common.logging_extra import NiceOrderedDict, SwagFormatter, SwagLogFileFormatter, SwagLogger, json_robust_dumps
+
+Item = namedtuple("Item", ["path", "size"])
+
+
+class RecordCapture(logging.Handler):
+  def __init__(self):
+    super().__init__()
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(record)
+
+
+class TestSwaglogFormat(unittest.TestCase):
+  def setUp(self):
+    self.log = SwagLogger()
+    self.capture = RecordCapture()
+    self.log.addHandler(self.capture)
+    self.log.bind_global(dongle_id="0000")
+    self.formatter = SwagFormatter(self.log)
+
+  def records(self):
+    self.log.info("plain %s", "message")
+    self.log.event("upload", fn="/data/media/0/realdata/rlog.bz2", sz=1234, item=Item("a", 1), nested={"x": [1.5, None]})
+    self.log.timestamp("ts")
+    try:
+      raise ValueError("boom")
+    except ValueError:
+      self.log.exception("failed")
+    return self.capture.records
+
+  def test_binary_matches_json(self):
+    consumer = SwagFormatter(None)
+    for record in self.records():
+      expected = json_robust_dumps(self.formatter.format_dict(record))
+      self.assertEqual(json_robust_dumps(consumer.load_binary(self.formatter.format_binary(record))), expected)
+
+  def test_file_format(self):
+    consumer = SwagFormatter(None)
+    file_formatter = SwagLogFileFormatter(None)
+    for record in self.records():
+      from_str = json.loads(file_formatter.format(json_robust_dumps(self.formatter.format_dict(record))))
+      record_dict = consumer.load_binary(self.formatter.format_binary(record))
+      from_dict = json.loads(file_formatter.format(record_dict))
+      self.assertNotEqual(from_str.pop("id"), from_dict.pop("id"))
+      self.assertEqual(from_str, from_dict)
+      self.assertIn("msg", record_dict)
+      self.assertIsInstance(record_dict, NiceOrderedDict)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from selfdrive.loggerd.upload_engine import BLOCK_SIZE, TokenBucket, block_id, new_session, upload_file
+
+
+class BlobServer(ThreadingHTTPServer):
+  """Stand-in for the block blob upload urls the upload_url endpoint hands out"""
+  daemon_threads = True
+
+  def __init__(self):
+    super().__init__(("127.0.0.1", 0), BlobHandler)
+    self.blobs = {}
+    self.blocks = {}
+    self.fail_blocks = set()
+    self.block_puts = []
+    self.connections = set()
+
+
+class BlobHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, *args):
+    pass
+
+  def do_PUT(self):
+    server = self.server
+    server.connections.add(self.client_address)
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    body = self.rfile.read(int(self.headers["Content-Length"]))
+
+    comp = query.get("comp", [None])[0]
+    if comp == "block":
+      block = query["blockid"][0]
+      server.block_puts.append(block)
+      if block in server.fail_blocks:
+        server.fail_blocks.discard(block)
+        return self.reply(500)
+      server.blocks.setdefault(url.path, {})[block] = body
+    elif comp == "blocklist":
+      blocks = server.blocks.pop(url.path, {})
+      ids = re.findall(r"<Latest>(.*?)</Latest>", body.decode())
+      if any(i not in blocks for i in ids):
+        return self.reply(400)
+      server.blobs[url.path] = b"".join(blocks[i] for i in ids)
+    else:
+      server.blobs[url.path] = body
+    self.reply(201)
+
+  def reply(self, status):
+    self.send_response(status)
+    self.send_header("Content-Length", "0")
+    self.end_headers()
+
+
+class TestUploadEngine(unittest.TestCase):
+  def setUp(self):
+    self.server = BlobServer()
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url = f"http://127.0.0.1:{self.server.server_port}"
+    self.session = new_session()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def make_file(self, size):
+    f = tempfile.NamedTemporaryFile(delete=False)
+    f.write(os.urandom(size))
+    f.close()
+    self.addCleanup(os.unlink, f.name)
+    with open(f.name, "rb") as f:
+      return f.name, f.read()
+
+  def test_single_put(self):
+    fn, dat = self.make_file(100 * 1024)
+    resp = upload_file(self.session, self.url + "/small?sig=1", {"x-ms-blob-type": "BlockBlob"}, fn)
+    self.assertEqual(resp.status_code, 201)
+    self.assertEqual(self.server.blobs["/small"], dat)
+    self.assertEqual(self.server.block_puts, [])
+
+  def test_resume(self):
+    fn, dat = self.make_file(int(4.5 * BLOCK_SIZE))
+    headers = {"x-ms-blob-type": "BlockBlob"}
+
+    progress = []
+    on_block = progress.append
+
+    # third block fails, the next attempt continues from it
+    self.server.fail_blocks.add(block_id(2))
+    resp = upload_file(self.session, self.url + "/rlog?sig=1", headers, fn, on_block=on_block)
+    self.assertEqual(resp.status_code, 500)
+    self.assertEqual(progress[-1], 2)
+    first_puts = list(self.server.block_puts)
+
+    sent = []
+    resp = upload_file(self.session, self.url + "/rlog?sig=2", headers, fn, callback=lambda sz, cur: sent.append(cur),
+                       blocks_done=progress[-1], on_block=on_block)
+    self.assertEqual(resp.status_code, 201)
+    self.assertEqual(self.server.blobs["/rlog"], dat)
+    self.assertEqual(self.server.block_puts[len(first_puts):], [block_id(i) for i in range(2, 5)])
+    self.assertEqual(sent[-1], len(dat))
+    self.assertEqual(progress[-1], 5)
+
+    # all requests went over the pooled connection
+    self.assertEqual(len(self.server.connections), 1)
+
+  def test_expired_blocks(self):
+    fn, _ = self.make_file(3 * BLOCK_SIZE)
+    progress = []
+    resp = upload_file(self.session, self.url + "/expired", {"x-ms-blob-type": "BlockBlob"}, fn,
+                       blocks_done=2, on_block=progress.append)
+    self.assertEqual(resp.status_code, 400)
+    self.assertEqual(progress, [3, 0])
+
+  def test_token_bucket(self):
+    bucket = TokenBucket(100e3, burst=0)
+    t = time.monotonic()
+    for _ in range(5):
+      bucket.consume(20e3)
+    self.assertGreater(time.monotonic() - t, 0.35)
+
+    bucket.set_rate(0)
+    t = time.monotonic()
+    bucket.consume(1e9)
+    self.assertLess(time.monotonic() - t, 0.1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from selfdrive.loggerd.upload_engine import WIFI_CONCURRENCY
+from selfdrive.loggerd.uploader import Uploader, fill_upload_slots
+
+
+class TestUploadSlots(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.addCleanup(self.tmp.cleanup)
+    self.uploader = Uploader("0000000000000000", self.tmp.name)
+    self.executor = ThreadPoolExecutor(max_workers=WIFI_CONCURRENCY)
+    self.release = threading.Event()
+    self.addCleanup(self.executor.shutdown)
+    self.addCleanup(self.release.set)
+
+  def make_files(self, names):
+    os.mkdir(os.path.join(self.tmp.name, "crash"))
+    for name in names:
+      with open(os.path.join(self.tmp.name, "crash", name), "wb") as f:
+        f.write(b"\0" * 100)
+
+  def fill(self, uploads):
+    with mock.patch.object(self.uploader, "upload", side_effect=lambda *args: self.release.wait(10)):
+      fill_upload_slots(self.uploader, self.executor, uploads, WIFI_CONCURRENCY, "wifi", False)
+
+  def test_one_slot_per_file(self):
+    self.make_files(["a", "b"])
+    uploads = {}
+    self.fill(uploads)
+    self.assertEqual(sorted(uploads.values()), ["crash/a", "crash/b"])
+
+    # the running uploads aren't picked again
+    open(os.path.join(self.tmp.name, "crash", "c"), "wb").close()
+    self.fill(uploads)
+    self.assertEqual(sorted(uploads.values()), ["crash/a", "crash/b", "crash/c"])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -14,7 +14,7 @@ import cereal.messaging as messaging
 from cereal import log
 from common.dict_helpers import strip_deprecated_keys
 from common.filter_simple import FirstOrderFilter
-from common.params import Params
+from common.params import Params, put_nonblocking, flush as params_flush
 from common.realtime import DT_TRML, sec_since_boot
 from selfdrive.controls.lib.alertmanager import set_offroad_alert
 from selfdrive.hardware import EON, HARDWARE, PC, TICI
@@ -342,17 +342,17 @@ def thermald_thread(end_event, hw_queue):
       should_start = should_start and all(startup_conditions.values())
 
     if should_start != should_start_prev or (count == 0):
-      params.put_bool("IsOnroad", should_start)
-      params.put_bool("IsOffroad", not should_start)
+      put_nonblocking("IsOnroad", "1" if should_start else "0")
+      put_nonblocking("IsOffroad", "0" if should_start else "1")
 
-      params.put_bool("IsEngaged", False)
+      put_nonblocking("IsEngaged", "0")
       engaged_prev = False
       HARDWARE.set_power_save(not should_start)
 
     if sm.updated['controlsState']:
       engaged = sm['controlsState'].enabled
       if engaged != engaged_prev:
-        params.put_bool("IsEngaged", engaged)
+        put_nonblocking("IsEngaged", "1" if engaged else "0")
         engaged_prev = engaged
 
       try:
@@ -391,6 +391,7 @@ def thermald_thread(end_event, hw_queue):
     # Check if we need to shut down
     if power_monitor.should_shutdown(peripheralState, onroad_conditions["ignition"], in_car, off_ts, started_seen):
       cloudlog.warning(f"shutting device down, offroad since {off_ts}")
+      params_flush(1.)
       params.put_bool("DoShutdown", True)
 
     msg.deviceState.chargingError = current_filter.x > 0. and msg.deviceState.batteryPercent < 90  # if current is positive, then battery is being discharged
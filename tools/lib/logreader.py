@@ -2,6 +2,7 @@
 import os
 import sys
 import bz2
+import lzma
 import urllib.parse
 import capnp
 
@@ -83,6 +84,10 @@ class LogReader:
     elif ext == ".bz2":
       dat = bz2.decompress(dat)
       ents = capnp_log.Event.read_multiple_bytes(dat)
+    elif ext == ".xz":
+      # recompressed on device for athena uploads
+      dat = lzma.decompress(dat)
+      ents = capnp_log.Event.read_multiple_bytes(dat)
     else:
       raise Exception(f"unknown extension {ext}")
 